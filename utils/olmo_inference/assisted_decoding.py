@@ -0,0 +1,138 @@
+"""
+Assisted (speculative) decoding with a small draft model.
+
+The draft model proposes a few tokens, the target model scores all of them in a
+single forward pass and keeps the longest prefix consistent with its own
+distribution, plus one token of its own. With sampling this is speculative
+sampling when both models share a vocabulary (the draft's probabilities are
+used for the accept/reject test) and token matching against the target's own
+samples otherwise; both leave the target's sampling distribution unchanged.
+generate's output_scores still hold the target's processed logits for every
+kept token, so the token metrics are computed exactly as without a draft.
+
+generate does not report how many draft tokens were accepted, so it is
+estimated from forward-pass counts: every target pass verifies one round of
+draft tokens and adds one token of its own, so
+    accepted = new tokens - target passes, proposed = draft passes.
+With a draft using a different tokenizer the two counts are in different token
+units and the rate is only indicative.
+"""
+import time
+from model_registry import load_model, resolve_model_name
+
+class AssistedDecoding:
+    """
+    Draft model for generate(assistant_model=...) and counters of its acceptance.
+
+    Args:
+        assistant_model: Draft causal LM, on the same device as the target model
+        assistant_tokenizer: Tokenizer of the draft model
+        tokenizer: Tokenizer of the target model
+        num_assistant_tokens (int): Tokens drafted per round, None for the draft's
+            generation_config default (adjusted by its schedule during generation)
+    """
+    def __init__(self, assistant_model, assistant_tokenizer, tokenizer, num_assistant_tokens=None):
+        self.assistant_model = assistant_model
+        self.assistant_tokenizer = assistant_tokenizer
+        self.tokenizer = tokenizer
+        if num_assistant_tokens is not None:
+            assistant_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        # Same vocabulary: the draft's logits take part in speculative sampling;
+        # otherwise generate re-tokenizes the drafts (universal assisted decoding)
+        self.shares_tokenizer = assistant_tokenizer.get_vocab() == tokenizer.get_vocab()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.new_tokens = 0
+        self.target_passes = 0
+        self.draft_passes = 0
+        self.seconds = 0.0
+
+    def generate_kwargs(self):
+        """Extra generate() arguments for decoding with the draft model."""
+        kwargs = {"assistant_model": self.assistant_model}
+        if not self.shares_tokenizer:
+            kwargs["tokenizer"] = self.tokenizer
+            kwargs["assistant_tokenizer"] = self.assistant_tokenizer
+        return kwargs
+
+    def generate(self, model, num_new_tokens, **generate_kwargs):
+        """
+        Call model.generate with the draft model and count its forward passes.
+
+        Args:
+            num_new_tokens (callable): Maps the generate output to the number of new
+                tokens it holds (up to and including the first EOS)
+
+        Returns:
+            tuple: (generate output, stats dict of this call, see call_stats)
+        """
+        counts = {"target": 0, "draft": 0}
+        hooks = [
+            model.register_forward_hook(lambda *_: counts.__setitem__("target", counts["target"] + 1)),
+            self.assistant_model.register_forward_hook(lambda *_: counts.__setitem__("draft", counts["draft"] + 1))
+        ]
+        try:
+            start = time.perf_counter()
+            output = model.generate(**generate_kwargs, **self.generate_kwargs())
+            seconds = time.perf_counter() - start
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        new_tokens = num_new_tokens(output)
+        self.calls += 1
+        self.new_tokens += new_tokens
+        self.target_passes += counts["target"]
+        self.draft_passes += counts["draft"]
+        self.seconds += seconds
+        return output, call_stats(new_tokens, counts["target"], counts["draft"], seconds)
+
+    def stats(self):
+        """Counters accumulated since the last reset, see call_stats."""
+        return call_stats(self.new_tokens, self.target_passes, self.draft_passes, self.seconds)
+
+    def report(self, label=""):
+        stats = self.stats()
+        print(f"Assisted decoding{' ' + label if label else ''}: {self.calls} calls, "
+              f"{stats['new_tokens']} tokens at {stats['tokens_per_second']:.1f} tokens/s, "
+              f"acceptance rate {stats['acceptance_rate']:.1%}, "
+              f"{stats['tokens_per_target_pass']:.2f} tokens per target forward pass")
+
+def call_stats(new_tokens, target_passes, draft_passes, seconds):
+    """
+    Throughput and acceptance of assisted generation.
+
+    Returns:
+        dict: new_tokens, seconds, tokens_per_second, target_passes, draft_passes,
+            acceptance_rate (accepted / proposed draft tokens) and tokens_per_target_pass
+    """
+    accepted = max(0, new_tokens - target_passes)
+    return {
+        "new_tokens": new_tokens,
+        "seconds": seconds,
+        "tokens_per_second": new_tokens / seconds if seconds > 0 else 0.0,
+        "target_passes": target_passes,
+        "draft_passes": draft_passes,
+        "acceptance_rate": min(1.0, accepted / draft_passes) if draft_passes else 0.0,
+        "tokens_per_target_pass": new_tokens / target_passes if target_passes else 0.0
+    }
+
+def load_assistant_from_args(args, tokenizer, device=None):
+    """
+    Load the --assistant_model draft model, if any, for the target model's tokenizer.
+
+    Returns:
+        AssistedDecoding or None
+    """
+    if not getattr(args, "assistant_model", None):
+        return None
+    assistant_model, assistant_tokenizer = load_model(args.assistant_model, device=device, dtype=args.dtype,
+                                                      low_cpu_mem_usage=not args.no_low_cpu_mem_usage,
+                                                      checkpoint_dir=args.checkpoint_dir)
+    assistant = AssistedDecoding(assistant_model, assistant_tokenizer, tokenizer, args.num_assistant_tokens)
+    if not assistant.shares_tokenizer:
+        print(f"{resolve_model_name(args.assistant_model)} uses a different tokenizer than the target model; "
+              "its drafts are re-tokenized (universal assisted decoding)")
+    return assistant
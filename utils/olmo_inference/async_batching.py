@@ -0,0 +1,180 @@
+"""
+asyncio front-end that micro-batches single-prompt inference calls.
+
+run_inference completes one prompt per call and blocks. AsyncBatcher takes the
+same calls as coroutines and coalesces the ones that arrive within batch_window
+seconds of each other (or until max_batch_size are waiting) into batched
+run_batched_inference calls, so notebook cells and concurrent prompt-key loops
+sharing one loaded model get batching throughput without building batches
+themselves:
+
+    batcher = AsyncBatcher(model, tokenizer, device)
+    results = await asyncio.gather(*(batcher.generate_async(get_prompt(key), {"seed": i})
+                                     for i, key in enumerate(prompt_keys)))
+
+Only calls with the same decoding parameters share a batch. A seeded call
+samples from its own generator, so its completion does not depend on the other
+calls in its batch, except where the float differences between batch shapes
+described in seeding.py flip a token. Batches are bucketed by prompt length and
+generated one at a time on a single worker thread, keeping the event loop free
+while the model runs; calls arriving meanwhile are gathered for the next batch.
+"""
+import json
+import asyncio
+import functools
+import concurrent.futures
+from batching import bucket_by_length
+from many_normal_prompt import run_batched_inference
+
+# run_inference keyword arguments accepted in params; seed is per call, the rest
+# must agree for calls to share a batch
+PARAMS = ("max_new_tokens", "do_sample", "top_k", "top_p", "stop_criteria", "logit_snapshot_k", "engine", "seed")
+
+def _fail(calls, error):
+    """Raise error in the callers of calls that are still waiting."""
+    for _, _, future in calls:
+        if not future.done():
+            future.set_exception(error)
+
+class AsyncBatcher:
+    """
+    Micro-batching asyncio front-end of run_inference for one loaded model.
+
+    Args:
+        model, tokenizer: The loaded model and its tokenizer
+        device (str): Device of the model
+        max_batch_size (int): Maximum number of calls generated together
+        batch_window (float): Seconds to wait for more calls after the first one
+        stream_metrics (bool): Compute token metrics during generation (see
+            run_batched_inference); keeps memory flat for large batches
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=16, batch_window=0.01, stream_metrics=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.stream_metrics = stream_metrics
+        # One thread: the model generates one batch at a time
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-batcher")
+        self._queue = None
+        self._task = None
+        self.calls = 0
+        self.batches = 0
+
+    async def generate_async(self, prompt, params=None):
+        """
+        run_inference(model, tokenizer, prompt, device, **params), batched with
+        concurrent calls.
+
+        Args:
+            prompt (str): The prompt to complete
+            params (dict): run_inference keyword arguments, see PARAMS
+
+        Returns:
+            dict: The run_inference result
+        """
+        params = dict(params or {})
+        unknown = set(params) - set(PARAMS)
+        if unknown:
+            raise ValueError(f"Unsupported parameters: {sorted(unknown)}")
+        if self._task is not None and self._task.done():
+            # Failures are sent to the calls they belong to, so this is a bug; calls
+            # already queued are picked up by the restarted task
+            if not self._task.cancelled() and self._task.exception() is not None:
+                print(f"Async batching task failed, restarting it: {self._task.exception()!r}")
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._task is None:
+            # Bound to the event loop of the first call
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, params, future))
+        return await future
+
+    async def close(self):
+        """Stop batching (pending calls are cancelled) and release the worker thread."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            while not self._queue.empty():
+                self._queue.get_nowait()[2].cancel()
+        self._executor.shutdown(wait=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Callers that gave up meanwhile are not generated
+            pending = [call for call in pending if not call[2].done()]
+            groups = {}
+            for call in pending:
+                params = call[1]
+                try:
+                    key = json.dumps({name: params[name] for name in params if name != "seed"}, sort_keys=True)
+                except (TypeError, ValueError) as e:
+                    _fail([call], e)
+                    continue
+                groups.setdefault((key, params.get("seed") is not None), []).append(call)
+            for calls in groups.values():
+                try:
+                    await self._generate_group(loop, calls)
+                except Exception as e:
+                    _fail(calls, e)
+
+    async def _generate_group(self, loop, calls):
+        tokenized = []
+        for call in calls:
+            try:
+                tokenized.append((call, self.tokenizer(call[0], return_token_type_ids=False)["input_ids"]))
+            except Exception as e:
+                _fail([call], e)
+        if not tokenized:
+            return
+        calls = [call for call, _ in tokenized]
+        prompt_token_ids = [ids for _, ids in tokenized]
+        for bucket in bucket_by_length([len(ids) for ids in prompt_token_ids], self.max_batch_size):
+            batch = [calls[i] for i in bucket]
+            kwargs = {name: value for name, value in batch[0][1].items() if name != "seed"}
+            seeds = None
+            if batch[0][1].get("seed") is not None:
+                seeds = [params["seed"] for _, params, _ in batch]
+            generate = functools.partial(
+                run_batched_inference,
+                self.model,
+                self.tokenizer,
+                [prompt for prompt, _, _ in batch],
+                self.device,
+                stream_metrics=self.stream_metrics,
+                prompt_token_ids=[prompt_token_ids[i] for i in bucket],
+                seeds=seeds,
+                **kwargs
+            )
+            try:
+                results = await loop.run_in_executor(self._executor, generate)
+            except Exception as e:
+                _fail(batch, e)
+                continue
+            self.calls += len(batch)
+            self.batches += 1
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def report(self):
+        if self.batches:
+            print(f"Async batching: {self.calls} calls in {self.batches} batches "
+                  f"(average batch size {self.calls / self.batches:.1f})")
@@ -0,0 +1,360 @@
+"""
+Automatic batch sizes and out-of-memory backoff.
+
+The largest batch that fits depends on the model, its dtype, the device, the
+prompt length and max_new_tokens. BatchSizeTuner probes it the first time a
+(model, device, prompt length bucket, max_new_tokens) combination is used and
+keeps the result in a small JSON profile, so later runs start at the right size
+straight away:
+
+    {"<model>|<dtype or int8>|<device>|<scores>|<prompt bucket>|<max_new_tokens>":
+        {"batch_size": 24, "peak_bytes": ..., "budget_bytes": ...}}
+
+A probe runs the worst case of a batch: a forward pass over prompt_length +
+max_new_tokens tokens with the KV cache (plus the scores generate keeps when
+output_scores is on) and measures its peak memory, the allocator's peak on CUDA
+and the peak RSS on CPU. The batch size doubles until the peak exceeds the
+memory budget, an allocation fails, or the per-row growth predicts the next size
+would not fit (on CPU the kernel kills a process that overshoots rather than
+raising), and is then bisected.
+
+A batch that still runs out of memory at runtime is split in halves and retried
+by split_on_oom, and the profile entry is lowered to the size that fit.
+"""
+import os
+import gc
+import sys
+import json
+import math
+import time
+import resource
+import torch
+from cpu_inference import model_precision
+from decode_engine import logits_to_keep_argument
+
+DEFAULT_PROFILE = os.path.join(os.path.expanduser("~"), ".cache", "olmo_inference", "batch_profile.json")
+
+# Error messages of failed allocations: CUDA and MPS ("out of memory"), the CPU
+# allocator on Linux/macOS and on Windows
+OOM_MESSAGES = ("out of memory", "can't allocate memory", "not enough memory")
+
+def is_oom_error(exc):
+    """Whether an exception is an allocation failure on any device."""
+    oom_types = tuple(
+        error_type for error_type in (getattr(torch, "OutOfMemoryError", None),
+                                      getattr(torch.cuda, "OutOfMemoryError", None))
+        if error_type is not None
+    )
+    if isinstance(exc, MemoryError) or (oom_types and isinstance(exc, oom_types)):
+        return True
+    return isinstance(exc, RuntimeError) and any(message in str(exc) for message in OOM_MESSAGES)
+
+def release_memory(device):
+    """Return cached allocations to the device after a failed or probing batch."""
+    gc.collect()
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    elif device.type == "mps":
+        torch.mps.empty_cache()
+
+def cpu_memory_limit():
+    """Memory available to this process: the tightest of the cgroup limit, RLIMIT_AS and physical memory."""
+    limits = []
+    soft, _ = resource.getrlimit(resource.RLIMIT_AS)
+    if soft != resource.RLIM_INFINITY:
+        limits.append(soft)
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limits.append(int(value))
+    if hasattr(os, "sysconf") and "SC_PHYS_PAGES" in os.sysconf_names:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    return min(limits) if limits else None
+
+def memory_budget(device):
+    """Bytes this process can use on a device, None if unknown."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device)
+    if device.type == "cpu":
+        return cpu_memory_limit()
+    return None
+
+def _reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    elif device.type == "cpu":
+        # Resets VmHWM, the peak RSS (Linux only)
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+def _peak_memory(device):
+    """Peak memory since _reset_peak_memory, None if the device does not report it."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_reserved(device)
+    if device.type != "cpu":
+        return None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Without /proc the peak cannot be reset, so this is the peak of the whole process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def prompt_length_bucket(prompt_length):
+    """Profile bucket of a prompt length: the next power of two (at least 64)."""
+    return max(64, 2 ** math.ceil(math.log2(max(prompt_length, 1))))
+
+def split_on_oom(generate, positions, device, on_oom=None):
+    """
+    Call generate(positions), splitting positions in halves and retrying when a
+    batch runs out of memory.
+
+    Args:
+        generate (callable): Generates the completions at a list of positions and
+            returns their results in that order
+        positions (list): Positions of the completions to generate
+        device (str): Device whose cached memory is released before a retry
+        on_oom (callable): Called with the size of every batch that ran out of memory
+
+    Returns:
+        list: One result per position
+    """
+    positions = list(positions)
+    try:
+        return generate(positions)
+    except Exception as e:
+        if not is_oom_error(e) or len(positions) == 1:
+            raise
+    # Retry outside the except block, so the failed batch's tensors held by the
+    # traceback are freed first
+    release_memory(device)
+    half = len(positions) // 2
+    print(f"Out of memory on a batch of {len(positions)}, retrying as {half} + {len(positions) - half}")
+    if on_oom is not None:
+        on_oom(len(positions))
+    return (split_on_oom(generate, positions[:half], device, on_oom)
+            + split_on_oom(generate, positions[half:], device, on_oom))
+
+class BatchSizeTuner:
+    """
+    Largest batch size that fits, per prompt length bucket and max_new_tokens,
+    probed on first use and persisted in a profile file.
+
+    Args:
+        model: The causal LM the batches run on
+        device (str): Its device
+        profile_path (str): JSON profile shared by all runs on this machine
+        max_batch_size (int): Never use or probe larger batches
+        keep_scores (bool): Batches keep every step's full-vocabulary scores
+            (generate with output_scores, i.e. without stream_metrics)
+        memory_fraction (float): Share of the device memory budget a batch may use
+            (lower it when several workers share a device)
+    """
+    def __init__(self, model, device, profile_path=DEFAULT_PROFILE, max_batch_size=64, keep_scores=False,
+                 memory_fraction=0.9):
+        self.model = model
+        self.device = torch.device(device)
+        self.profile_path = profile_path
+        self.max_batch_size = max_batch_size
+        self.keep_scores = keep_scores
+        self.memory_fraction = memory_fraction
+        self._sizes = {}
+
+    def _device_name(self):
+        # Devices of the same kind with different memory get their own entries
+        if self.device.type == "cuda":
+            total = torch.cuda.mem_get_info(self.device)[1]
+            return f"{torch.cuda.get_device_name(self.device)} {total / 1024 ** 3:.0f}GiB"
+        total = cpu_memory_limit() if self.device.type == "cpu" else None
+        return f"{self.device.type} {total / 1024 ** 3:.0f}GiB" if total else self.device.type
+
+    def _key(self, prompt_length, max_new_tokens):
+        return "|".join([
+            str(self.model.config.name_or_path),
+            model_precision(self.model),
+            self._device_name(),
+            "scores" if self.keep_scores else "streamed",
+            str(prompt_length_bucket(prompt_length)),
+            str(max_new_tokens)
+        ])
+
+    def _load_profile(self):
+        try:
+            with open(self.profile_path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _store(self, key, entry):
+        # Re-read first: other processes may have added entries since
+        profile = self._load_profile()
+        profile[key] = entry
+        os.makedirs(os.path.dirname(os.path.abspath(self.profile_path)), exist_ok=True)
+        tmp_path = self.profile_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.profile_path)
+
+    def batch_size(self, prompt_length, max_new_tokens):
+        """Batch size for prompts of up to prompt_length tokens, probed if not in the profile yet."""
+        key = self._key(prompt_length, max_new_tokens)
+        if key not in self._sizes:
+            entry = self._load_profile().get(key)
+            if entry is None:
+                entry = self.probe(prompt_length_bucket(prompt_length), max_new_tokens)
+                self._store(key, entry)
+            self._sizes[key] = entry["batch_size"]
+        return min(self._sizes[key], self.max_batch_size)
+
+    def record_oom(self, prompt_length, max_new_tokens, failed_batch_size):
+        """Lower a profile entry after a batch of failed_batch_size ran out of memory."""
+        key = self._key(prompt_length, max_new_tokens)
+        batch_size = max(1, failed_batch_size // 2)
+        if self._sizes.get(key, self.max_batch_size) <= batch_size:
+            return
+        self._sizes[key] = batch_size
+        entry = dict(self._load_profile().get(key, {}), batch_size=batch_size, lowered_at=time.time())
+        self._store(key, entry)
+        print(f"Lowered the batch size for {key} to {batch_size}")
+
+    def split(self, buckets, lengths, max_new_tokens):
+        """Split length buckets (lists of indices into lengths) to the batch size of their longest prompt."""
+        batches = []
+        for bucket in buckets:
+            size = self.batch_size(max(lengths[i] for i in bucket), max_new_tokens)
+            batches.extend(bucket[start:start + size] for start in range(0, len(bucket), size))
+        return batches
+
+    def _run_probe(self, batch_size, prompt_length, max_new_tokens):
+        """Worst case of one batch: the full-length forward with its KV cache, and the kept scores."""
+        vocab_size = self.model.config.vocab_size
+        input_ids = torch.randint(vocab_size, (batch_size, prompt_length + max_new_tokens), device=self.device)
+        forward_kwargs = {}
+        logits_to_keep = logits_to_keep_argument(self.model)
+        if logits_to_keep:
+            forward_kwargs[logits_to_keep] = 1
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), use_cache=True,
+                                **forward_kwargs)
+            scores = None
+            if self.keep_scores:
+                # zeros rather than empty: on CPU untouched pages never count towards RSS
+                scores = torch.zeros((batch_size, max_new_tokens, vocab_size), device=self.device)
+        del output, scores
+
+    def _try(self, batch_size, prompt_length, max_new_tokens):
+        """Peak memory of a probe batch (0 if unknown), None if it ran out of memory."""
+        release_memory(self.device)
+        _reset_peak_memory(self.device)
+        try:
+            self._run_probe(batch_size, prompt_length, max_new_tokens)
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+            peak = None
+        else:
+            peak = _peak_memory(self.device) or 0
+        release_memory(self.device)
+        return peak
+
+    def probe(self, prompt_length, max_new_tokens):
+        """
+        Find the largest batch size that fits.
+
+        Returns:
+            dict: Profile entry with batch_size, the peak memory of that batch and the budget
+        """
+        budget = memory_budget(self.device)
+        budget = budget * self.memory_fraction if budget else None
+        print(f"Probing the batch size for {prompt_length}-token prompts and {max_new_tokens} new tokens "
+              f"on {self._device_name()}")
+        start = time.perf_counter()
+
+        def fits(batch_size):
+            peak = self._try(batch_size, prompt_length, max_new_tokens)
+            ok = peak is not None and (budget is None or peak <= budget)
+            print(f"  batch {batch_size}: " + ("out of memory" if peak is None else
+                  f"{peak / 1024 ** 3:.2f} GiB peak" + ("" if ok else ", over budget")))
+            return ok, peak
+
+        # Double while the batch fits and the per-row growth says the next one will
+        peaks = {}
+        batch_size = 1
+        failed = None
+        while True:
+            ok, peak = fits(batch_size)
+            if not ok:
+                failed = batch_size
+                break
+            peaks[batch_size] = peak
+            if batch_size >= self.max_batch_size:
+                break
+            next_size = min(2 * batch_size, self.max_batch_size)
+            if budget and len(peaks) >= 2 and peak:
+                smaller = max(size for size in peaks if size < batch_size)
+                per_row = (peak - peaks[smaller]) / (batch_size - smaller)
+                if per_row > 0:
+                    next_size = min(next_size, batch_size + int((budget - peak) / per_row))
+            if next_size <= batch_size:
+                break
+            batch_size = next_size
+
+        # Bisect between the largest fitting and the smallest failing size, to within 1/8
+        good = max(peaks) if peaks else 0
+        while failed is not None and failed - good > max(1, good // 8):
+            middle = (good + failed) // 2
+            ok, peak = fits(middle)
+            if ok:
+                good = middle
+                peaks[middle] = peak
+            else:
+                failed = middle
+
+        if not good:
+            print("  Even a batch of 1 does not fit the budget, using 1")
+        batch_size = max(good, 1)
+        print(f"Batch size {batch_size} ({time.perf_counter() - start:.1f}s to probe)")
+        return {
+            "batch_size": batch_size,
+            "peak_bytes": peaks.get(batch_size),
+            "budget_bytes": budget,
+            "probed_at": time.time()
+        }
+
+def add_batch_tuner_arguments(parser):
+    """Add the --auto_batch_size options to an argument parser."""
+    parser.add_argument("--auto_batch_size", action="store_true",
+                        help="Use the largest batch that fits, probed once per model, prompt length and max_tokens "
+                             "(replaces --batch_size for static batches)")
+    parser.add_argument("--max_batch_size", type=int, default=64,
+                        help="Upper bound for --auto_batch_size")
+    parser.add_argument("--batch_profile", type=str, default=DEFAULT_PROFILE,
+                        help="Profile file the probed batch sizes are kept in")
+    return parser
+
+def batch_tuner_from_args(args, model, device, memory_fraction=0.9):
+    """
+    BatchSizeTuner with the options added by add_batch_tuner_arguments.
+
+    Returns:
+        BatchSizeTuner or None (without --auto_batch_size)
+    """
+    if not args.auto_batch_size:
+        return None
+    keep_scores = not args.stream_metrics and getattr(args, "engine", "generate") == "generate"
+    return BatchSizeTuner(model, device, profile_path=args.batch_profile, max_batch_size=args.max_batch_size,
+                          keep_scores=keep_scores, memory_fraction=memory_fraction)
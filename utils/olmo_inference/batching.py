@@ -0,0 +1,42 @@
+"""
+Helpers for batching prompts of different lengths.
+
+Random-document prompts range from a few dozen to many thousands of tokens, so
+batching them in arrival order would spend most of the prefill on padding. Prompts
+are grouped into buckets of similar token length and left-padded within a bucket.
+"""
+
+def bucket_by_length(lengths, batch_size, max_length_ratio=2.0):
+    """
+    Group item indices into batches of similar length.
+
+    Items are sorted by length and a bucket is closed when it holds batch_size items
+    or when the next item is more than max_length_ratio times longer than the
+    bucket's shortest item.
+
+    Args:
+        lengths (list): Token length of each item
+        batch_size (int): Maximum number of items per bucket
+        max_length_ratio (float): Longest / shortest length allowed within a bucket
+
+    Returns:
+        list: Buckets, each a list of indices into lengths, shortest bucket first
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    current = []
+    for i in order:
+        too_long = current and lengths[i] > max_length_ratio * max(lengths[current[0]], 1)
+        if current and (len(current) >= batch_size or too_long):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+def padding_efficiency(lengths, buckets):
+    """Fraction of the padded prefill tokens that are real prompt tokens."""
+    real = sum(lengths[i] for bucket in buckets for i in bucket)
+    padded = sum(len(bucket) * max(lengths[i] for i in bucket) for bucket in buckets)
+    return real / padded if padded else 1.0
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the generation helpers on a tiny, randomly initialised OLMo model.
+
+The model and a byte-level tokenizer are built locally, so these run on any machine
+without downloading a checkpoint. Absolute numbers are meaningless; compare the
+variants within one run.
+
+Usage:
+    python utils/olmo_inference/benchmark.py prefix_cache --num_completions 32 --batch_size 8
+    python utils/olmo_inference/benchmark.py assisted --prompts NLP_research haiku creative_story
+    python utils/olmo_inference/benchmark.py scheduler --num_completions 64 --batch_size 8
+    python utils/olmo_inference/benchmark.py engine --batch_size 8 --max_tokens 128
+    python utils/olmo_inference/benchmark.py cpu_optimized --precision int8
+    python utils/olmo_inference/benchmark.py async_batching --prompts haiku creative_story --num_calls 32
+"""
+
+import os
+import sys
+import time
+import random
+import copy
+import asyncio
+import argparse
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import OlmoConfig, OlmoForCausalLM, PreTrainedTokenizerFast
+
+# Add the parent directory to sys.path to import prompt_store
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prompt_store import get_prompt
+from assisted_decoding import AssistedDecoding
+from async_batching import AsyncBatcher
+from cpu_inference import ENTROPY_TOLERANCE, PRECISIONS, configure_cpu_threads, entropy_drift, optimize_for_cpu
+from many_normal_prompt import run_batched_inference, run_inference
+from prefix_cache import PromptCache
+from scheduler import ContinuousBatchScheduler, GenerationRequest
+from throughput import ThroughputMeter
+
+def build_tiny_tokenizer():
+    """Byte-level BPE tokenizer without merges: one token per byte, round-trips any text."""
+    vocab = {symbol: i for i, symbol in enumerate(pre_tokenizers.ByteLevel.alphabet())}
+    vocab["<|endoftext|>"] = len(vocab)
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+
+def build_tiny_model(tokenizer, hidden_size=128, num_layers=2, num_heads=4, seed=0):
+    """Randomly initialised OLMo causal LM sized for the tiny tokenizer."""
+    torch.manual_seed(seed)
+    config = OlmoConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        max_position_embeddings=4096,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=None,
+        eos_token_id=tokenizer.eos_token_id
+    )
+    return OlmoForCausalLM(config).eval()
+
+def build_draft_model(model, num_layers=1):
+    """
+    Draft model made of the first num_layers layers of model, sharing its embeddings,
+    final norm and LM head, so its predictions are correlated with the full model's
+    even with random weights.
+    """
+    config = model.config.__class__.from_dict(model.config.to_dict())
+    config.num_hidden_layers = num_layers
+    draft = OlmoForCausalLM(config)
+    draft.load_state_dict(model.state_dict(), strict=False)
+    return draft.eval()
+
+def timed(fn, repeats=1):
+    """Run fn repeats times and return (last result, seconds per run)."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeats
+
+def bench_prefix_cache(args):
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    # Repeat the prompt so that prefill is a visible share of the work, as with
+    # the long NLP_research prompts on the real model
+    prompt = " ".join([get_prompt(args.prompt)] * args.prompt_repeats)
+    print(f"Prompt length: {len(tokenizer(prompt)['input_ids'])} tokens")
+
+    def generate_all(prompt_cache):
+        for start in range(0, args.num_completions, args.batch_size):
+            run_batched_inference(
+                model,
+                tokenizer,
+                prompt,
+                'cpu',
+                num_return_sequences=min(args.batch_size, args.num_completions - start),
+                max_new_tokens=args.max_tokens,
+                prompt_cache=prompt_cache
+            )
+
+    with torch.no_grad():
+        _, baseline = timed(lambda: generate_all(None))
+        _, cached = timed(lambda: generate_all(PromptCache()))
+    print(f"Re-prefill every call: {baseline:.2f}s")
+    print(f"Shared prompt cache:   {cached:.2f}s ({baseline / cached:.2f}x)")
+
+def bench_assisted(args):
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    draft = build_draft_model(model, args.draft_layers)
+    assistant = AssistedDecoding(draft, tokenizer, tokenizer, args.num_assistant_tokens)
+
+    for prompt_key in args.prompts:
+        prompt = get_prompt(prompt_key)
+
+        def generate_all(assistant):
+            new_tokens = 0
+            for _ in range(args.num_completions):
+                result = run_inference(model, tokenizer, prompt, 'cpu', max_new_tokens=args.max_tokens,
+                                       assistant=assistant)
+                new_tokens += len(result["token_details"])
+            return new_tokens
+
+        assistant.reset()
+        with torch.no_grad():
+            baseline_tokens, baseline = timed(lambda: generate_all(None))
+            _, assisted = timed(lambda: generate_all(assistant))
+        stats = assistant.stats()
+        baseline_rate = baseline_tokens / baseline if baseline > 0 else 0.0
+        print(f"{prompt_key}: target only {baseline_rate:.1f} tokens/s, "
+              f"assisted {stats['tokens_per_second']:.1f} tokens/s "
+              f"({stats['tokens_per_second'] / baseline_rate if baseline_rate else 0.0:.2f}x), "
+              f"acceptance rate {stats['acceptance_rate']:.1%}, "
+              f"{stats['tokens_per_target_pass']:.2f} tokens per target forward pass")
+
+def bench_scheduler(args):
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    # A random model rarely emits EOS, so every completion gets a target length drawn
+    # from a skewed mix (haiku-short to story-long) and stops there
+    rng = random.Random(0)
+    prompts = [get_prompt(key) for key in args.prompts]
+    jobs = [
+        (prompts[i % len(prompts)], rng.choice([args.min_tokens] * 3 + [args.max_tokens]))
+        for i in range(args.num_completions)
+    ]
+    useful_tokens = sum(length for _, length in jobs)
+
+    def static_batches():
+        # generate runs every batch until its longest completion is done
+        for start in range(0, len(jobs), args.batch_size):
+            batch = jobs[start:start + args.batch_size]
+            run_batched_inference(model, tokenizer, [prompt for prompt, _ in batch], 'cpu',
+                                  max_new_tokens=max(length for _, length in batch))
+
+    def continuous():
+        scheduler = ContinuousBatchScheduler(model, tokenizer, 'cpu', max_batch_size=args.batch_size)
+        requests = [GenerationRequest(i, prompt, max_new_tokens=length) for i, (prompt, length) in enumerate(jobs)]
+        for _ in scheduler.run(requests):
+            pass
+        return scheduler
+
+    with torch.no_grad():
+        _, static = timed(static_batches)
+    scheduler, scheduled = timed(continuous)
+    print(f"{len(jobs)} completions, {useful_tokens} tokens wanted")
+    print(f"Static batches:      {static:.2f}s ({useful_tokens / static:.1f} useful tokens/s)")
+    print(f"Continuous batching: {scheduled:.2f}s ({useful_tokens / scheduled:.1f} useful tokens/s, "
+          f"{static / scheduled:.2f}x)")
+    scheduler.report()
+
+def bench_engine(args):
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    prompt = get_prompt(args.prompt)
+    seeds = list(range(args.batch_size))
+
+    def generate_all(engine):
+        results = []
+        for _ in range(args.num_batches):
+            # Seeded, so both engines sample the same completions
+            results.extend(run_batched_inference(model, tokenizer, prompt, 'cpu', num_return_sequences=args.batch_size,
+                                                 max_new_tokens=args.max_tokens, stream_metrics=True, seeds=seeds,
+                                                 logit_snapshot_k=args.logit_snapshot_k, engine=engine))
+        return results
+
+    with torch.no_grad():
+        generate_all("lean")  # warm-up
+        baseline_results, baseline = timed(lambda: generate_all("generate"))
+        lean_results, lean = timed(lambda: generate_all("lean"))
+    num_tokens = sum(len(result["token_ids"]) for result in baseline_results)
+    same = sum(a["token_ids"] == b["token_ids"] for a, b in zip(baseline_results, lean_results))
+    print(f"{len(baseline_results)} completions, {num_tokens} tokens")
+    print(f"generate:    {baseline:.2f}s ({1000 * baseline / num_tokens:.3f} ms/token)")
+    print(f"lean engine: {lean:.2f}s ({1000 * lean / num_tokens:.3f} ms/token, {baseline / lean:.2f}x)")
+    print(f"Per-token overhead saved: {1000 * (baseline - lean) / num_tokens:.3f} ms")
+    print(f"Identical completions: {same}/{len(baseline_results)}")
+
+def bench_cpu_optimized(args):
+    tokenizer = build_tiny_tokenizer()
+    reference_model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    num_threads = configure_cpu_threads(args.num_threads)
+    model, precision = optimize_for_cpu(copy.deepcopy(reference_model), args.precision)
+    prompt = get_prompt(args.prompt)
+
+    def throughput(model):
+        meter = ThroughputMeter()
+        generate = meter.measure(run_batched_inference)
+        with torch.no_grad():
+            for _ in range(args.num_batches):
+                generate(model, tokenizer, prompt, 'cpu', num_return_sequences=args.batch_size,
+                         max_new_tokens=args.max_tokens, stream_metrics=True)
+        return meter.tokens_per_second()
+
+    baseline = throughput(reference_model)
+    optimized = throughput(model)
+    drift = entropy_drift(reference_model, model, tokenizer, prompt, args.max_tokens, seed=0)
+    print(f"{num_threads} intra-op threads")
+    print(f"fp32: {baseline:.1f} tokens/s")
+    print(f"{precision}: {optimized:.1f} tokens/s ({optimized / baseline:.2f}x)")
+    print(f"Entropy drift over {drift['num_tokens']} tokens: mean |diff| {drift['mean_abs_diff']:.4f}, "
+          f"max |diff| {drift['max_abs_diff']:.4f} nats (tolerance {ENTROPY_TOLERANCE})")
+
+def bench_async_batching(args):
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    # One call per (prompt, seed), as independent callers would make them
+    calls = [(get_prompt(args.prompts[i % len(args.prompts)]), i) for i in range(args.num_calls)]
+
+    def sequential():
+        return [run_inference(model, tokenizer, prompt, 'cpu', max_new_tokens=args.max_tokens, stream_metrics=True,
+                              seed=seed) for prompt, seed in calls]
+
+    async def concurrent():
+        batcher = AsyncBatcher(model, tokenizer, 'cpu', max_batch_size=args.max_batch_size,
+                               batch_window=args.batch_window_ms / 1000)
+        results = await asyncio.gather(*(batcher.generate_async(prompt, {"max_new_tokens": args.max_tokens, "seed": seed})
+                                         for prompt, seed in calls))
+        batcher.report()
+        await batcher.close()
+        return results
+
+    with torch.no_grad():
+        sequential_results, sequential_time = timed(sequential)
+        batched_results, batched_time = timed(lambda: asyncio.run(concurrent()))
+    same = sum(a["token_ids"] == b["token_ids"] for a, b in zip(sequential_results, batched_results))
+    print(f"{len(calls)} calls")
+    print(f"run_inference one at a time: {sequential_time:.2f}s")
+    print(f"generate_async:              {batched_time:.2f}s ({sequential_time / batched_time:.2f}x)")
+    print(f"Identical completions: {same}/{len(calls)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark generation helpers on a tiny local OLMo model")
+    parser.add_argument("--hidden_size", type=int, default=128, help="Hidden size of the tiny model")
+    parser.add_argument("--num_layers", type=int, default=2, help="Number of layers of the tiny model")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    prefix = subparsers.add_parser("prefix_cache", help="Prompt prefill reuse vs. re-prefilling every call")
+    prefix.add_argument("--prompt", type=str, default="NLP_research", help="Prompt key from the prompt store")
+    prefix.add_argument("--prompt_repeats", type=int, default=8, help="Times the prompt is repeated")
+    prefix.add_argument("--num_completions", type=int, default=32, help="Number of completions to generate")
+    prefix.add_argument("--batch_size", type=int, default=1, help="Completions per generate call")
+    prefix.add_argument("--max_tokens", type=int, default=32, help="Maximum number of tokens to generate")
+    prefix.set_defaults(func=bench_prefix_cache)
+
+    assisted = subparsers.add_parser("assisted", help="Assisted decoding with a truncated draft vs. the target alone")
+    assisted.add_argument("--prompts", type=str, nargs="+", default=["NLP_research", "haiku", "creative_story"],
+                          help="Prompt keys from the prompt store, reported separately")
+    assisted.add_argument("--draft_layers", type=int, default=1, help="Layers of the target kept in the draft")
+    assisted.add_argument("--num_assistant_tokens", type=int, default=None, help="Tokens drafted per round")
+    assisted.add_argument("--num_completions", type=int, default=4, help="Completions per prompt")
+    assisted.add_argument("--max_tokens", type=int, default=64, help="Maximum number of tokens to generate")
+    assisted.set_defaults(func=bench_assisted)
+
+    continuous = subparsers.add_parser("scheduler", help="Continuous batching vs. static generate batches")
+    continuous.add_argument("--prompts", type=str, nargs="+", default=["haiku", "creative_story", "NLP_research"],
+                            help="Prompt keys from the prompt store, used round-robin")
+    continuous.add_argument("--num_completions", type=int, default=64, help="Number of completions to generate")
+    continuous.add_argument("--batch_size", type=int, default=8, help="Batch size / scheduler slots")
+    continuous.add_argument("--min_tokens", type=int, default=16, help="Length of the short completions")
+    continuous.add_argument("--max_tokens", type=int, default=128, help="Length of the long completions")
+    continuous.set_defaults(func=bench_scheduler)
+
+    engine = subparsers.add_parser("engine", help="Lean decode loop vs. model.generate, per-token overhead")
+    engine.add_argument("--prompt", type=str, default="haiku", help="Prompt key from the prompt store")
+    engine.add_argument("--num_batches", type=int, default=4, help="Number of batches to generate")
+    engine.add_argument("--batch_size", type=int, default=8, help="Completions per batch")
+    engine.add_argument("--max_tokens", type=int, default=128, help="Maximum number of tokens to generate")
+    engine.add_argument("--logit_snapshot_k", type=int, default=0, help="Also record top-k logit snapshots")
+    engine.set_defaults(func=bench_engine)
+
+    cpu = subparsers.add_parser("cpu_optimized", help="Reduced-precision CPU inference vs. fp32, with entropy drift")
+    cpu.add_argument("--precision", type=str, default="int8", choices=list(PRECISIONS), help="Precision to compare")
+    cpu.add_argument("--num_threads", type=int, default=0, help="Intra-op threads (0: one per physical core)")
+    cpu.add_argument("--prompt", type=str, default="haiku", help="Prompt key from the prompt store")
+    cpu.add_argument("--num_batches", type=int, default=4, help="Number of batches to generate")
+    cpu.add_argument("--batch_size", type=int, default=4, help="Completions per batch")
+    cpu.add_argument("--max_tokens", type=int, default=64, help="Maximum number of tokens to generate")
+    cpu.set_defaults(func=bench_cpu_optimized)
+
+    batched = subparsers.add_parser("async_batching", help="generate_async micro-batching vs. one run_inference per call")
+    batched.add_argument("--prompts", type=str, nargs="+", default=["haiku", "creative_story"],
+                         help="Prompt keys from the prompt store, cycled over the calls")
+    batched.add_argument("--num_calls", type=int, default=32, help="Number of concurrent calls")
+    batched.add_argument("--max_batch_size", type=int, default=16, help="Maximum calls per batch")
+    batched.add_argument("--batch_window_ms", type=float, default=10.0, help="Coalescing window")
+    batched.add_argument("--max_tokens", type=int, default=32, help="Maximum number of tokens to generate")
+    batched.set_defaults(func=bench_async_batching)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+One-time conversion of hub checkpoints into the local checkpoint cache.
+
+The model is loaded once in the target dtype and written with its tokenizer as
+safetensors shards to <checkpoint_dir>/<model id with / as -->/<dtype>/, next to
+a conversion.json manifest. load_model (model_registry) then maps that copy
+directly on every later start, which skips the hub resolution, the fp32
+materialization and the cast.
+
+Usage:
+    python utils/olmo_inference/convert_checkpoint.py --models olmo-2-7b olmo-2-13b --dtype bf16
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import transformers
+from model_registry import (CHECKPOINT_DIR, CONVERSION_MANIFEST, DTYPES, MODELS, converted_checkpoint_path,
+                            find_converted_checkpoint, load_model, resolve_model_name, unload_model)
+
+# Shards small enough to be written and mapped one at a time
+MAX_SHARD_SIZE = "5GB"
+
+def convert_checkpoint(model, dtype="bf16", checkpoint_dir=CHECKPOINT_DIR, overwrite=False):
+    """
+    Write a model in dtype to the local checkpoint cache.
+
+    Args:
+        model (str): Registry key (see MODELS) or a model id / local path
+        dtype (str): Weight dtype, one of DTYPES
+        checkpoint_dir (str): Root of the checkpoint cache
+        overwrite (bool): Convert again even if a conversion exists
+
+    Returns:
+        str: Directory of the converted checkpoint
+    """
+    model_name = resolve_model_name(model)
+    path = converted_checkpoint_path(model_name, dtype, checkpoint_dir)
+    if not overwrite and find_converted_checkpoint(model_name, dtype, checkpoint_dir):
+        print(f"{model_name} ({dtype}) is already converted in {path}")
+        return path
+
+    start = time.time()
+    # Always from the original checkpoint, on CPU so any model fits
+    lm, tokenizer = load_model(model_name, device="cpu", dtype=dtype, checkpoint_dir=None)
+    # Written to a temporary directory first, so an interrupted conversion is never
+    # mistaken for a complete one
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    lm.save_pretrained(tmp_path, max_shard_size=MAX_SHARD_SIZE)
+    tokenizer.save_pretrained(tmp_path)
+    manifest = {
+        "model": model_name,
+        "revision": getattr(lm.config, "_commit_hash", None),
+        "dtype": dtype,
+        "transformers_version": transformers.__version__,
+        "converted_at": time.time()
+    }
+    with open(os.path.join(tmp_path, CONVERSION_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    unload_model(model_name, device="cpu", dtype=dtype)
+
+    size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    print(f"Converted {model_name} ({dtype}) to {path}: {size / 1024 ** 3:.1f} GiB in {time.time() - start:.0f}s")
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert models into the local checkpoint cache")
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS),
+                        help=f"Models to convert: keys of {list(MODELS)} or model ids / paths")
+    parser.add_argument("--dtype", type=str, default="bf16", choices=list(DTYPES),
+                        help="Dtype the checkpoints are written in (load them with the same --dtype)")
+    parser.add_argument("--checkpoint_dir", type=str, default=CHECKPOINT_DIR,
+                        help="Root of the checkpoint cache (default: $OLMO_CHECKPOINT_DIR or ~/.cache/olmo_inference/checkpoints)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Convert again even if a conversion exists")
+    args = parser.parse_args()
+
+    failed = []
+    for model in args.models:
+        try:
+            convert_checkpoint(model, args.dtype, args.checkpoint_dir, args.overwrite)
+        except Exception as e:
+            print(f"Error converting {model}: {e}")
+            failed.append(model)
+    if failed:
+        sys.exit(f"Failed to convert: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+CPU-optimized inference: reduced-precision linear layers and thread tuning.
+
+With --cpu_optimized the model loaded for a CPU run is converted before
+generation:
+
+    int8  dynamic int8 quantization of every nn.Linear (weights stored as int8,
+          activations quantized on the fly), the default
+    bf16  bfloat16 weights, only on CPUs with native bf16 (avx512_bf16 / AMX);
+          elsewhere int8 is used instead
+    auto  bf16 where supported, int8 otherwise
+
+and torch uses one intra-op thread per physical core of the process's CPU set
+and a single inter-op thread (decoding is a sequential chain of small ops, so
+extra threads only oversubscribe the cores, as do hyperthreads).
+
+Reduced precision shifts the next-token distributions slightly. entropy_drift
+measures how much: it samples a completion with the fp32 model on a fixed seed,
+teacher-forces it through both models and compares the per-token entropies
+(after the same top-k/top-p filtering the records use). Run it as a script to
+check a model against ENTROPY_TOLERANCE before a sweep:
+
+    python utils/olmo_inference/cpu_inference.py --model olmo-1b --cpu_precision int8
+"""
+import os
+import sys
+import copy
+import argparse
+import torch
+
+# Add the parent directory to sys.path to import prompt_store
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prompt_store import get_prompt
+from sampling import top_k_top_p_filter
+from token_metrics import step_metrics
+
+PRECISIONS = ("auto", "int8", "bf16")
+
+# Largest accepted mean absolute difference, in nats, between the per-token
+# entropies of the optimized and the fp32 model on the same tokens
+ENTROPY_TOLERANCE = 0.05
+
+def cpu_supports_bf16():
+    """Whether the CPU has native bf16 arithmetic (avx512_bf16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split(":", 1)[1].split() for line in f if line.startswith("flags")), [])
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def physical_cores(cores):
+    """Number of physical cores among a set of logical CPU ids (hyperthreads counted once)."""
+    physical = set()
+    for core in cores:
+        topology = f"/sys/devices/system/cpu/cpu{core}/topology"
+        try:
+            with open(f"{topology}/physical_package_id") as f:
+                package = f.read().strip()
+            with open(f"{topology}/core_id") as f:
+                physical.add((package, f.read().strip()))
+        except OSError:
+            return len(cores)
+    return len(physical) or len(cores)
+
+def configure_cpu_threads(num_threads=0):
+    """
+    Set torch's intra-op and inter-op thread counts for CPU decoding.
+
+    Args:
+        num_threads (int): Intra-op threads, 0 for one per physical core the process
+            may run on (its affinity set, which parallel workers restrict)
+
+    Returns:
+        int: The intra-op thread count
+    """
+    if not num_threads:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+        num_threads = physical_cores(cores)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only possible before the first inter-op parallel work of the process
+        pass
+    return num_threads
+
+def optimize_for_cpu(model, precision="int8"):
+    """
+    Convert a model for CPU inference, in place.
+
+    Args:
+        model: Causal LM on the CPU
+        precision (str): One of PRECISIONS
+
+    Returns:
+        tuple: (model, precision actually applied)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+    if precision == "auto":
+        precision = "bf16" if cpu_supports_bf16() else "int8"
+    elif precision == "bf16" and not cpu_supports_bf16():
+        print("This CPU has no native bf16, using int8 dynamic quantization instead")
+        precision = "int8"
+    if precision == "bf16":
+        return model.to(torch.bfloat16), precision
+    # Dynamic quantization takes fp32 weights
+    model = torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model, precision
+
+def model_precision(model):
+    """
+    Precision a model computes its linear layers in: "int8" once optimize_for_cpu
+    has quantized them (the remaining parameters, and so model.dtype, stay fp32),
+    its parameter dtype otherwise.
+    """
+    quantized = torch.ao.nn.quantized.dynamic.Linear
+    if any(isinstance(module, quantized) for module in model.modules()):
+        return "int8"
+    return str(model.dtype)
+
+def add_cpu_arguments(parser):
+    """Add the --cpu_optimized options to an argument parser."""
+    parser.add_argument("--cpu_optimized", action="store_true",
+                        help="On CPU: reduced-precision linear layers and one thread per physical core")
+    parser.add_argument("--cpu_precision", type=str, default="int8", choices=list(PRECISIONS),
+                        help="Precision of --cpu_optimized (bf16 only on CPUs with native bf16)")
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help="Intra-op threads of --cpu_optimized (default: one per physical core)")
+    return parser
+
+def apply_cpu_options(args, model, device):
+    """
+    Apply --cpu_optimized to a loaded model.
+
+    The conversion is in place, so the model is dropped from model_registry's
+    process cache and a later load_model returns a fresh fp32 copy.
+
+    Returns:
+        The model to generate with
+    """
+    if not getattr(args, "cpu_optimized", False):
+        return model
+    if torch.device(device).type != "cpu":
+        print(f"--cpu_optimized only applies on CPU, not on {device}")
+        return model
+    from model_registry import unload_model
+    unload_model(args.model, device=device, dtype=args.dtype)
+    num_threads = configure_cpu_threads(args.num_threads)
+    model, precision = optimize_for_cpu(model, args.cpu_precision)
+    print(f"CPU-optimized inference: {precision} linear layers, {num_threads} intra-op threads")
+    return model
+
+def _teacher_forced_entropies(model, sequence, prompt_length, top_k, top_p):
+    """Per-token entropy of the generated part of sequence (shape [1, length]) under model."""
+    with torch.no_grad():
+        logits = model(input_ids=sequence).logits[0, prompt_length - 1:-1].float()
+    scores = top_k_top_p_filter(logits, top_k, top_p)
+    entropy, _ = step_metrics(scores, sequence[0, prompt_length:])
+    return entropy
+
+def entropy_drift(reference_model, model, tokenizer, prompt, max_new_tokens=64, seed=0, top_k=50, top_p=0.95):
+    """
+    Per-token entropy difference between a reduced-precision model and its fp32 reference.
+
+    Args:
+        reference_model: The fp32 model
+        model: The optimized model
+        prompt (str): Prompt of the completion compared
+        seed (int): Sampling seed of the reference completion
+
+    Returns:
+        dict: mean_abs_diff and max_abs_diff (nats), the mean entropies of both
+            models and the number of tokens compared
+    """
+    from many_normal_prompt import run_batched_inference
+    result = run_batched_inference(reference_model, tokenizer, prompt, "cpu", max_new_tokens=max_new_tokens,
+                                   top_k=top_k, top_p=top_p, stream_metrics=True, seeds=[seed])[0]
+    prompt_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+    sequence = torch.cat([prompt_ids, torch.tensor([result["token_ids"]], dtype=torch.long)], dim=1)
+    prompt_length = prompt_ids.shape[1]
+    reference = _teacher_forced_entropies(reference_model, sequence, prompt_length, top_k, top_p)
+    optimized = _teacher_forced_entropies(model, sequence, prompt_length, top_k, top_p)
+    diff = (optimized - reference).abs()
+    return {
+        "num_tokens": len(result["token_ids"]),
+        "mean_abs_diff": diff.mean().item() if len(diff) else 0.0,
+        "max_abs_diff": diff.max().item() if len(diff) else 0.0,
+        "reference_entropy": reference.mean().item() if len(diff) else 0.0,
+        "optimized_entropy": optimized.mean().item() if len(diff) else 0.0
+    }
+
+def main():
+    from model_registry import add_model_arguments, load_model_from_args
+    parser = argparse.ArgumentParser(description="Check the entropy drift of --cpu_optimized against fp32")
+    parser.add_argument("--prompts", type=str, nargs="+", default=["haiku", "creative_story", "NLP_research"],
+                        help="Prompt keys from the prompt store")
+    parser.add_argument("--max_tokens", type=int, default=64, help="Tokens compared per prompt")
+    parser.add_argument("--seed", type=int, default=0, help="Sampling seed of the reference completions")
+    parser.add_argument("--tolerance", type=float, default=ENTROPY_TOLERANCE,
+                        help="Largest accepted mean absolute per-token entropy difference (nats)")
+    add_model_arguments(parser)
+    add_cpu_arguments(parser)
+    args = parser.parse_args()
+    if args.dtype != "fp32":
+        parser.error("the reference model must be loaded in fp32")
+
+    reference_model, tokenizer = load_model_from_args(args, "cpu")
+    # The reference stays in fp32 while a copy is converted
+    model = copy.deepcopy(reference_model)
+    num_threads = configure_cpu_threads(args.num_threads)
+    model, precision = optimize_for_cpu(model, args.cpu_precision)
+    print(f"{precision} against fp32, {num_threads} threads, tolerance {args.tolerance} nats")
+
+    failed = []
+    for prompt_key in args.prompts:
+        drift = entropy_drift(reference_model, model, tokenizer, get_prompt(prompt_key), args.max_tokens, args.seed)
+        ok = drift["mean_abs_diff"] <= args.tolerance
+        print(f"{prompt_key}: {drift['num_tokens']} tokens, entropy {drift['reference_entropy']:.4f} -> "
+              f"{drift['optimized_entropy']:.4f}, mean |diff| {drift['mean_abs_diff']:.4f}, "
+              f"max |diff| {drift['max_abs_diff']:.4f} {'ok' if ok else 'OVER TOLERANCE'}")
+        if not ok:
+            failed.append(prompt_key)
+    if failed:
+        sys.exit(f"Entropy drift over tolerance for: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Lean decode loop, an alternative to model.generate for our sampling setup.
+
+generate runs its logits processor and stopping criteria machinery every step,
+keeps every step's full-vocabulary scores for output_scores, and re-sorts the
+whole vocabulary for top-p. For plain top-k/top-p sampling this loop only calls
+the model with its KV cache, samples with sampling.sample_with_metrics (which
+works on the top-k candidates and yields the entropy and chosen-token log-prob
+of the same pass) and writes tokens and metrics into buffers preallocated for
+max_new_tokens. Everything stays on the device until one transfer at the end;
+the loop only synchronizes every sync_every steps to check whether all rows are
+done (or every step when a stop check has to look at the text).
+
+run_batched_inference(..., engine="lean") returns the same results as with
+generate.
+"""
+import inspect
+import torch
+from transformers import DynamicCache
+from logit_snapshots import snapshot_rows, snapshot_step
+from sampling import sample_with_metrics
+
+def logits_to_keep_argument(model):
+    """Name of the forward argument limiting the logits to the last positions, if any."""
+    parameters = inspect.signature(model.forward).parameters
+    return next((name for name in ("logits_to_keep", "num_logits_to_keep") if name in parameters), None)
+
+def lean_generate(model, input_ids, attention_mask, max_new_tokens, pad_token_id, eos_ids, top_k=50, top_p=0.95,
+                  generators=None, past_key_values=None, stopper=None, logit_snapshot_k=0, sync_every=8):
+    """
+    Sample completions for a left-padded batch of prompts.
+
+    Args:
+        input_ids (torch.Tensor): Prompt ids of shape [batch, prompt_length]
+        attention_mask (torch.Tensor): Its attention mask
+        max_new_tokens (int): Maximum number of tokens to generate
+        pad_token_id (int): Written after a row is done
+        eos_ids (set): Ids that end a sequence
+        top_k (int): Top-k filtering, as in generate
+        top_p (float): Nucleus filtering, as in generate
+        generators (list): Optional per-row torch.Generator for seeded sampling
+        past_key_values: Prefill cache of the first input_ids columns (e.g. from a
+            PromptCache), extended in place
+        stopper (PromptStopCriteria): Stop criteria checked on the generated tokens
+            (built with prompt_length 0)
+        logit_snapshot_k (int): Also snapshot the top logit_snapshot_k tokens of every step
+        sync_every (int): Steps between checks whether every row is done
+
+    Returns:
+        dict: "tokens" (generated ids of shape [batch, steps], padded after a row is
+            done), "metrics" (in the compute_token_metrics format) and "snapshots"
+            (snapshot rows of shape [batch, steps], or None)
+    """
+    batch_size = input_ids.shape[0]
+    device = input_ids.device
+    tokens = torch.full((batch_size, max_new_tokens), pad_token_id, dtype=torch.long, device=device)
+    metrics = torch.zeros((3, batch_size, max_new_tokens), dtype=torch.float32, device=device)
+    snapshots = None
+    if logit_snapshot_k:
+        snapshots = {
+            "topk_ids": torch.zeros((batch_size, max_new_tokens, logit_snapshot_k), dtype=torch.long, device=device),
+            "topk_logprobs": torch.zeros((batch_size, max_new_tokens, logit_snapshot_k), device=device),
+            "chosen_logprob": torch.zeros((batch_size, max_new_tokens), device=device),
+            "logsumexp": torch.zeros((batch_size, max_new_tokens), device=device)
+        }
+    eos = torch.tensor(sorted(eos_ids), dtype=torch.long, device=device)
+    done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    past_length = cache.get_seq_length() if past_key_values is not None else 0
+    position_ids = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+    step_ids = input_ids[:, past_length:]
+    step_positions = position_ids[:, past_length:]
+    forward_kwargs = {}
+    logits_to_keep = logits_to_keep_argument(model)
+    if logits_to_keep:
+        forward_kwargs[logits_to_keep] = 1
+
+    steps = 0
+    with torch.no_grad():
+        for step in range(max_new_tokens):
+            output = model(
+                input_ids=step_ids,
+                attention_mask=attention_mask,
+                position_ids=step_positions,
+                past_key_values=cache,
+                use_cache=True,
+                **forward_kwargs
+            )
+            cache = output.past_key_values
+            logits = output.logits[:, -1]
+            next_tokens, entropy, log_prob = sample_with_metrics(logits, top_k, top_p, generators)
+            next_tokens = next_tokens.masked_fill(done, pad_token_id)
+            tokens[:, step] = next_tokens
+            metrics[0, :, step] = entropy
+            metrics[1, :, step] = log_prob
+            if snapshots is not None:
+                topk_ids, topk_logprobs, chosen_logprob, logsumexp = snapshot_step(logits, next_tokens, logit_snapshot_k)
+                snapshots["topk_ids"][:, step] = topk_ids
+                snapshots["topk_logprobs"][:, step] = topk_logprobs
+                snapshots["chosen_logprob"][:, step] = chosen_logprob
+                snapshots["logsumexp"][:, step] = logsumexp
+            done |= torch.isin(next_tokens, eos)
+            steps = step + 1
+
+            if stopper is not None:
+                done |= stopper(tokens[:, :steps], None).to(device)
+                if bool(done.all()):
+                    break
+            elif steps % sync_every == 0 and bool(done.all()):
+                break
+
+            step_ids = next_tokens.unsqueeze(1)
+            step_positions = step_positions[:, -1:] + 1
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=1)
+
+    # Steps a row took after it was done only hold padding; the metrics rows are
+    # cut at each row's length by the caller
+    tokens = tokens[:, :steps]
+    metrics[2] = metrics[0].exp()
+    host = metrics[:, :, :steps].cpu().tolist()
+    result = {
+        "tokens": tokens,
+        "metrics": {"entropy": host[0], "perplexity": host[2], "logprob": host[1]},
+        "snapshots": None
+    }
+    if snapshots is not None:
+        result["snapshots"] = snapshot_rows(
+            logit_snapshot_k,
+            tokens,
+            snapshots["topk_ids"][:, :steps],
+            snapshots["topk_logprobs"][:, :steps],
+            snapshots["chosen_logprob"][:, :steps],
+            snapshots["logsumexp"][:, :steps]
+        )
+    return result
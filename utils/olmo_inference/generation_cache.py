@@ -0,0 +1,249 @@
+"""
+Content-addressed on-disk cache of generation results.
+
+A completion is fully determined by the model weights, the tokenizer, the exact
+prompt text, the decoding parameters, its sampling seed and the engine that
+sampled it. The cache key is a hash of all of these, and the stored value is the
+completion's result dict (the run_batched_inference format), so a rerun with the
+same run seed writes the same records without touching the model.
+
+Completions sampled from the global RNG (no run seed) are never cached: they
+are not reproducible, and every completion_idx must stay a different sample.
+
+Entries are single files under <cache_dir>/<key[:2]>/; a logit snapshot is kept
+next to its entry as .npy. Hits refresh the entry's mtime, and once the cache
+grows past max_bytes the least recently used entries are evicted. Writes go
+through a temporary file and os.replace, so workers of a parallel run can share
+one cache directory.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+def model_fingerprint(model, tokenizer):
+    """Identity of the weights and tokenizer a completion was generated with."""
+    # Imported here: the cache itself works on result dicts and needs no torch
+    from cpu_inference import model_precision
+    config = model.config
+    return {
+        "model": config.name_or_path,
+        "revision": getattr(config, "_commit_hash", None),
+        "dtype": str(model.dtype),
+        # int8-quantized linear layers leave model.dtype at fp32
+        "precision": model_precision(model),
+        "tokenizer": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer)
+    }
+
+def completion_params(seed, max_new_tokens, top_k=50, top_p=0.95, stop_criteria=None, logit_snapshot_k=0,
+                      engine="generate"):
+    """Decoding parameters of one completion, as hashed into its cache key."""
+    return {
+        "seed": seed,
+        "max_new_tokens": max_new_tokens,
+        "top_k": top_k,
+        "top_p": top_p,
+        "stop_criteria": stop_criteria or {},
+        "logit_snapshot_k": logit_snapshot_k,
+        # generate and the scheduler draw the same tokens from the same seed only
+        # up to float differences between their batch layouts
+        "engine": engine
+    }
+
+class GenerationCache:
+    """
+    Size-bounded LRU store of generation results keyed by content hash.
+
+    Args:
+        cache_dir (str): Directory of the cache, created if missing
+        max_bytes (int): Evict least recently used entries beyond this total size
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, fingerprint, prompt, params):
+        """
+        Cache key of one completion.
+
+        Args:
+            fingerprint (dict): model_fingerprint of the model and tokenizer
+            prompt (str): Full prompt text
+            params (dict): Everything else the completion depends on, see completion_params
+
+        Returns:
+            str: Hex digest
+        """
+        content = json.dumps({"fingerprint": fingerprint, "prompt": prompt, "params": params}, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _snapshot_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def _entries(self):
+        """(key, mtime, size in bytes) of every entry, snapshots included."""
+        entries = {}
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                key, ext = os.path.splitext(entry.name)
+                if ext not in (".json", ".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                mtime, size = entries.get(key, (0.0, 0))
+                entries[key] = (max(mtime, stat.st_mtime) if ext == ".json" else mtime, size + stat.st_size)
+        return [(key, mtime, size) for key, (mtime, size) in entries.items()]
+
+    def get(self, key):
+        """Return the stored result for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            if result.pop("has_logit_snapshot", False):
+                result["logit_snapshot"] = np.load(self._snapshot_path(key))
+            os.utime(path)
+        except (OSError, json.JSONDecodeError, ValueError):
+            # Missing, evicted by another process or partially written
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Store a result dict (JSON-serializable apart from an optional logit_snapshot array)."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        result = dict(result)
+        # Overwriting an entry replaces its files, and their size with them
+        for old_path in (path, self._snapshot_path(key)):
+            try:
+                self.total_bytes -= os.path.getsize(old_path)
+            except OSError:
+                pass
+        size = 0
+        snapshot = result.pop("logit_snapshot", None)
+        if snapshot is None:
+            try:
+                os.remove(self._snapshot_path(key))
+            except OSError:
+                pass
+        if snapshot is not None:
+            tmp_path = self._snapshot_path(key) + f".{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, snapshot)
+            size += os.path.getsize(tmp_path)
+            os.replace(tmp_path, self._snapshot_path(key))
+            result["has_logit_snapshot"] = True
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        size += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self.stores += 1
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is below 90% of max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.total_bytes = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            for path in (self._path(key), self._snapshot_path(key)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def lookup(self, keys, generate):
+        """
+        Results for a list of completions, generating only the cache misses.
+
+        Args:
+            keys (list): Cache key of every completion, None for completions that
+                must not be cached
+            generate (callable): Called with the positions (in keys) of the misses,
+                returns their results in that order
+
+        Returns:
+            list: One result per key
+        """
+        results = [self.get(key) if key is not None else None for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, generate(missing)):
+                results[i] = result
+                if keys[i] is not None:
+                    self.put(keys[i], result)
+        return results
+
+    def run_scheduler(self, scheduler, requests, key_fn):
+        """
+        ContinuousBatchScheduler.run that serves cache hits without admitting them.
+
+        Args:
+            requests (iterable): GenerationRequests, consumed lazily
+            key_fn (callable): Maps a request to its cache key, None to not cache it
+
+        Yields:
+            tuple: (request, result), hits as soon as they are looked up and the
+                misses as the scheduler finishes them
+        """
+        hits = []
+        keys = {}
+
+        def misses():
+            for request in requests:
+                key = key_fn(request)
+                result = self.get(key) if key is not None else None
+                if result is not None:
+                    hits.append((request, result))
+                    continue
+                keys[request.key] = key
+                yield request
+
+        for request, result in scheduler.run(misses()):
+            while hits:
+                yield hits.pop(0)
+            key = keys.pop(request.key)
+            if key is not None:
+                self.put(key, result)
+            yield request, result
+        yield from hits
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "total_bytes": self.total_bytes
+        }
+
+    def report(self, label=""):
+        stats = self.stats()
+        print(f"Generation cache{' ' + label if label else ''}: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate), {stats['stores']} stored, {stats['evictions']} evicted, "
+              f"{stats['total_bytes'] / 1024 ** 2:.1f} MB in {self.cache_dir}")
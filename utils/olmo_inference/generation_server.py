@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Long-lived local generation server, so the scripts stop reloading the model.
+
+The server keeps models from the registry loaded (preloaded with --models, or on
+the first request for them) and serves run_batched_inference over HTTP on the
+loopback interface (standard library only):
+
+    POST /load      {"model", "dtype"}  -> {"fingerprint": model_fingerprint}
+    POST /generate  {"model", "dtype", "prompts", "prompt_token_ids",
+                     "num_return_sequences", "seeds", "max_new_tokens", "top_k",
+                     "top_p", "stop_criteria", "logit_snapshot_k", "engine"}
+                    -> {"results": [run_batched_inference result dicts]}
+    GET  /health    -> loaded models and batching statistics
+
+Every model has one worker thread that owns it. Requests are split into single
+completions, and completions of concurrent requests with the same decoding
+parameters are gathered for up to --batch_window_ms, bucketed by prompt length
+and generated together, up to --max_batch_size per batch. A seeded completion
+keeps its own generator, so whatever it is batched with only matters through
+the float differences between batch shapes (see seeding.py), which can flip a
+token sitting right at the sampled value.
+
+The generation scripts take --server URL to run as thin clients: they load only
+the tokenizer and send their batches here.
+
+Usage:
+    python utils/olmo_inference/generation_server.py --models olmo-2-7b --dtype bf16
+    python utils/olmo_inference/many_normal_prompt.py --prompt haiku --server http://127.0.0.1:8765 --dtype bf16
+"""
+import sys
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from batching import bucket_by_length
+from generation_cache import model_fingerprint
+from logit_snapshots import snapshot_dtype
+from model_registry import CHECKPOINT_DIR, DTYPES, default_device, load_model, load_tokenizer, resolve_model_name
+from prefix_cache import PromptCache
+
+DEFAULT_PORT = 8765
+DEFAULT_URL = f"http://127.0.0.1:{DEFAULT_PORT}"
+
+# Parameters a completion is generated with; only completions that agree on all
+# of them (and on being seeded or not) share a batch
+BATCH_PARAMS = ("max_new_tokens", "top_k", "top_p", "stop_criteria", "logit_snapshot_k", "engine")
+
+def encode_result(result):
+    """JSON-serializable copy of a run_batched_inference result (logit snapshots as base64)."""
+    result = dict(result)
+    snapshot = result.pop("logit_snapshot", None)
+    if snapshot is not None:
+        result["logit_snapshot"] = {
+            "top_k": snapshot.dtype["topk_ids"].shape[0],
+            "data": base64.b64encode(np.ascontiguousarray(snapshot).tobytes()).decode("ascii")
+        }
+    return result
+
+def decode_result(result):
+    """Inverse of encode_result."""
+    snapshot = result.get("logit_snapshot")
+    if snapshot is not None:
+        result["logit_snapshot"] = np.frombuffer(base64.b64decode(snapshot["data"]),
+                                                 dtype=snapshot_dtype(snapshot["top_k"])).copy()
+    return result
+
+class _Request:
+    """A /generate request in flight: its completions and their results."""
+    def __init__(self, units, params):
+        self.units = units
+        self.params = params
+        self.key = json.dumps(dict(params, seeded=units[0]["seed"] is not None), sort_keys=True)
+        self.results = [None] * len(units)
+        self.remaining = len(units)
+        self.error = None
+        self.done = threading.Event()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+class ModelWorker(threading.Thread):
+    """
+    Thread owning one loaded model and generating the batched requests for it.
+
+    Args:
+        model, tokenizer: The loaded model and its tokenizer
+        device (str): Device of the model
+        max_batch_size (int): Maximum number of completions generated together
+        batch_window (float): Seconds to wait for more requests after the first one
+        prompt_cache (PromptCache): Reuse prefills when a batch completes a single prompt
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=16, batch_window=0.02, prompt_cache=None):
+        super().__init__(daemon=True, name=f"model-worker-{model.config.name_or_path}")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.prompt_cache = prompt_cache
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.completions = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def submit(self, units, params):
+        """Queue completions and block until they are generated; returns their results in order."""
+        request = _Request(units, params)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while sum(len(request.units) for request in pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            groups = {}
+            for request in pending:
+                groups.setdefault(request.key, []).append(request)
+            for requests in groups.values():
+                self._generate_group(requests)
+
+    def _generate_group(self, requests):
+        self.requests += len(requests)
+        units = [(request, i) for request in requests for i in range(len(request.units))]
+        lengths = [len(request.units[i]["prompt_token_ids"]) for request, i in units]
+        for bucket in bucket_by_length(lengths, self.max_batch_size):
+            batch = [units[j] for j in bucket]
+            try:
+                results = self._generate_batch([request.units[i] for request, i in batch], requests[0].params)
+            except Exception as e:
+                for request in {id(request): request for request, _ in batch}.values():
+                    request.fail(e)
+                continue
+            for (request, i), result in zip(batch, results):
+                request.results[i] = result
+                request.remaining -= 1
+                if request.remaining == 0 and request.error is None:
+                    request.done.set()
+
+    def _generate_batch(self, units, params):
+        # Imported here: many_normal_prompt imports this module for its --server client
+        from many_normal_prompt import run_batched_inference
+        start = time.perf_counter()
+        seeds = [unit["seed"] for unit in units] if units[0]["seed"] is not None else None
+        kwargs = dict(params, stream_metrics=True, seeds=seeds)
+        prompts = [unit["prompt"] for unit in units]
+        if (self.prompt_cache is not None and len(set(prompts)) == 1
+                and not any(unit["client_token_ids"] for unit in units)):
+            # Every completion of the same prompt: one prefill for all of them
+            results = run_batched_inference(self.model, self.tokenizer, prompts[0], self.device,
+                                            num_return_sequences=len(units), prompt_cache=self.prompt_cache,
+                                            **kwargs)
+        else:
+            results = run_batched_inference(self.model, self.tokenizer, prompts, self.device,
+                                            prompt_token_ids=[unit["prompt_token_ids"] for unit in units], **kwargs)
+        self.seconds += time.perf_counter() - start
+        self.batches += 1
+        self.completions += len(units)
+        return results
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "completions": self.completions,
+            "batches": self.batches,
+            "avg_batch_size": self.completions / self.batches if self.batches else 0.0,
+            "seconds": self.seconds,
+            "queued": self.queue.qsize()
+        }
+
+class GenerationServer(ThreadingHTTPServer):
+    """
+    HTTP server holding one ModelWorker per loaded (model, dtype).
+
+    Args:
+        address (tuple): (host, port) to listen on
+        device (str): Device the models are loaded on
+        load_options (dict): Extra keyword arguments for load_model
+        worker_options (dict): Keyword arguments for every ModelWorker (prompt_cache
+            True to give each worker its own PromptCache)
+    """
+    daemon_threads = True
+
+    def __init__(self, address, device, load_options=None, worker_options=None):
+        super().__init__(address, _Handler)
+        self.device = device
+        self.load_options = load_options or {}
+        self.worker_options = worker_options or {}
+        self.workers = {}
+        self._lock = threading.Lock()
+
+    def worker(self, model, dtype):
+        """The worker of a model, loading the model on first use."""
+        key = (resolve_model_name(model), dtype)
+        with self._lock:
+            if key not in self.workers:
+                lm, tokenizer = load_model(model, device=self.device, dtype=dtype, **self.load_options)
+                options = dict(self.worker_options)
+                if options.pop("prompt_cache", False):
+                    options["prompt_cache"] = PromptCache()
+                worker = ModelWorker(lm, tokenizer, self.device, **options)
+                worker.start()
+                self.workers[key] = worker
+            return self.workers[key]
+
+    def generate(self, payload):
+        """Serve a /generate payload; returns the encoded results."""
+        prompts = payload["prompts"]
+        if not isinstance(prompts, list) or not prompts or not all(isinstance(prompt, str) for prompt in prompts):
+            raise ValueError("prompts must be a non-empty list of strings")
+        num_return_sequences = payload.get("num_return_sequences", 1)
+        if not isinstance(num_return_sequences, int) or num_return_sequences < 1:
+            raise ValueError(f"num_return_sequences must be a positive integer, got {num_return_sequences!r}")
+        prompt_token_ids = payload.get("prompt_token_ids")
+        if prompt_token_ids is not None and len(prompt_token_ids) != len(prompts):
+            raise ValueError(f"Expected {len(prompts)} prompt_token_ids, got {len(prompt_token_ids)}")
+        seeds = payload.get("seeds")
+        if seeds is not None and len(seeds) != len(prompts) * num_return_sequences:
+            raise ValueError(f"Expected {len(prompts) * num_return_sequences} seeds, got {len(seeds)}")
+        params = {name: payload[name] for name in BATCH_PARAMS if name in payload}
+        worker = self.worker(payload["model"], payload.get("dtype", "fp32"))
+        # Tokenized once here, on the request's thread: the worker buckets and
+        # generates with these ids
+        if prompt_token_ids is None:
+            prompt_token_ids = [worker.tokenizer(prompt, return_token_type_ids=False)["input_ids"] for prompt in prompts]
+            client_token_ids = False
+        else:
+            client_token_ids = True
+        # One unit per completion, in run_batched_inference's output order
+        units = [
+            {"prompt": prompt, "prompt_token_ids": ids, "client_token_ids": client_token_ids,
+             "seed": None if seeds is None else seeds[p * num_return_sequences + r]}
+            for p, (prompt, ids) in enumerate(zip(prompts, prompt_token_ids))
+            for r in range(num_return_sequences)
+        ]
+        return [encode_result(result) for result in worker.submit(units, params)]
+
+    def health(self):
+        return {
+            "models": [
+                {"model": model, "dtype": dtype, **worker.stats()}
+                for (model, dtype), worker in self.workers.items()
+            ]
+        }
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, self.server.health())
+        else:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if self.path == "/generate":
+                self._reply(200, {"results": self.server.generate(payload)})
+            elif self.path == "/load":
+                worker = self.server.worker(payload["model"], payload.get("dtype", "fp32"))
+                self._reply(200, {"fingerprint": model_fingerprint(worker.model, worker.tokenizer)})
+            else:
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+        except (KeyError, ValueError) as e:
+            self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            print(f"Error serving {self.path}: {e}")
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def log_message(self, format, *args):
+        # Requests arrive many times a second during a sweep; only errors are printed
+        pass
+
+class GenerationClient:
+    """
+    Client of a GenerationServer for one model, standing in for the local model.
+
+    Args:
+        url (str): Server URL, e.g. DEFAULT_URL
+        model (str): Registry key or model id the server should generate with
+        dtype (str): Its dtype
+        tokenizer: Local tokenizer of the model (for prompt building and lengths)
+        timeout (float): Seconds to wait for a response, None for no limit
+    """
+    def __init__(self, url, model, dtype, tokenizer, timeout=None):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.dtype = dtype
+        self.tokenizer = tokenizer
+        self.timeout = timeout
+        self._fingerprint = None
+
+    def _post(self, path, payload):
+        request = urllib.request.Request(self.url + path, data=json.dumps(payload).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Generation server error: {json.load(e).get('error', e.reason)}") from None
+
+    def model_fingerprint(self):
+        """model_fingerprint of the server's model (loading it there if needed)."""
+        if self._fingerprint is None:
+            self._fingerprint = self._post("/load", {"model": self.model, "dtype": self.dtype})["fingerprint"]
+        return self._fingerprint
+
+    def run_batched_inference(self, prompt, device=None, num_return_sequences=1, max_new_tokens=100,
+                              do_sample=True, top_k=50, top_p=0.95, stream_metrics=False, prompt_token_ids=None,
+                              seeds=None, stop_criteria=None, logit_snapshot_k=0, engine="generate"):
+        """
+        many_normal_prompt.run_batched_inference on the server (device and
+        stream_metrics are the server's business).
+
+        Returns:
+            list: The same result dicts as run_batched_inference
+        """
+        if not do_sample:
+            raise ValueError("the generation server only samples")
+        payload = {
+            "model": self.model,
+            "dtype": self.dtype,
+            "prompts": [prompt] if isinstance(prompt, str) else list(prompt),
+            "prompt_token_ids": prompt_token_ids,
+            "num_return_sequences": num_return_sequences,
+            "seeds": seeds,
+            "max_new_tokens": max_new_tokens,
+            "top_k": top_k,
+            "top_p": top_p,
+            "stop_criteria": stop_criteria,
+            "logit_snapshot_k": logit_snapshot_k,
+            "engine": engine
+        }
+        return [decode_result(result) for result in self._post("/generate", payload)["results"]]
+
+def add_server_arguments(parser):
+    """Add the --server option to a generation script's argument parser."""
+    parser.add_argument("--server", type=str, default=None,
+                        help=f"Generate on a running generation_server.py (e.g. {DEFAULT_URL}) instead of loading the model")
+    return parser
+
+# Options that need the model in the client process
+_LOCAL_ONLY_OPTIONS = ("assistant_model", "scheduler", "auto_batch_size", "cpu_optimized", "prompt_cache")
+
+def server_conflicts(args):
+    """Options given with --server that need the model in this process (as flags)."""
+    if not getattr(args, "server", None):
+        return []
+    return [f"--{name}" for name in _LOCAL_ONLY_OPTIONS if getattr(args, name, None)]
+
+def connect_from_args(args):
+    """
+    GenerationClient for --server, None without it.
+
+    Only the tokenizer is loaded locally; options that need the model in this
+    process are rejected.
+    """
+    if not getattr(args, "server", None):
+        return None
+    local = server_conflicts(args)
+    if local:
+        sys.exit(f"--server cannot be combined with {', '.join(local)}")
+    tokenizer = load_tokenizer(args.model, args.dtype, args.checkpoint_dir)
+    client = GenerationClient(args.server, args.model, args.dtype, tokenizer)
+    print(f"Generating on {args.server} with {client.model_fingerprint()['model']} ({args.dtype})")
+    return client
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generation from models kept loaded")
+    parser.add_argument("--models", type=str, nargs="*", default=[],
+                        help="Models to load at startup (others are loaded on their first request)")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=list(DTYPES),
+                        help="Dtype of the models loaded at startup")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port on 127.0.0.1")
+    parser.add_argument("--device", type=str, default=None, help="Device of the models (default: CUDA if available)")
+    parser.add_argument("--checkpoint_dir", type=str, default=CHECKPOINT_DIR,
+                        help="Load models converted by convert_checkpoint.py from here if available ('' to disable)")
+    parser.add_argument("--max_batch_size", type=int, default=16,
+                        help="Maximum number of completions generated together")
+    parser.add_argument("--batch_window_ms", type=float, default=20.0,
+                        help="How long to wait for concurrent requests to batch with")
+    parser.add_argument("--prompt_cache", action="store_true",
+                        help="Reuse the prefill of a prompt across the batches completing it")
+    args = parser.parse_args()
+
+    device = args.device or default_device()
+    server = GenerationServer(
+        ("127.0.0.1", args.port),
+        device,
+        load_options={"checkpoint_dir": args.checkpoint_dir},
+        worker_options={"max_batch_size": args.max_batch_size, "batch_window": args.batch_window_ms / 1000,
+                        "prompt_cache": args.prompt_cache}
+    )
+    for model in args.models:
+        server.worker(model, args.dtype)
+    print(f"Generation server listening on http://127.0.0.1:{args.port} ({device})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Buffered JSONL writer that appends records from a background thread.
+
+The generation loops used to open the output file, write one line and close it
+for every completion. Records are now handed to a queue and a background thread
+serializes and appends them in batches, so file I/O never blocks decoding. Every
+writer is flushed on close and at interpreter exit, which SIGTERM is turned into.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import signal
+import weakref
+import threading
+
+FSYNC_POLICIES = ("never", "batch", "close")
+
+# Writers that still have to be flushed if the process is terminated
+_open_writers = weakref.WeakSet()
+_previous_sigterm_handler = None
+_sigterm_installed = False
+
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
+def _handle_sigterm(signum, frame):
+    # Closing the writers here could deadlock: the signal may arrive while the
+    # main thread holds the queue's lock inside write(). SystemExit unwinds the
+    # main thread instead, and the finally blocks of the generation loops and the
+    # atexit hook close (flush and join) the writers
+    if callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(signum, frame)
+    raise SystemExit(128 + signum)
+
+def _install_sigterm_handler():
+    global _previous_sigterm_handler, _sigterm_installed
+    if _sigterm_installed:
+        return
+    try:
+        _previous_sigterm_handler = signal.signal(signal.SIGTERM, _handle_sigterm)
+        _sigterm_installed = True
+    except ValueError:
+        # signal handlers can only be installed from the main thread;
+        # atexit still flushes on a normal exit
+        pass
+
+atexit.register(_close_open_writers)
+
+class _Flush:
+    def __init__(self):
+        self.done = threading.Event()
+
+_CLOSE = object()
+
+class BufferedJsonlWriter:
+    """
+    Append records to a JSONL file from a background thread.
+
+    Args:
+        path (str): Output JSONL file, opened in append mode
+        max_records (int): Write the buffer once it holds this many records
+        flush_interval (float): Write the buffer at least this often (seconds)
+        fsync (str): "never", "batch" (after every buffer write) or "close"
+    """
+    def __init__(self, path, max_records=32, flush_interval=5.0, fsync="never"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        self.path = path
+        self.max_records = max(1, max_records)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.records_written = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._file = open(path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+        self._thread.start()
+        _open_writers.add(self)
+        _install_sigterm_handler()
+
+    def _write_buffer(self, buffer, sync):
+        error = None
+        if buffer:
+            lines = []
+            for record in buffer:
+                try:
+                    lines.append(json.dumps(record) + "\n")
+                except (TypeError, ValueError) as e:
+                    # Dropped, so that later writes (and the flush at exit) still
+                    # write the records buffered with it
+                    error = error or e
+            buffer.clear()
+            self._file.write("".join(lines))
+            self._file.flush()
+            self.records_written += len(lines)
+        if sync:
+            os.fsync(self._file.fileno())
+        if error is not None:
+            raise error
+
+    def _run(self):
+        buffer = []
+        last_write = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_write))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            try:
+                if item is _CLOSE:
+                    self._write_buffer(buffer, sync=self.fsync != "never")
+                    return
+                if isinstance(item, _Flush):
+                    self._write_buffer(buffer, sync=self.fsync == "batch")
+                    last_write = time.monotonic()
+                    item.done.set()
+                    continue
+                if item is not None:
+                    buffer.append(item)
+                if len(buffer) >= self.max_records or time.monotonic() - last_write >= self.flush_interval:
+                    self._write_buffer(buffer, sync=self.fsync == "batch" and bool(buffer))
+                    last_write = time.monotonic()
+            except Exception as e:
+                # Surface the failure in the caller's thread on the next call
+                self._error = e
+                if isinstance(item, _Flush):
+                    item.done.set()
+                if item is _CLOSE:
+                    return
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, record):
+        """Queue one record (a JSON-serializable dict) for writing."""
+        self._raise_error()
+        if self._closed:
+            raise ValueError(f"write to closed writer for {self.path}")
+        self._queue.put(record)
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        if self._closed:
+            return
+        flush = _Flush()
+        self._queue.put(flush)
+        flush.done.wait()
+        self._raise_error()
+
+    def close(self):
+        """Write everything still queued and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._file.close()
+        _open_writers.discard(self)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
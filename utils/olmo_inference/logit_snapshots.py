@@ -0,0 +1,220 @@
+"""
+Top-k logit snapshots of every generated step, for re-analysis without the model.
+
+With snapshots enabled, the raw next-token distribution of every step (before the
+top-k/top-p warpers) is reduced to its top_k token ids and log-probs, the
+log-probs of the sampled token and the log-sum-exp of the logits, and appended to
+a sidecar of the output file in the token_trace format:
+
+    <output>.logits          one snapshot_dtype(top_k) row per generated token
+    <output>.logits.offsets  (completion_idx, offset, length) per completion
+    <output>.logits.json     {"top_k": top_k}
+
+At top_k=20 a row is 130 bytes against the 200 KB of a float16 OLMo logit vector.
+The functions at the bottom recompute token-level metrics from the snapshots:
+bounds on the full entropy, the top-k entropy at any temperature, min-entropy,
+tail mass and the rank of the sampled token.
+"""
+import os
+import json
+import numpy as np
+import torch
+from transformers import LogitsProcessor
+from token_trace import TokenTrace, TokenTraceWriter, has_trace, merge_traces
+
+SNAPSHOT_SUFFIX = ".logits"
+
+def snapshot_dtype(top_k):
+    """Row type of a snapshot: one generated step."""
+    return np.dtype([
+        ("token_id", "<u4"),
+        ("chosen_logprob", "<f2"),
+        ("logsumexp", "<f4"),
+        ("topk_ids", "<u4", (top_k,)),
+        ("topk_logprobs", "<f2", (top_k,))
+    ])
+
+def _meta_path(output_file):
+    return output_file + SNAPSHOT_SUFFIX + ".json"
+
+def snapshot_step(scores, chosen_tokens, top_k):
+    """
+    Snapshot of a block of raw logits.
+
+    Args:
+        scores (torch.Tensor): Raw logits of shape [..., vocab]
+        chosen_tokens (torch.Tensor): Sampled token ids of shape [...]
+        top_k (int): Number of most likely tokens kept
+
+    Returns:
+        tuple: (topk_ids, topk_logprobs, chosen_logprob, logsumexp) tensors, still on device
+    """
+    scores = scores.float()
+    logsumexp = torch.logsumexp(scores, dim=-1)
+    topk_scores, topk_ids = torch.topk(scores, min(top_k, scores.shape[-1]), dim=-1)
+    chosen_scores = scores.gather(-1, chosen_tokens.unsqueeze(-1)).squeeze(-1)
+    return topk_ids, topk_scores - logsumexp.unsqueeze(-1), chosen_scores - logsumexp, logsumexp
+
+def snapshot_rows(top_k, token_ids, topk_ids, topk_logprobs, chosen_logprob, logsumexp):
+    """Pack snapshot tensors of shape [batch, steps(, top_k)] into a [batch, steps] array of snapshot rows."""
+    rows = np.empty(tuple(token_ids.shape), dtype=snapshot_dtype(top_k))
+    rows["token_id"] = token_ids.cpu().numpy()
+    rows["chosen_logprob"] = chosen_logprob.cpu().numpy()
+    rows["logsumexp"] = logsumexp.cpu().numpy()
+    rows["topk_ids"] = topk_ids.cpu().numpy()
+    rows["topk_logprobs"] = topk_logprobs.cpu().numpy()
+    return rows
+
+class LogitSnapshotRecorder(LogitsProcessor):
+    """
+    Logits processor that snapshots the raw distribution of every step.
+
+    It must be the first processor in the list so it sees the logits before any
+    warper. Like StreamingTokenMetrics, only the latest step's full logits are
+    held until the token sampled from them is known.
+
+    Args:
+        top_k (int): Number of most likely tokens kept per step
+    """
+    def __init__(self, top_k):
+        self.top_k = top_k
+        self.topk_ids = []
+        self.topk_logprobs = []
+        self.logsumexps = []
+        self.chosen_logprobs = []
+        self._pending_scores = None
+
+    def _resolve_pending(self, chosen_tokens):
+        topk_ids, topk_logprobs, chosen_logprob, logsumexp = snapshot_step(
+            self._pending_scores, chosen_tokens.to(self._pending_scores.device), self.top_k
+        )
+        self.topk_ids.append(topk_ids)
+        self.topk_logprobs.append(topk_logprobs)
+        self.chosen_logprobs.append(chosen_logprob)
+        self.logsumexps.append(logsumexp)
+        self._pending_scores = None
+
+    def __call__(self, input_ids, scores):
+        # The last input id is the token sampled from the previous step
+        if self._pending_scores is not None:
+            self._resolve_pending(input_ids[:, -1])
+        self._pending_scores = scores
+        return scores
+
+    def finalize(self, new_tokens):
+        """
+        Resolve the last step and return the snapshots.
+
+        Args:
+            new_tokens (torch.Tensor): Generated token ids of shape [batch, steps]
+
+        Returns:
+            np.ndarray: Snapshot rows of shape [batch, steps]
+        """
+        if self._pending_scores is not None:
+            self._resolve_pending(new_tokens[:, len(self.topk_ids)])
+        if not self.topk_ids:
+            return np.empty((new_tokens.shape[0], 0), dtype=snapshot_dtype(self.top_k))
+        steps = len(self.topk_ids)
+        return snapshot_rows(
+            self.top_k,
+            new_tokens[:, :steps],
+            torch.stack(self.topk_ids, dim=1),
+            torch.stack(self.topk_logprobs, dim=1),
+            torch.stack(self.chosen_logprobs, dim=1),
+            torch.stack(self.logsumexps, dim=1)
+        )
+
+def _check_top_k(output_file, top_k):
+    """Record top_k next to the snapshots, or check it matches the one already recorded."""
+    meta_path = _meta_path(output_file)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            existing = json.load(f)["top_k"]
+        if existing != top_k:
+            raise ValueError(f"{output_file} already has top-{existing} logit snapshots, not top-{top_k}")
+        return
+    with open(meta_path, "w") as f:
+        json.dump({"top_k": top_k}, f)
+
+def open_snapshot_writer(output_file, top_k):
+    """TokenTraceWriter appending top_k snapshots to an output file's sidecar."""
+    _check_top_k(output_file, top_k)
+    return TokenTraceWriter(output_file, SNAPSHOT_SUFFIX, snapshot_dtype(top_k))
+
+def snapshot_top_k(output_file):
+    """top_k of an output file's snapshots, None if it has none."""
+    if not os.path.exists(_meta_path(output_file)):
+        return None
+    with open(_meta_path(output_file)) as f:
+        return json.load(f)["top_k"]
+
+def load_snapshots(output_file):
+    """
+    Memory-mapped snapshots of an output file.
+
+    Returns:
+        TokenTrace: Indexed by completion_idx, each item a [steps] array of snapshot rows
+    """
+    top_k = snapshot_top_k(output_file)
+    if top_k is None:
+        raise FileNotFoundError(f"No logit snapshots for {output_file}")
+    return TokenTrace(output_file, SNAPSHOT_SUFFIX, snapshot_dtype(top_k))
+
+def merge_snapshots(output_file, shard_files):
+    """Append the snapshots of shard files to those of output_file and delete them."""
+    shard_files = [shard_file for shard_file in shard_files if has_trace(shard_file, SNAPSHOT_SUFFIX)]
+    if not shard_files:
+        return 0
+    top_k = snapshot_top_k(shard_files[0])
+    _check_top_k(output_file, top_k)
+    merged = merge_traces(output_file, shard_files, SNAPSHOT_SUFFIX, snapshot_dtype(top_k))
+    for shard_file in shard_files:
+        os.remove(_meta_path(shard_file))
+    return merged
+
+# Analysis: every function takes an array of snapshot rows (any shape) and
+# returns one value per row, computed in float64
+
+def _topk_probs(rows):
+    return np.exp(rows["topk_logprobs"].astype(np.float64))
+
+def tail_mass(rows):
+    """Probability mass outside the top-k tokens."""
+    return np.clip(1.0 - _topk_probs(rows).sum(axis=-1), 0.0, 1.0)
+
+def truncated_entropy(rows):
+    """Entropy contribution of the top-k tokens, a lower bound on the full entropy."""
+    probs = _topk_probs(rows)
+    return -(probs * rows["topk_logprobs"].astype(np.float64)).sum(axis=-1)
+
+def entropy_upper_bound(rows, vocab_size):
+    """Full entropy if the tail mass were spread evenly over the remaining vocabulary."""
+    top_k = rows["topk_ids"].shape[-1]
+    tail = tail_mass(rows)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tail_entropy = np.where(tail > 0, -tail * np.log(tail / (vocab_size - top_k)), 0.0)
+    return truncated_entropy(rows) + tail_entropy
+
+def topk_entropy(rows, temperature=1.0):
+    """Entropy of the top-k tokens renormalized, after rescaling the logits by 1 / temperature."""
+    scaled = rows["topk_logprobs"].astype(np.float64) / temperature
+    log_probs = scaled - np.logaddexp.reduce(scaled, axis=-1, keepdims=True)
+    return -(np.exp(log_probs) * log_probs).sum(axis=-1)
+
+def min_entropy(rows):
+    """-log of the largest probability (exact, the most likely token is always in the top-k)."""
+    return -rows["topk_logprobs"][..., 0].astype(np.float64)
+
+def chosen_surprisal(rows):
+    """-log-prob of the sampled token under the raw distribution."""
+    return -rows["chosen_logprob"].astype(np.float64)
+
+def chosen_rank(rows):
+    """0-based rank of the sampled token in the raw distribution, -1 if it is outside the top-k."""
+    matches = rows["topk_ids"] == rows["token_id"][..., None]
+    return np.where(matches.any(axis=-1), matches.argmax(axis=-1), -1)
+
+def raw_logits(rows):
+    """Logits of the top-k tokens (up to the log-sum-exp's float32 rounding)."""
+    return rows["topk_logprobs"].astype(np.float64) + rows["logsumexp"][..., None]
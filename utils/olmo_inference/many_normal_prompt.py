@@ -1,80 +1,621 @@
 import os
-import gzip
 import json
-import glob
-import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import argparse
+import itertools
+from transformers import LogitsProcessorList, StoppingCriteriaList, TopKLogitsWarper, TopPLogitsWarper
 import torch
-import torch.nn.functional as F
-import math
 import sys
 
 # Add the parent directory to sys.path to import prompt_store
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from prompt_store import get_prompt, get_all_prompts
+from prompt_store import get_prompt, get_all_prompts, get_stop_criteria
+from generation_cache import GenerationCache, completion_params, model_fingerprint
+from batch_tuner import add_batch_tuner_arguments, batch_tuner_from_args, split_on_oom
+from cpu_inference import add_cpu_arguments, apply_cpu_options
+from decode_engine import lean_generate
+from generation_server import add_server_arguments, connect_from_args
+from jsonl_writer import BufferedJsonlWriter
+from logit_snapshots import LogitSnapshotRecorder, open_snapshot_writer
+from assisted_decoding import load_assistant_from_args
+from model_registry import add_model_arguments, default_device, load_model_from_args, resolve_model_name
+from output_index import pending_indices
+from prefix_cache import PromptCache, expand_cache
+from seeding import SeededSampler, completion_seed, completion_seeds
+from stop_criteria import PromptStopCriteria, StopChecker
+from throughput import ThroughputMeter
+from token_trace import TokenTraceWriter
+from token_metrics import StreamingTokenMetrics, compute_token_metrics, eos_token_ids, generated_length, summarize_tokens
 
-def run_inference(model, tokenizer, prompt, device, max_new_tokens=100, do_sample=True, top_k=50, top_p=0.95):
-    """Run inference on a single prompt and return the results"""
-    # Tokenize the prompt
-    inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+ENGINES = ("generate", "lean")
+
+def _sampling_kwargs(top_k, top_p, stream_metrics, seeds=None):
+    """
+    generate() arguments for top-k/top-p sampling and per-token metrics.
+    
+    With stream_metrics the warpers are built here instead of by generate so the
+    StreamingTokenMetrics recorder can run after them; generate appends its own
+    warpers after any custom processors. Seeded sampling has to run after the
+    warpers too, so seeds always take this path.
+    
+    Args:
+        seeds (list): One token sampling seed per output row, None for the global RNG
+    
+    Returns:
+        tuple: (generate kwargs, StreamingTokenMetrics or None)
+    """
+    if not stream_metrics and seeds is None:
+        return {"top_k": top_k, "top_p": top_p, "output_scores": True}, None
     
-    # Generate text with output scores
-    generation_output = model.generate(
-        **inputs,
+    recorder = StreamingTokenMetrics()
+    processors = LogitsProcessorList()
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k))
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    processors.append(recorder)
+    if seeds is not None:
+        processors.append(SeededSampler(seeds))
+    return {"top_k": 0, "top_p": 1.0, "output_scores": False, "logits_processor": processors}, recorder
+
+def _pad_token_id(tokenizer):
+    return tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+def encode_prompts(tokenizer, prompts, device, prompt_token_ids=None):
+    """
+    Tokenize prompts into one left-padded batch.
+    
+    Padding is done here rather than with tokenizer(..., padding=True) so that the
+    tokenizer's padding state is never touched and it can be shared with
+    tokenization running on other threads.
+    
+    Args:
+        prompts (list): Prompt strings
+        prompt_token_ids (list): Optional already tokenized prompts, one id list per prompt
+        
+    Returns:
+        dict: input_ids and attention_mask on device
+    """
+    if prompt_token_ids is None:
+        prompt_token_ids = [tokenizer(prompt, return_token_type_ids=False)["input_ids"] for prompt in prompts]
+    max_length = max(len(ids) for ids in prompt_token_ids)
+    input_ids = torch.full((len(prompt_token_ids), max_length), _pad_token_id(tokenizer), dtype=torch.long)
+    attention_mask = torch.zeros((len(prompt_token_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(prompt_token_ids):
+        if ids:
+            input_ids[row, max_length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, max_length - len(ids):] = 1
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+def run_inference(model, tokenizer, prompt, device, max_new_tokens=100, do_sample=True, top_k=50, top_p=0.95,
+                  stream_metrics=False, prompt_cache=None, seed=None, assistant=None, stop_criteria=None,
+                  logit_snapshot_k=0, engine="generate"):
+    """Run inference on a single prompt and return the results"""
+    return run_batched_inference(
+        model,
+        tokenizer,
+        prompt,
+        device,
+        num_return_sequences=1,
         max_new_tokens=max_new_tokens,
         do_sample=do_sample,
         top_k=top_k,
         top_p=top_p,
-        output_scores=True,
-        return_dict_in_generate=True
-    )
+        stream_metrics=stream_metrics,
+        prompt_cache=prompt_cache,
+        seeds=None if seed is None else [seed],
+        assistant=assistant,
+        stop_criteria=stop_criteria,
+        logit_snapshot_k=logit_snapshot_k,
+        engine=engine
+    )[0]
+
+def run_batched_inference(model, tokenizer, prompt, device, num_return_sequences=1, max_new_tokens=100,
+                          do_sample=True, top_k=50, top_p=0.95, stream_metrics=False, prompt_cache=None,
+                          prompt_token_ids=None, seeds=None, assistant=None, stop_criteria=None,
+                          logit_snapshot_k=0, engine="generate"):
+    """
+    Sample several completions with a single generate call (or decode_engine loop).
+    
+    Args:
+        prompt (str or list): The prompt to complete, or a list of prompts that are
+            left-padded into one batch
+        num_return_sequences (int): Number of completions to sample per prompt
+        stream_metrics (bool): Compute the token metrics during generation instead of
+            keeping every step's full-vocabulary scores (output_scores)
+        prompt_cache (PromptCache): Reuse the prompt's prefill KV cache across calls
+            (single prompt only)
+        prompt_token_ids (list): Already tokenized prompts, one id list per prompt
+        seeds (list): Token sampling seed of every completion, in output order; each
+            completion is then sampled from its own generator (requires do_sample)
+        assistant (AssistedDecoding): Draft model proposing tokens for the model to verify
+            (one completion per call, without prompt_cache, stream_metrics or seeds)
+        stop_criteria (dict): Stop each completion as soon as it meets these criteria
+            (see prompt_store.get_stop_criteria)
+        logit_snapshot_k (int): Snapshot the top logit_snapshot_k tokens of every step's
+            raw distribution (see logit_snapshots), 0 to disable
+        engine (str): "generate" for model.generate, "lean" for decode_engine.lean_generate
+            (sampling only, without an assistant; metrics are always computed on the fly)
+        
+    Returns:
+        list: One result dict per completion, each with the same fields as run_inference,
+            ordered prompt by prompt, plus token_ids and token_logprobs (chosen-token
+            log-probs) of the generated tokens and stop_reason (the criterion that
+            stopped it, "eos" or "length"); with an assistant also generation_stats
+            (tokens/sec and draft acceptance rate), with logit_snapshot_k also
+            logit_snapshot (an array of snapshot rows)
+    """
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+    if seeds is not None:
+        if not do_sample:
+            raise ValueError("seeds require do_sample=True")
+        if len(seeds) != len(prompts) * num_return_sequences:
+            raise ValueError(f"Expected {len(prompts) * num_return_sequences} seeds, got {len(seeds)}")
+    if assistant is not None:
+        # generate only supports assisted decoding for a single sequence, and the
+        # target scores every drafted position, so the metrics come from output_scores
+        if len(prompts) * num_return_sequences != 1:
+            raise ValueError("assisted decoding generates one completion per call")
+        if prompt_cache is not None or stream_metrics or seeds is not None or logit_snapshot_k:
+            raise ValueError("assisted decoding does not support prompt_cache, stream_metrics, seeds or logit snapshots")
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got {engine!r}")
+    if engine == "lean" and (assistant is not None or not do_sample):
+        raise ValueError("the lean engine only samples, without an assistant")
+    
+    # Tokenize the prompts, or take the prompt and its prefill from the prompt cache
+    past_key_values = None
+    if prompt_cache is not None:
+        if len(prompts) != 1:
+            raise ValueError("prompt_cache only supports a single prompt per call")
+        inputs, past_key_values = prompt_cache.get(model, tokenizer, prompts[0], device)
+    else:
+        inputs = encode_prompts(tokenizer, prompts, device, prompt_token_ids)
     
-    # Decode the full generated text
-    generated_text = tokenizer.decode(generation_output.sequences[0], skip_special_tokens=True)
+    generate_inputs = dict(inputs)
+    if past_key_values is not None:
+        # generate does not expand a passed cache for num_return_sequences,
+        # so repeat the prompt and its cache to the batch size ourselves
+        generate_inputs = {k: v.repeat_interleave(num_return_sequences, dim=0) for k, v in inputs.items()}
+        generate_inputs["past_key_values"] = expand_cache(past_key_values, num_return_sequences)
+        num_return_sequences = 1
     
-    # Calculate token-level metrics for the newly generated tokens
     prompt_length = inputs["input_ids"].shape[1]
-    new_tokens = generation_output.sequences[0][prompt_length:]
-    token_entropies = []
-    token_perplexities = []
-    
-    token_details = []
-    for i, score in enumerate(generation_output.scores):
-        # Convert logits to probabilities for the current timestep
-        probs = F.softmax(score, dim=-1)
-        # Compute entropy for this token
-        entropy = torch.distributions.Categorical(probs=probs).entropy()
-        token_entropy = entropy.item()
-        token_perplexity = math.exp(token_entropy)
-        
-        token_id = new_tokens[i].item()
-        token_text = tokenizer.decode(token_id)
-        token_entropies.append(token_entropy)
-        token_perplexities.append(token_perplexity)
-        token_details.append({
-            "token": token_text,
-            "entropy": token_entropy,
-            "perplexity": token_perplexity
-        })
+    eos_ids = eos_token_ids(model, tokenizer)
+    generation_stats = None
+    snapshots = None
+    stopper = None
+    if engine == "lean":
+        if num_return_sequences > 1:
+            generate_inputs = {k: v.repeat_interleave(num_return_sequences, dim=0) for k, v in generate_inputs.items()}
+        if stop_criteria:
+            stopper = PromptStopCriteria(tokenizer, stop_criteria, 0)
+        output = lean_generate(
+            model,
+            generate_inputs["input_ids"],
+            generate_inputs["attention_mask"],
+            max_new_tokens,
+            _pad_token_id(tokenizer),
+            eos_ids,
+            top_k=top_k,
+            top_p=top_p,
+            generators=None if seeds is None else [torch.Generator().manual_seed(seed) for seed in seeds],
+            past_key_values=generate_inputs.get("past_key_values"),
+            stopper=stopper,
+            logit_snapshot_k=logit_snapshot_k
+        )
+        new_tokens = output["tokens"]
+        metrics = output["metrics"]
+        snapshots = output["snapshots"]
+        sequences = torch.cat([generate_inputs["input_ids"], new_tokens], dim=1)
+    else:
+        # Generate text, either keeping the output scores or recording metrics on the fly
+        sampling_kwargs, recorder = _sampling_kwargs(top_k, top_p, stream_metrics, seeds)
+        if stop_criteria:
+            stopper = PromptStopCriteria(tokenizer, stop_criteria, prompt_length)
+            sampling_kwargs["stopping_criteria"] = StoppingCriteriaList([stopper])
+        snapshot_recorder = None
+        if logit_snapshot_k:
+            # First in the list, so it sees the logits before any warper
+            snapshot_recorder = LogitSnapshotRecorder(logit_snapshot_k)
+            sampling_kwargs["logits_processor"] = LogitsProcessorList(
+                [snapshot_recorder] + list(sampling_kwargs.get("logits_processor", []))
+            )
+        generate_kwargs = dict(
+            generate_inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=do_sample,
+            num_return_sequences=num_return_sequences,
+            pad_token_id=_pad_token_id(tokenizer),
+            return_dict_in_generate=True,
+            **sampling_kwargs
+        )
+        if assistant is not None:
+            generation_output, generation_stats = assistant.generate(
+                model,
+                lambda output: generated_length(output.sequences[0, prompt_length:].tolist(), eos_ids),
+                **generate_kwargs
+            )
+        else:
+            generation_output = model.generate(**generate_kwargs)
+        sequences = generation_output.sequences
+        
+        # Token-level metrics for every step of every row in one pass
+        # (left padding means every row's completion starts at the same column)
+        new_tokens = sequences[:, prompt_length:]
+        if recorder is not None:
+            metrics = recorder.finalize(new_tokens)
+        else:
+            metrics = compute_token_metrics(generation_output.scores, new_tokens)
+        if snapshot_recorder is not None:
+            snapshots = snapshot_recorder.finalize(new_tokens)
     
-    avg_entropy = sum(token_entropies) / len(token_entropies) if token_entropies else 0.0
-    avg_perplexity = sum(token_perplexities) / len(token_perplexities) if token_perplexities else 0.0
+    samples_per_prompt = len(new_tokens) // len(prompts)
+    results = []
+    for row, token_ids in enumerate(new_tokens.tolist()):
+        row_prompt = prompts[row // samples_per_prompt]
+        # Ignore the padding generate appends after an early EOS or stop
+        num_generated = generated_length(token_ids, eos_ids)
+        if stopper is not None and row in stopper.stop_lengths and stopper.stop_lengths[row] <= num_generated:
+            num_generated = stopper.stop_lengths[row]
+            stop_reason = stopper.stop_reasons[row]
+        elif num_generated and token_ids[num_generated - 1] in eos_ids:
+            stop_reason = "eos"
+        else:
+            stop_reason = "length"
+        token_ids = token_ids[:num_generated]
+        
+        # Decode the full generated text
+        generated_text = tokenizer.decode(sequences[row][:prompt_length + num_generated], skip_special_tokens=True)
+        
+        token_details, avg_entropy, avg_perplexity = summarize_tokens(
+            tokenizer,
+            token_ids,
+            metrics["entropy"][row][:num_generated],
+            metrics["perplexity"][row][:num_generated]
+        )
+        
+        # Extract just the generated completion (without the prompt)
+        completion_only = generated_text[len(row_prompt):].strip()
+        
+        results.append({
+            "full_output": generated_text,
+            "completion_only": completion_only,
+            "avg_token_entropy": avg_entropy,
+            "avg_token_perplexity": avg_perplexity,
+            "token_details": token_details,
+            "token_ids": token_ids,
+            "token_logprobs": metrics["logprob"][row][:num_generated],
+            "stop_reason": stop_reason
+        })
+        if generation_stats is not None:
+            results[-1]["generation_stats"] = generation_stats
+        if snapshots is not None:
+            results[-1]["logit_snapshot"] = snapshots[row, :num_generated]
     
-    # Extract just the generated completion (without the prompt)
-    completion_only = generated_text[len(prompt):].strip()
+    return results
+
+def normal_output_file(prompt_key):
+    """Output file of a prompt key's normal-prompt completions (its directory is created)."""
+    output_dir = f"completions_eval_store/{prompt_key}"
+    os.makedirs(output_dir, exist_ok=True)
+    return f"{output_dir}/{prompt_key}_normal_prompt_output.jsonl"
+
+def write_normal_record(writer, output_file, prompt, model_name, completion_idx, inference_results, run_seed=None,
+                        assistant=None, trace_writer=None, snapshot_writer=None):
+    """
+    Print one completion with its token metrics, queue its record on writer and
+    append its token trace and logit snapshots to trace_writer and snapshot_writer.
+    """
+    print(f"\nGenerated text:\n{inference_results['full_output']}\n")
+    print("Token-level metrics for generated tokens:")
+    for token_info in inference_results['token_details']:
+        print(f"Token: {repr(token_info['token'])} | Entropy: {token_info['entropy']:.4f} | Perplexity: {token_info['perplexity']:.4f}")
     
-    return {
-        "full_output": generated_text,
-        "completion_only": completion_only,
-        "avg_token_entropy": avg_entropy,
-        "avg_token_perplexity": avg_perplexity,
-        "token_details": token_details
+    # Create a dictionary to store the results
+    result = {
+        "prompt": prompt,
+        "full_output": inference_results["full_output"],
+        "completion_only": inference_results["completion_only"],
+        "model": model_name,
+        "completion_idx": completion_idx,
+        "avg_token_entropy": inference_results["avg_token_entropy"],
+        "avg_token_perplexity": inference_results["avg_token_perplexity"],
+        "stop_reason": inference_results["stop_reason"],
+        "prompt_type": "normal_prompt"
     }
+    if run_seed is not None:
+        result.update(completion_seeds(run_seed, completion_idx, purposes=("sample",)))
+    if assistant is not None:
+        result["assistant_model"] = assistant.assistant_model.name_or_path
+        result["generation_stats"] = inference_results["generation_stats"]
+    
+    # Queue the result for appending to the JSONL file
+    writer.write(result)
+    if trace_writer is not None:
+        trace_writer.write_result(completion_idx, inference_results)
+    if snapshot_writer is not None:
+        snapshot_writer.write_rows(completion_idx, inference_results["logit_snapshot"])
+    
+    print(f"Results queued for {output_file}")
+    print(f"Average entropy of generated tokens: {inference_results['avg_token_entropy']:.4f}")
+    print(f"Average perplexity of generated tokens: {inference_results['avg_token_perplexity']:.4f}")
 
-if __name__ == "__main__":
-    import argparse
+def generate_scheduled_completions(scheduler, model_name, jobs, max_tokens, writer_options=None, run_seed=None,
+                                   use_stop_criteria=True, token_trace=False, cache=None):
+    """
+    Generate the normal-prompt completions of one or more prompt keys through a
+    ContinuousBatchScheduler.
+    
+    The keys' requests are interleaved, so completions of very different lengths
+    (haiku next to stories) share the running batch. Each key's records are still
+    written to its own file in completion_idx order.
+    
+    Args:
+        scheduler (ContinuousBatchScheduler): Scheduler of the loaded model
+        model_name (str): Model id recorded in the output records
+        jobs (list): (prompt_key, output_file, completion_indices) per prompt key
+        max_tokens (int): Maximum number of tokens to generate per completion
+        writer_options (dict): Keyword arguments for the BufferedJsonlWriter of each output file
+        run_seed (int): Derive each completion's sampling seed from this seed, see generate_normal_completions
+        use_stop_criteria (bool): Retire each completion once it meets its prompt's stop criteria
+        token_trace (bool): Also write each key's token traces, see generate_normal_completions
+        cache (GenerationCache): Serve completions generated before from this cache
+            (requires run_seed)
+        
+    The scheduler's logit_snapshot_k decides whether logit snapshots are written.
+    """
+    from scheduler import GenerationRequest, in_completion_order
+    
+    prompts = {prompt_key: get_prompt(prompt_key) for prompt_key, _, _ in jobs}
+    output_files = {prompt_key: output_file for prompt_key, output_file, _ in jobs}
+    stop_criteria = {}
+    stop_checks = {}
+    for prompt_key in prompts:
+        criteria = get_stop_criteria(prompt_key) if use_stop_criteria else None
+        stop_criteria[prompt_key] = criteria
+        stop_checks[prompt_key] = StopChecker(scheduler.tokenizer, criteria) if criteria else None
+    # Round-robin over the prompt keys
+    order = [
+        (prompt_key, completion_idx)
+        for round_keys in itertools.zip_longest(*[[(key, idx) for idx in indices] for key, _, indices in jobs])
+        for prompt_key, completion_idx in filter(None, round_keys)
+    ]
+    requests = (
+        GenerationRequest(
+            (prompt_key, completion_idx),
+            prompts[prompt_key],
+            max_new_tokens=max_tokens,
+            seed=None if run_seed is None else completion_seed(run_seed, completion_idx, "sample"),
+            stop=stop_checks[prompt_key]
+        )
+        for prompt_key, completion_idx in order
+    )
+    if cache is not None and run_seed is None:
+        print("The generation cache needs a run seed (--seed), not caching")
+        cache = None
+    if cache is not None:
+        fingerprint = model_fingerprint(scheduler.model, scheduler.tokenizer)
+        
+        def cache_key(request):
+            params = completion_params(request.seed, request.max_new_tokens, scheduler.top_k, scheduler.top_p,
+                                       stop_criteria[request.key[0]], scheduler.logit_snapshot_k, engine="scheduler")
+            return cache.key(fingerprint, request.prompt, params)
+        
+        cache.reset_stats()
+        results = cache.run_scheduler(scheduler, requests, cache_key)
+    else:
+        results = scheduler.run(requests)
+    
+    writers = {}
+    trace_writers = {}
+    snapshot_writers = {}
+    try:
+        for prompt_key, output_file in output_files.items():
+            writers[prompt_key] = BufferedJsonlWriter(output_file, **(writer_options or {}))
+            if token_trace:
+                trace_writers[prompt_key] = TokenTraceWriter(output_file)
+            if scheduler.logit_snapshot_k:
+                snapshot_writers[prompt_key] = open_snapshot_writer(output_file, scheduler.logit_snapshot_k)
+        scheduler.reset_stats()
+        for request, inference_results in in_completion_order(results, order):
+            prompt_key, completion_idx = request.key
+            print(f"\n--- Completed {prompt_key} completion {completion_idx+1} ({inference_results['stop_reason']}) ---\n")
+            write_normal_record(writers[prompt_key], output_files[prompt_key], request.prompt, model_name,
+                                completion_idx, inference_results, run_seed=run_seed,
+                                trace_writer=trace_writers.get(prompt_key),
+                                snapshot_writer=snapshot_writers.get(prompt_key))
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for trace_writer in list(trace_writers.values()) + list(snapshot_writers.values()):
+            trace_writer.close()
+    scheduler.report(", ".join(output_files))
+    if cache is not None:
+        cache.report(", ".join(output_files))
+
+def generate_normal_completions(model, tokenizer, model_name, device, prompt_key, num_completions, max_tokens,
+                                batch_size=1, stream_metrics=False, prompt_cache=None, resume=False,
+                                writer_options=None, completion_indices=None, output_file=None, run_seed=None,
+                                assistant=None, scheduler=None, use_stop_criteria=True, token_trace=False,
+                                logit_snapshot_k=0, cache=None, engine="generate", batch_tuner=None, server=None):
+    """
+    Generate completions of a prompt from the prompt store and append them to
+    completions_eval_store/<prompt_key>/<prompt_key>_normal_prompt_output.jsonl.
+    
+    Args:
+        model_name (str): Model id recorded in the output records
+        prompt_key (str): Key of the prompt in the prompt store
+        num_completions (int): Number of completions to generate
+        max_tokens (int): Maximum number of tokens to generate per completion
+        batch_size (int): Number of completions to sample per generate call
+        stream_metrics (bool): Compute token metrics during generation
+        prompt_cache (PromptCache): Shared prefill cache, can be reused across prompt keys
+        resume (bool): Only generate the completion indices missing from the output file
+        writer_options (dict): Keyword arguments for the BufferedJsonlWriter of the output file
+        completion_indices (list): Generate exactly these completion indices (e.g. one
+            worker's share of a parallel run) instead of range(num_completions)
+        output_file (str): Write to this file instead of the prompt key's output file
+        run_seed (int): Derive each completion's sampling seed from this seed and its
+            completion_idx and record it, None to sample from the global RNG
+        assistant (AssistedDecoding): Draft model for assisted decoding; completions are
+            then generated one at a time and tokens/sec and acceptance are reported
+        scheduler (ContinuousBatchScheduler): Generate through this continuous-batching
+            scheduler (its max_batch_size replaces batch_size) instead of static batches
+        use_stop_criteria (bool): Stop each completion once it meets the prompt's stop
+            criteria (prompt_store.get_stop_criteria) instead of only at EOS or max_tokens
+        token_trace (bool): Also append every completion's token ids, entropies and
+            log-probs to the binary sidecar of the output file (see token_trace)
+        logit_snapshot_k (int): Also store the top logit_snapshot_k tokens of every step's
+            raw distribution next to the output file (see logit_snapshots), 0 to disable;
+            with a scheduler, its own logit_snapshot_k applies
+        cache (GenerationCache): Take completions generated before with the same model,
+            prompt, decoding parameters and seed from this cache instead of generating
+            them again (requires run_seed)
+        engine (str): Decode loop of the static batches, "generate" or "lean"
+            (see run_batched_inference)
+        batch_tuner (BatchSizeTuner): Take the batch size from its profile instead of
+            batch_size (ignored with an assistant)
+        server (GenerationClient): Generate on this generation server instead of with
+            model (which may be None; tokenizer is still used locally)
+        
+    Returns:
+        str: Path of the output file
+    """
+    original_prompt = get_prompt(prompt_key)
+    stop_criteria = get_stop_criteria(prompt_key) if use_stop_criteria else None
+    
+    print(f"Using prompt: {original_prompt}")
+    
+    if assistant is not None:
+        if prompt_cache is not None or stream_metrics or run_seed is not None or logit_snapshot_k:
+            raise ValueError("assisted decoding does not support prompt_cache, stream_metrics, run_seed or logit snapshots")
+        if batch_size != 1:
+            print("Assisted decoding generates one completion per call, using batch_size 1")
+            batch_size = 1
+        assistant.reset()
+        batch_tuner = None
+    if scheduler is not None and (assistant is not None or prompt_cache is not None):
+        raise ValueError("the scheduler does not support an assistant or prompt_cache")
+    if server is not None and (assistant is not None or scheduler is not None or prompt_cache is not None
+                               or batch_tuner is not None):
+        raise ValueError("the generation server does not support an assistant, scheduler, prompt_cache or batch_tuner")
     
+    # Define output file path based on the prompt name
+    if output_file is None:
+        output_file = normal_output_file(prompt_key)
+    
+    if completion_indices is None:
+        completion_indices = pending_indices(output_file, num_completions, resume)
+    
+    if scheduler is not None:
+        generate_scheduled_completions(scheduler, model_name, [(prompt_key, output_file, completion_indices)],
+                                       max_tokens, writer_options=writer_options, run_seed=run_seed,
+                                       use_stop_criteria=use_stop_criteria, token_trace=token_trace, cache=cache)
+        print(f"\nCompleted generating {num_completions} completions.")
+        return output_file
+    
+    if cache is not None and run_seed is None:
+        print("The generation cache needs a run seed (--seed), not caching")
+        cache = None
+    if cache is not None:
+        fingerprint = server.model_fingerprint() if server is not None else model_fingerprint(model, tokenizer)
+        cache.reset_stats()
+    
+    # A batch that runs out of memory lowers the tuner's batch size for this prompt
+    prompt_length = len(tokenizer(original_prompt)["input_ids"])
+    
+    def on_oom(failed_batch_size):
+        if batch_tuner is not None:
+            batch_tuner.record_oom(prompt_length, max_tokens, failed_batch_size)
+    
+    throughput = ThroughputMeter()
+    # Records are written in batches from a background thread
+    writer = BufferedJsonlWriter(output_file, **(writer_options or {}))
+    trace_writer = TokenTraceWriter(output_file) if token_trace else None
+    snapshot_writer = open_snapshot_writer(output_file, logit_snapshot_k) if logit_snapshot_k else None
+    try:
+        # Generate multiple completions, batch_size samples per generate call
+        batch_start = 0
+        while batch_start < len(completion_indices):
+            if batch_tuner is not None:
+                # Re-read every batch: an out-of-memory retry lowers it
+                batch_size = batch_tuner.batch_size(prompt_length, max_tokens)
+            batch_indices = completion_indices[batch_start:batch_start + batch_size]
+            batch_start += len(batch_indices)
+            print(f"\n--- Generating completions {batch_indices[0]+1}-{batch_indices[-1]+1}/{num_completions} ---\n")
+        
+            # Use only the original prompt without random samples
+            prompt = original_prompt
+            print("Prompt:\n", prompt)
+        
+            seeds = None
+            if run_seed is not None:
+                seeds = [completion_seed(run_seed, completion_idx, "sample") for completion_idx in batch_indices]
+        
+            def generate_batch(positions):
+                # Run inference for the completions at these positions of the batch
+                if server is not None:
+                    return server.run_batched_inference(
+                        prompt,
+                        num_return_sequences=len(positions),
+                        max_new_tokens=max_tokens,
+                        seeds=None if seeds is None else [seeds[i] for i in positions],
+                        stop_criteria=stop_criteria,
+                        logit_snapshot_k=logit_snapshot_k,
+                        engine=engine
+                    )
+                return run_batched_inference(
+                    model, 
+                    tokenizer, 
+                    prompt, 
+                    device, 
+                    num_return_sequences=len(positions),
+                    max_new_tokens=max_tokens,
+                    stream_metrics=stream_metrics,
+                    prompt_cache=prompt_cache,
+                    seeds=None if seeds is None else [seeds[i] for i in positions],
+                    assistant=assistant,
+                    stop_criteria=stop_criteria,
+                    logit_snapshot_k=logit_snapshot_k,
+                    engine=engine
+                )
+        
+            @throughput.measure
+            def generate(positions):
+                # A batch that runs out of memory is retried in halves
+                return split_on_oom(generate_batch, positions, device, on_oom)
+        
+            if cache is not None:
+                keys = [
+                    cache.key(fingerprint, prompt, completion_params(seed, max_tokens, stop_criteria=stop_criteria,
+                                                                     logit_snapshot_k=logit_snapshot_k, engine=engine))
+                    for seed in seeds
+                ]
+                batch_results = cache.lookup(keys, generate)
+            else:
+                batch_results = generate(range(len(batch_indices)))
+        
+            for completion_idx, inference_results in zip(batch_indices, batch_results):
+                write_normal_record(writer, output_file, prompt, model_name, completion_idx, inference_results,
+                                    run_seed=run_seed, assistant=assistant, trace_writer=trace_writer,
+                                    snapshot_writer=snapshot_writer)
+    
+    finally:
+        writer.close()
+        if trace_writer is not None:
+            trace_writer.close()
+        if snapshot_writer is not None:
+            snapshot_writer.close()
+    
+    throughput.report(prompt_key)
+    if assistant is not None:
+        assistant.report(prompt_key)
+    if cache is not None:
+        cache.report(prompt_key)
+    print(f"\nCompleted generating {num_completions} completions.")
+    return output_file
+
+def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Generate text completions with normal prompts")
     parser.add_argument("--prompt", type=str, help="Custom prompt to use for generation")
@@ -84,83 +625,91 @@ if __name__ == "__main__":
                         help="Number of completions to generate")
     parser.add_argument("--max_tokens", type=int, default=500,
                         help="Maximum number of tokens to generate")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of completions to sample per generate call")
+    parser.add_argument("--stream_metrics", action="store_true",
+                        help="Compute token metrics during generation instead of keeping output scores")
+    parser.add_argument("--prompt_cache", action="store_true",
+                        help="Prefill the prompt once and reuse its KV cache for every completion")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only generate the completion indices missing from the output file")
+    parser.add_argument("--flush_records", type=int, default=32,
+                        help="Write buffered records to the output file once this many are queued")
+    parser.add_argument("--flush_interval", type=float, default=5.0,
+                        help="Write buffered records to the output file at least this often (seconds)")
+    parser.add_argument("--fsync", type=str, default="never", choices=["never", "batch", "close"],
+                        help="When to fsync the output file")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Run seed; each completion's sampling seed is derived from it and its index")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="Continuous batching: refill a slot as soon as its completion ends (--batch_size slots)")
+    parser.add_argument("--no_stop_criteria", action="store_true",
+                        help="Only stop at EOS or max_tokens, ignoring the prompt's stop criteria")
+    parser.add_argument("--token_trace", action="store_true",
+                        help="Write token ids, entropies and log-probs to a binary sidecar of the output file")
+    parser.add_argument("--logit_snapshot_k", type=int, default=0,
+                        help="Store the top-k tokens and log-probs of every step's raw distribution next to the output file (0: off)")
+    parser.add_argument("--engine", type=str, default="generate", choices=ENGINES,
+                        help="Decode loop: model.generate or the lean loop of decode_engine (sampling only)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Reuse completions generated before with the same model, prompt, parameters and --seed from this cache")
+    parser.add_argument("--cache_max_gb", type=float, default=10.0,
+                        help="Evict least recently used cache entries beyond this size")
+    add_model_arguments(parser)
+    add_batch_tuner_arguments(parser)
+    add_cpu_arguments(parser)
+    add_server_arguments(parser)
     args = parser.parse_args()
     
-    # Set up variables from arguments
-    num_completions = args.num_completions
-    max_tokens = args.max_tokens
-    
     # Instead of defining a prompt bank, use the centralized one
     # Print available prompts for reference
     prompt_bank = get_all_prompts()
     print("Available prompts:", list(prompt_bank.keys()))
     
-    # Setup your language model and tokenizer
-    MODELS = {
-        "olmo-1b": "allenai/OLMo-1B-0724-hf",
-        "olmo-2-7b": "allenai/OLMo-2-1124-7B",
-        "olmo-2-13b": "allenai/OLMo-2-1124-13B"
-    }
-    model_name = MODELS["olmo-2-7b"]
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    
-    # Move model to CUDA if available
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model = model.to(device)
+    # Setup your language model and tokenizer, on CUDA if available
+    model_name = resolve_model_name(args.model)
+    device = default_device()
+    server = connect_from_args(args)
+    if server is not None:
+        # The server holds the model; only the tokenizer is needed here
+        model, tokenizer = None, server.tokenizer
+    else:
+        model, tokenizer = load_model_from_args(args, device)
+        model = apply_cpu_options(args, model, device)
+    assistant = load_assistant_from_args(args, tokenizer, device)
+    scheduler = None
+    if args.scheduler:
+        from scheduler import ContinuousBatchScheduler
+        scheduler = ContinuousBatchScheduler(model, tokenizer, device, max_batch_size=args.batch_size,
+                                             logit_snapshot_k=args.logit_snapshot_k)
     
     # Use the provided prompt if available, otherwise use default
     prompt_key = args.prompt if args.prompt else "default"
-    original_prompt = get_prompt(prompt_key)
     
-    print(f"Using prompt: {original_prompt}")
-    
-    # Define output file path based on the prompt name
-    prompt_name = prompt_key
-    output_dir = f"completions_eval_store/{prompt_name}"
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = f"{output_dir}/{prompt_name}_normal_prompt_output.jsonl"
-    
-    # Generate multiple completions
-    for completion_idx in range(num_completions):
-        print(f"\n--- Generating completion {completion_idx+1}/{num_completions} ---\n")
-        
-        # Use only the original prompt without random samples
-        prompt = original_prompt
-        print("Prompt:\n", prompt)
-        
-        # Run inference
-        inference_results = run_inference(
-            model, 
-            tokenizer, 
-            prompt, 
-            device, 
-            max_new_tokens=max_tokens
-        )
-        
-        print(f"\nGenerated text:\n{inference_results['full_output']}\n")
-        print("Token-level metrics for generated tokens:")
-        for token_info in inference_results['token_details']:
-            print(f"Token: {repr(token_info['token'])} | Entropy: {token_info['entropy']:.4f} | Perplexity: {token_info['perplexity']:.4f}")
-        
-        # Create a dictionary to store the results
-        result = {
-            "prompt": prompt,
-            "full_output": inference_results["full_output"],
-            "completion_only": inference_results["completion_only"],
-            "model": model_name,
-            "completion_idx": completion_idx,
-            "avg_token_entropy": inference_results["avg_token_entropy"],
-            "avg_token_perplexity": inference_results["avg_token_perplexity"],
-            "prompt_type": "normal_prompt"
-        }
-        
-        # Append the result to the JSONL file
-        with open(output_file, "a") as f:
-            f.write(json.dumps(result) + "\n")
-        
-        print(f"Results saved to {output_file}")
-        print(f"Average entropy of generated tokens: {inference_results['avg_token_entropy']:.4f}")
-        print(f"Average perplexity of generated tokens: {inference_results['avg_token_perplexity']:.4f}")
-    
-    print(f"\nCompleted generating {num_completions} completions.")
\ No newline at end of file
+    generate_normal_completions(
+        model,
+        tokenizer,
+        model_name,
+        device,
+        prompt_key,
+        args.num_completions,
+        args.max_tokens,
+        batch_size=args.batch_size,
+        stream_metrics=args.stream_metrics,
+        prompt_cache=PromptCache() if args.prompt_cache else None,
+        resume=args.resume,
+        writer_options={"max_records": args.flush_records, "flush_interval": args.flush_interval, "fsync": args.fsync},
+        run_seed=args.seed,
+        assistant=assistant,
+        scheduler=scheduler,
+        use_stop_criteria=not args.no_stop_criteria,
+        token_trace=args.token_trace,
+        logit_snapshot_k=args.logit_snapshot_k,
+        cache=GenerationCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3)) if args.cache_dir else None,
+        engine=args.engine,
+        batch_tuner=batch_tuner_from_args(args, model, device),
+        server=server
+    )
+
+if __name__ == "__main__":
+    main()
@@ -3,27 +3,46 @@ import gzip
 import json
 import glob
 import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import argparse
+import itertools
 import torch
-import torch.nn.functional as F
-import math
 import sys
 
 # Add the parent directory to sys.path to import prompt_store
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from prompt_store import get_prompt, get_all_prompts
+from prompt_store import get_prompt, get_all_prompts, get_stop_criteria
+from many_normal_prompt import ENGINES, run_batched_inference
+from assisted_decoding import load_assistant_from_args
+from model_registry import add_model_arguments, default_device, load_model_from_args, resolve_model_name
+from batching import bucket_by_length, padding_efficiency
+from batch_tuner import add_batch_tuner_arguments, batch_tuner_from_args, split_on_oom
+from cpu_inference import add_cpu_arguments, apply_cpu_options
+from generation_cache import GenerationCache, completion_params, model_fingerprint
+from generation_server import add_server_arguments, connect_from_args
+from jsonl_writer import BufferedJsonlWriter
+from logit_snapshots import open_snapshot_writer
+from output_index import pending_indices
+from prefetch import Prefetcher
+from prompt_builder import build_random_doc_prompt
+from seeding import completion_rng, completion_seed, completion_seeds
+from stop_criteria import StopChecker
+from throughput import ThroughputMeter
+from token_trace import TokenTraceWriter
 
-def get_sample_text(data_dir):
+def get_sample_text(data_dir, rng=random):
     """
     Randomly selects one file from data_dir, randomly samples a single record,
-    and returns the value of its "text" field.
+    and returns the value of its "text" field and the file path ("" and None if
+    nothing could be sampled).
+    
+    The file list is sorted so that a seeded rng always picks the same document.
     """
-    file_list = glob.glob(os.path.join(data_dir, "*.json.gz"))
+    file_list = sorted(glob.glob(os.path.join(data_dir, "*.json.gz")))
     if not file_list:
         print(f"No .json.gz files found in {data_dir}")
-        return ""
+        return "", None
     
-    file_path = random.choice(file_list)
+    file_path = rng.choice(file_list)
     print(f"Sampling from file: {file_path}")
 
     with gzip.open(file_path, "rt", encoding="utf-8") as f:
@@ -31,150 +50,447 @@ def get_sample_text(data_dir):
     
     if not lines:
         print("No lines found in the file.")
-        return ""
+        return "", file_path
     
-    sampled_line = random.choice(lines)
+    sampled_line = rng.choice(lines)
     try:
         record = json.loads(sampled_line)
     except json.JSONDecodeError as e:
         print(f"Error decoding JSON: {e}")
-        return ""
+        return "", file_path
     
     # Extract the 'text' field from the record, or return empty string if missing
     # Also return the file path
     return record.get("text", ""), file_path
 
-if __name__ == "__main__":
-    import argparse
-    
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Generate text completions with random documents")
-    parser.add_argument("--prompt", type=str, help="Custom prompt to use for generation")
-    parser.add_argument("--data_dir", type=str, default="/home/eisape/projects/diversify_lm_output/dolma/data", 
-                        help="Directory containing data files")
-    parser.add_argument("--num_completions", type=int, default=300, 
-                        help="Number of completions to generate")
-    parser.add_argument("--max_tokens", type=int, default=500,
-                        help="Maximum number of tokens to generate")
-    args = parser.parse_args()
+def prepare_random_doc_prompt(tokenizer, data_dir, original_prompt, token_budget=None, truncation="head", rng=random):
+    """
+    Sample a random document, prepend it to the prompt and tokenize the result.
     
-    # Set up data directory
-    data_dir = args.data_dir if args.data_dir else os.getenv("DATA_DIR", "/home/eisape/projects/diversify_lm_output/dolma/data")
+    Args:
+        token_budget (int): Maximum prompt length in tokens; the document is truncated to fit
+        truncation (str): Part of the document kept when truncating: "head", "tail" or "random"
+        rng (random.Random): Source of randomness for the document and its truncation
     
-    # Define number of completions to generate
-    num_completions = args.num_completions
-    max_tokens = args.max_tokens if hasattr(args, 'max_tokens') else 500
+    Returns:
+        dict: sampled_text, random_doc_file_path and the build_random_doc_prompt fields
+            (prompt, prompt_token_ids, doc_span, doc_tokens_used, doc_tokens_total)
+    """
+    # Get a new sampled text for each completion
+    sampled_text, random_doc_file_path = get_sample_text(data_dir, rng)
+    if not sampled_text:
+        print("No sampled text found. Proceeding with default prompt.")
     
-    # Instead of defining a prompt bank, use the centralized one
-    # Print available prompts for reference
-    prompt_bank = get_all_prompts()
-    print("Available prompts:", list(prompt_bank.keys()))
+    # Prepend the sampled text (if any) to your original prompt, within the token budget
+    sample = build_random_doc_prompt(tokenizer, sampled_text, original_prompt, token_budget, truncation, rng)
+    sample["sampled_text"] = sampled_text
+    sample["random_doc_file_path"] = random_doc_file_path
+    return sample
+
+def generate_random_doc_completions(model, tokenizer, model_name, device, prompt_key, data_dir, num_completions,
+                                    max_tokens, batch_size=1, window=0, stream_metrics=False, resume=False,
+                                    prefetch=0, prefetch_workers=1, writer_options=None, token_budget=None,
+                                    truncation="head", completion_indices=None, output_file=None, run_seed=None,
+                                    assistant=None, scheduler=None, use_stop_criteria=True, token_trace=False,
+                                    logit_snapshot_k=0, cache=None, engine="generate", batch_tuner=None, server=None):
+    """
+    Generate completions of a prompt from the prompt store, each conditioned on a
+    different random document, and append them to
+    completions_eval_store/<prompt_key>/<prompt_key>_random_prompt_output.jsonl.
     
-    # Use the provided prompt if available, otherwise use default
-    prompt_key = args.prompt if args.prompt else "default"
+    Args:
+        model_name (str): Model id recorded in the output records
+        prompt_key (str): Key of the prompt in the prompt store
+        data_dir (str): Directory containing the .json.gz document shards
+        num_completions (int): Number of completions to generate
+        max_tokens (int): Maximum number of tokens to generate per completion
+        batch_size (int): Maximum number of prompts generated together in one length bucket
+        window (int): Documents sampled ahead and bucketed together (0: 4 x batch_size)
+        stream_metrics (bool): Compute token metrics during generation
+        resume (bool): Only generate the completion indices missing from the output file
+        prefetch (int): Prompts sampled and tokenized ahead on background threads (0: inline)
+        prefetch_workers (int): Number of background threads for prefetching
+        writer_options (dict): Keyword arguments for the BufferedJsonlWriter of the output file
+        token_budget (int): Maximum prompt length in tokens; documents are truncated to fit
+            and the document span used is added to the records
+        truncation (str): Part of the document kept when truncating: "head", "tail" or "random"
+        completion_indices (list): Generate exactly these completion indices (e.g. one
+            worker's share of a parallel run) instead of range(num_completions)
+        output_file (str): Write to this file instead of the prompt key's output file
+        run_seed (int): Derive each completion's document and sampling seeds from this
+            seed and its completion_idx and record them, None to use the global RNGs
+        assistant (AssistedDecoding): Draft model for assisted decoding; completions are
+            then generated one at a time and tokens/sec and acceptance are reported
+        scheduler (ContinuousBatchScheduler): Generate through this continuous-batching
+            scheduler (its max_batch_size replaces batch_size and length bucketing)
+        use_stop_criteria (bool): Stop each completion once it meets the prompt's stop
+            criteria (prompt_store.get_stop_criteria) instead of only at EOS or max_tokens
+        token_trace (bool): Also append every completion's token ids, entropies and
+            log-probs to the binary sidecar of the output file (see token_trace)
+        logit_snapshot_k (int): Also store the top logit_snapshot_k tokens of every step's
+            raw distribution next to the output file (see logit_snapshots), 0 to disable;
+            with a scheduler, its own logit_snapshot_k applies
+        cache (GenerationCache): Take completions generated before with the same model,
+            prompt (document included), decoding parameters and seed from this cache
+            instead of generating them again (requires run_seed)
+        engine (str): Decode loop of the length buckets, "generate" or "lean"
+            (see run_batched_inference)
+        batch_tuner (BatchSizeTuner): Split every length bucket to the batch size its
+            longest prompt gets from the tuner's profile; batch_size then only caps the
+            buckets at the tuner's max_batch_size (ignored with an assistant)
+        server (GenerationClient): Generate on this generation server instead of with
+            model (which may be None; tokenizer is still used locally)
+        
+    Returns:
+        str: Path of the output file
+    """
     original_prompt = get_prompt(prompt_key)
+    stop_criteria = get_stop_criteria(prompt_key) if use_stop_criteria else None
     
     print(f"Using prompt: {original_prompt}")
-
-    # Setup your language model and tokenizer
-    MODELS = {
-        "olmo-1b": "allenai/OLMo-1B-0724-hf",
-        "olmo-2-7b": "allenai/OLMo-2-1124-7B",
-        "olmo-2-13b": "allenai/OLMo-2-1124-13B"
-    }
-    model_name = MODELS["olmo-2-7b"]
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    
-    # Move model to CUDA if available
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model = model.to(device)
+    
+    if assistant is not None:
+        if stream_metrics or run_seed is not None or logit_snapshot_k:
+            raise ValueError("assisted decoding does not support stream_metrics, run_seed or logit snapshots")
+        if batch_size != 1:
+            print("Assisted decoding generates one completion per call, using batch_size 1")
+            batch_size = 1
+        assistant.reset()
+        batch_tuner = None
+    if batch_tuner is not None:
+        batch_size = batch_tuner.max_batch_size
+    if scheduler is not None and assistant is not None:
+        raise ValueError("the scheduler does not support an assistant")
+    if server is not None and (assistant is not None or scheduler is not None or batch_tuner is not None):
+        raise ValueError("the generation server does not support an assistant, scheduler or batch_tuner")
     
     # Define output file path
-    output_dir = f"completions_eval_store/{prompt_key}"
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = f"{output_dir}/{prompt_key}_random_prompt_output.jsonl"
+    if output_file is None:
+        output_dir = f"completions_eval_store/{prompt_key}"
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = f"{output_dir}/{prompt_key}_random_prompt_output.jsonl"
     
-    # Generate multiple completions
-    for completion_idx in range(num_completions):
-        print(f"\n--- Generating completion {completion_idx+1}/{num_completions} ---\n")
-        
-        # Get a new sampled text for each completion
-        sampled_text, random_doc_file_path = get_sample_text(data_dir)
-        if not sampled_text:
-            print("No sampled text found. Proceeding with default prompt.")
-        
-        # Prepend the sampled text (if any) to your original prompt
-        prompt = sampled_text + "\n" + original_prompt if sampled_text else original_prompt
+    # Documents are sampled a window at a time so each window can be split into
+    # buckets of similar prompt length and every bucket generated as one batch
+    window = window if window else (batch_size * 4 if batch_size > 1 else 1)
+    if completion_indices is None:
+        completion_indices = pending_indices(output_file, num_completions, resume)
+    
+    def prepare(completion_idx):
+        rng = random if run_seed is None else completion_rng(run_seed, completion_idx, "doc")
+        return prepare_random_doc_prompt(tokenizer, data_dir, original_prompt, token_budget, truncation, rng)
+    
+    # Prompts come either from the background prefetcher or are prepared inline
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = Prefetcher(prepare, completion_indices, depth=max(prefetch, window), num_workers=prefetch_workers)
+        prepared = iter(prefetcher)
+    else:
+        prepared = ((completion_idx, prepare(completion_idx)) for completion_idx in completion_indices)
+    
+    def write_record(completion_idx, sample, inference_results):
+        prompt = sample["prompt"]
         print("Combined prompt:\n", prompt)
-        
-        # Tokenize the prompt
-        inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        
-        # Generate text with output scores
-        generation_output = model.generate(
-            **inputs,
-            max_new_tokens=max_tokens,
-            do_sample=True,
-            top_k=50,
-            top_p=0.95,
-            output_scores=True,
-            return_dict_in_generate=True
-        )
-        
-        # Decode the full generated text
-        generated_text = tokenizer.decode(generation_output.sequences[0], skip_special_tokens=True)
-        print(f"\nGenerated text:\n{generated_text}\n")
-        
-        # Calculate token-level metrics for the newly generated tokens
-        prompt_length = inputs["input_ids"].shape[1]
-        new_tokens = generation_output.sequences[0][prompt_length:]
-        token_entropies = []
-        token_perplexities = []
-        
+        print(f"\nGenerated text:\n{inference_results['full_output']}\n")
         print("Token-level metrics for generated tokens:")
-        for i, score in enumerate(generation_output.scores):
-            # Convert logits to probabilities for the current timestep
-            probs = F.softmax(score, dim=-1)
-            # Compute entropy for this token
-            entropy = torch.distributions.Categorical(probs=probs).entropy()
-            token_entropy = entropy.item()
-            token_perplexity = math.exp(token_entropy)
-            
-            token_id = new_tokens[i].item()
-            token_text = tokenizer.decode(token_id)
-            token_entropies.append(token_entropy)
-            token_perplexities.append(token_perplexity)
-            print(f"Token: {repr(token_text)} | Entropy: {token_entropy:.4f} | Perplexity: {token_perplexity:.4f}")
-        
-        avg_entropy = sum(token_entropies) / len(token_entropies) if token_entropies else 0.0
-        avg_perplexity = sum(token_perplexities) / len(token_perplexities) if token_perplexities else 0.0
-        
-        # Extract just the generated completion (without the prompt)
-        completion_only = generated_text[len(prompt):].strip()
+        for token_info in inference_results['token_details']:
+            print(f"Token: {repr(token_info['token'])} | Entropy: {token_info['entropy']:.4f} | Perplexity: {token_info['perplexity']:.4f}")
         
         # Create a dictionary to store the results
         result = {
-            "random_doc_file_path": random_doc_file_path,
-            "random_doc": sampled_text,
+            "random_doc_file_path": sample["random_doc_file_path"],
+            "random_doc": sample["sampled_text"],
             "prompt": prompt,
             "original_prompt": original_prompt,
-            "full_output": generated_text,
-            "completion_only": completion_only,
+            "full_output": inference_results["full_output"],
+            "completion_only": inference_results["completion_only"],
             "model": model_name,
             "completion_idx": completion_idx,
-            "avg_token_entropy": avg_entropy,
-            "avg_token_perplexity": avg_perplexity,
+            "avg_token_entropy": inference_results["avg_token_entropy"],
+            "avg_token_perplexity": inference_results["avg_token_perplexity"],
+            "stop_reason": inference_results["stop_reason"],
             "prompt_type": "random_doc"
         }
+        if token_budget is not None:
+            # Which part of random_doc ended up in the prompt
+            result["random_doc_span"] = sample["doc_span"]
+            result["random_doc_tokens_used"] = sample["doc_tokens_used"]
+            result["random_doc_tokens_total"] = sample["doc_tokens_total"]
+            result["random_doc_truncation"] = truncation
+        if run_seed is not None:
+            result.update(completion_seeds(run_seed, completion_idx))
+        if assistant is not None:
+            result["assistant_model"] = assistant.assistant_model.name_or_path
+            result["generation_stats"] = inference_results["generation_stats"]
+        
+        # Queue the result for appending to the JSONL file
+        writer.write(result)
+        if trace_writer is not None:
+            trace_writer.write_result(completion_idx, inference_results)
+        if snapshot_writer is not None:
+            snapshot_writer.write_rows(completion_idx, inference_results["logit_snapshot"])
+        
+        print(f"Results queued for {output_file}")
+        print(f"Average entropy of generated tokens: {inference_results['avg_token_entropy']:.4f}")
+        print(f"Average perplexity of generated tokens: {inference_results['avg_token_perplexity']:.4f}")
+    
+    if cache is not None and run_seed is None:
+        print("The generation cache needs a run seed (--seed), not caching")
+        cache = None
+    if cache is not None:
+        fingerprint = server.model_fingerprint() if server is not None else model_fingerprint(model, tokenizer)
+        cache.reset_stats()
+    
+    throughput = ThroughputMeter()
+    # Records are written in batches from a background thread
+    writer = BufferedJsonlWriter(output_file, **(writer_options or {}))
+    trace_writer = TokenTraceWriter(output_file) if token_trace else None
+    if scheduler is not None:
+        logit_snapshot_k = scheduler.logit_snapshot_k
+    snapshot_writer = open_snapshot_writer(output_file, logit_snapshot_k) if logit_snapshot_k else None
+    try:
+        if scheduler is not None:
+            from scheduler import GenerationRequest, in_completion_order
+            # Prompts are admitted into free slots as they are needed; their samples
+            # are kept until the record is written
+            samples = {}
+            stop = StopChecker(tokenizer, stop_criteria) if stop_criteria else None
+            
+            def requests():
+                for completion_idx, sample in prepared:
+                    samples[completion_idx] = sample
+                    yield GenerationRequest(
+                        completion_idx,
+                        sample["prompt"],
+                        max_new_tokens=max_tokens,
+                        prompt_token_ids=sample["prompt_token_ids"],
+                        seed=None if run_seed is None else completion_seed(run_seed, completion_idx, "sample"),
+                        stop=stop
+                    )
+            
+            scheduler.reset_stats()
+            if cache is not None:
+                def cache_key(request):
+                    params = completion_params(request.seed, max_tokens, scheduler.top_k, scheduler.top_p,
+                                               stop_criteria, logit_snapshot_k, engine="scheduler")
+                    return cache.key(fingerprint, request.prompt, params)
+                
+                results = cache.run_scheduler(scheduler, requests(), cache_key)
+            else:
+                results = scheduler.run(requests())
+            for request, inference_results in in_completion_order(results, completion_indices):
+                write_record(request.key, samples.pop(request.key), inference_results)
+            scheduler.report(output_file)
+        else:
+            # Generate multiple completions
+            while True:
+                window_items = list(itertools.islice(prepared, window))
+                if not window_items:
+                    break
+                window_indices = [completion_idx for completion_idx, _ in window_items]
+                samples = [sample for _, sample in window_items]
+                seeds = None
+                if run_seed is not None:
+                    seeds = [completion_seed(run_seed, completion_idx, "sample") for completion_idx in window_indices]
         
-        # Append the result to the JSONL file
-        with open(output_file, "a") as f:
-            f.write(json.dumps(result) + "\n")
+                @throughput.measure
+                def generate(positions):
+                    # Bucket the prompts at these window positions by length, one batch per bucket
+                    lengths = [len(samples[i]["prompt_token_ids"]) for i in positions]
+                    buckets = bucket_by_length(lengths, batch_size)
+                    if batch_size > 1:
+                        print(f"\nWindow of {len(positions)} prompts in {len(buckets)} buckets, "
+                              f"padding efficiency {padding_efficiency(lengths, buckets):.2%}")
+                    if batch_tuner is not None:
+                        buckets = batch_tuner.split(buckets, lengths, max_tokens)
+                    buckets = [[positions[j] for j in bucket] for bucket in buckets]
+                    
+                    def generate_batch(batch):
+                        if server is not None:
+                            return server.run_batched_inference(
+                                [samples[i]["prompt"] for i in batch],
+                                max_new_tokens=max_tokens,
+                                prompt_token_ids=[samples[i]["prompt_token_ids"] for i in batch],
+                                seeds=None if seeds is None else [seeds[i] for i in batch],
+                                stop_criteria=stop_criteria,
+                                logit_snapshot_k=logit_snapshot_k,
+                                engine=engine
+                            )
+                        return run_batched_inference(
+                            model,
+                            tokenizer,
+                            [samples[i]["prompt"] for i in batch],
+                            device,
+                            max_new_tokens=max_tokens,
+                            stream_metrics=stream_metrics,
+                            prompt_token_ids=[samples[i]["prompt_token_ids"] for i in batch],
+                            seeds=None if seeds is None else [seeds[i] for i in batch],
+                            assistant=assistant,
+                            stop_criteria=stop_criteria,
+                            logit_snapshot_k=logit_snapshot_k,
+                            engine=engine
+                        )
+                    
+                    generated = {}
+                    for bucket in buckets:
+                        bucket_numbers = ", ".join(str(window_indices[i] + 1) for i in bucket)
+                        print(f"\n--- Generating completions {bucket_numbers} of {num_completions} ---\n")
+                        longest = max(len(samples[i]["prompt_token_ids"]) for i in bucket)
+                        
+                        def on_oom(failed_batch_size):
+                            if batch_tuner is not None:
+                                batch_tuner.record_oom(longest, max_tokens, failed_batch_size)
+                        
+                        # A bucket that runs out of memory is retried in halves
+                        batch_results = split_on_oom(generate_batch, bucket, device, on_oom)
+                        for i, inference_results in zip(bucket, batch_results):
+                            generated[i] = inference_results
+                    return [generated[i] for i in positions]
         
-        print(f"Results saved to {output_file}")
-        print(f"Average entropy of generated tokens: {avg_entropy:.4f}")
-        print(f"Average perplexity of generated tokens: {avg_perplexity:.4f}")
+                if cache is not None:
+                    keys = [
+                        cache.key(fingerprint, sample["prompt"], completion_params(
+                            seed, max_tokens, stop_criteria=stop_criteria, logit_snapshot_k=logit_snapshot_k,
+                            engine=engine
+                        ))
+                        for sample, seed in zip(samples, seeds)
+                    ]
+                    window_results = cache.lookup(keys, generate)
+                else:
+                    window_results = generate(list(range(len(samples))))
+        
+                # Write the records back in completion_idx order
+                for i, completion_idx in enumerate(window_indices):
+                    write_record(completion_idx, samples[i], window_results[i])
+    
+    finally:
+        writer.close()
+        if trace_writer is not None:
+            trace_writer.close()
+        if snapshot_writer is not None:
+            snapshot_writer.close()
+    
+    throughput.report(prompt_key)
+    if prefetcher is not None:
+        prefetcher.report()
+    if assistant is not None:
+        assistant.report(prompt_key)
+    if cache is not None:
+        cache.report(prompt_key)
+    print(f"\nCompleted generating {num_completions} completions with different random documents.")
+    return output_file
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Generate text completions with random documents")
+    parser.add_argument("--prompt", type=str, help="Custom prompt to use for generation")
+    parser.add_argument("--data_dir", type=str, default="/home/eisape/projects/diversify_lm_output/dolma/data", 
+                        help="Directory containing data files")
+    parser.add_argument("--num_completions", type=int, default=300, 
+                        help="Number of completions to generate")
+    parser.add_argument("--max_tokens", type=int, default=500,
+                        help="Maximum number of tokens to generate")
+    parser.add_argument("--stream_metrics", action="store_true",
+                        help="Compute token metrics during generation instead of keeping output scores")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Maximum number of prompts generated together in one length bucket")
+    parser.add_argument("--window", type=int, default=0,
+                        help="Documents sampled ahead and bucketed together (default: 4 x batch_size)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only generate the completion indices missing from the output file")
+    parser.add_argument("--flush_records", type=int, default=32,
+                        help="Write buffered records to the output file once this many are queued")
+    parser.add_argument("--flush_interval", type=float, default=5.0,
+                        help="Write buffered records to the output file at least this often (seconds)")
+    parser.add_argument("--fsync", type=str, default="never", choices=["never", "batch", "close"],
+                        help="When to fsync the output file")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Prompts sampled and tokenized ahead on background threads (0: inline)")
+    parser.add_argument("--prefetch_workers", type=int, default=1,
+                        help="Number of background threads for prefetching")
+    parser.add_argument("--prompt_token_budget", type=int, default=None,
+                        help="Maximum prompt length in tokens; longer documents are truncated to fit")
+    parser.add_argument("--doc_truncation", type=str, default="head", choices=["head", "tail", "random"],
+                        help="Part of the document kept when it is truncated")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Run seed; each completion's document and sampling seeds are derived from it and its index")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="Continuous batching: refill a slot as soon as its completion ends (--batch_size slots)")
+    parser.add_argument("--no_stop_criteria", action="store_true",
+                        help="Only stop at EOS or max_tokens, ignoring the prompt's stop criteria")
+    parser.add_argument("--token_trace", action="store_true",
+                        help="Write token ids, entropies and log-probs to a binary sidecar of the output file")
+    parser.add_argument("--logit_snapshot_k", type=int, default=0,
+                        help="Store the top-k tokens and log-probs of every step's raw distribution next to the output file (0: off)")
+    parser.add_argument("--engine", type=str, default="generate", choices=ENGINES,
+                        help="Decode loop: model.generate or the lean loop of decode_engine (sampling only)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Reuse completions generated before with the same model, prompt, parameters and --seed from this cache")
+    parser.add_argument("--cache_max_gb", type=float, default=10.0,
+                        help="Evict least recently used cache entries beyond this size")
+    add_model_arguments(parser)
+    add_batch_tuner_arguments(parser)
+    add_cpu_arguments(parser)
+    add_server_arguments(parser)
+    args = parser.parse_args()
     
-    print(f"\nCompleted generating {num_completions} completions with different random documents.")
\ No newline at end of file
+    # Set up data directory
+    data_dir = args.data_dir if args.data_dir else os.getenv("DATA_DIR", "/home/eisape/projects/diversify_lm_output/dolma/data")
+    
+    # Instead of defining a prompt bank, use the centralized one
+    # Print available prompts for reference
+    prompt_bank = get_all_prompts()
+    print("Available prompts:", list(prompt_bank.keys()))
+    
+    # Use the provided prompt if available, otherwise use default
+    prompt_key = args.prompt if args.prompt else "default"
+    
+    # Setup your language model and tokenizer, on CUDA if available
+    model_name = resolve_model_name(args.model)
+    device = default_device()
+    server = connect_from_args(args)
+    if server is not None:
+        # The server holds the model; only the tokenizer is needed here
+        model, tokenizer = None, server.tokenizer
+    else:
+        model, tokenizer = load_model_from_args(args, device)
+        model = apply_cpu_options(args, model, device)
+    assistant = load_assistant_from_args(args, tokenizer, device)
+    scheduler = None
+    if args.scheduler:
+        from scheduler import ContinuousBatchScheduler
+        scheduler = ContinuousBatchScheduler(model, tokenizer, device, max_batch_size=args.batch_size,
+                                             logit_snapshot_k=args.logit_snapshot_k)
+    
+    generate_random_doc_completions(
+        model,
+        tokenizer,
+        model_name,
+        device,
+        prompt_key,
+        data_dir,
+        args.num_completions,
+        args.max_tokens,
+        batch_size=args.batch_size,
+        window=args.window,
+        stream_metrics=args.stream_metrics,
+        resume=args.resume,
+        writer_options={"max_records": args.flush_records, "flush_interval": args.flush_interval, "fsync": args.fsync},
+        token_budget=args.prompt_token_budget,
+        truncation=args.doc_truncation,
+        prefetch=args.prefetch,
+        prefetch_workers=args.prefetch_workers,
+        run_seed=args.seed,
+        assistant=assistant,
+        scheduler=scheduler,
+        use_stop_criteria=not args.no_stop_criteria,
+        token_trace=args.token_trace,
+        logit_snapshot_k=args.logit_snapshot_k,
+        cache=GenerationCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3)) if args.cache_dir else None,
+        engine=args.engine,
+        batch_tuner=batch_tuner_from_args(args, model, device),
+        server=server
+    )
+
+if __name__ == "__main__":
+    main()
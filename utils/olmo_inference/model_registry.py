@@ -0,0 +1,201 @@
+"""
+Registry of the language models used for generation.
+
+All generation scripts load their model through load_model, which picks the
+weights' dtype, loads them with low CPU memory use (memory-mapped safetensors
+placed directly on the target device) and keeps one instance per process, so
+asking for the same model again returns the already loaded one.
+
+When convert_checkpoint.py has written a model in the requested dtype to the
+local checkpoint directory, load_model maps that copy instead of resolving the
+hub checkpoint: its safetensors shards already have the target dtype, so they
+are placed on the device as they are, without an fp32 copy or a cast. With
+measure_startup (--measure_startup), a load also prints the time from process
+start to the first generated token.
+"""
+import os
+import time
+import json
+import importlib.util
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# Language models that can be used for generation
+MODELS = {
+    "olmo-1b": "allenai/OLMo-1B-0724-hf",
+    "olmo-2-1b": "allenai/OLMo-2-0425-1B",
+    "olmo-2-7b": "allenai/OLMo-2-1124-7B",
+    "olmo-2-13b": "allenai/OLMo-2-1124-13B"
+}
+
+DEFAULT_MODEL = "olmo-2-7b"
+
+DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16
+}
+
+# accelerate is needed for low_cpu_mem_usage / device_map loading
+HAS_ACCELERATE = importlib.util.find_spec("accelerate") is not None
+
+# Pre-converted checkpoints, <CHECKPOINT_DIR>/<model id with / as -->/<dtype>/
+CHECKPOINT_DIR = os.environ.get(
+    "OLMO_CHECKPOINT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "olmo_inference", "checkpoints")
+)
+CONVERSION_MANIFEST = "conversion.json"
+
+# Process-level cache of loaded (model, tokenizer) pairs
+_loaded_models = {}
+
+def default_device():
+    """CUDA if available, otherwise CPU."""
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def resolve_model_name(model):
+    """Map a registry key such as "olmo-1b" to its model id; other names are returned as is."""
+    return MODELS.get(model, model)
+
+def converted_checkpoint_path(model, dtype, checkpoint_dir=CHECKPOINT_DIR):
+    """Directory convert_checkpoint.py writes a model in a dtype to."""
+    return os.path.join(checkpoint_dir, resolve_model_name(model).replace("/", "--"), dtype)
+
+def find_converted_checkpoint(model, dtype, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Manifest of a completed conversion of a model to a dtype, or None.
+
+    Returns:
+        dict: The conversion manifest, with the checkpoint directory under "path"
+    """
+    if not checkpoint_dir:
+        return None
+    path = converted_checkpoint_path(model, dtype, checkpoint_dir)
+    try:
+        with open(os.path.join(path, CONVERSION_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return dict(manifest, path=path)
+
+def _process_age():
+    """Seconds since this process started, None where /proc is unavailable."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the parenthesized command name; starttime is field 22
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+def report_startup(lm, tokenizer, device, load_seconds):
+    """Generate one token and print the time to it, from process start and from the start of loading."""
+    start = time.perf_counter()
+    inputs = tokenizer("Hello", return_tensors="pt", return_token_type_ids=False).to(device)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    with torch.no_grad():
+        lm.generate(**inputs, max_new_tokens=1, do_sample=False, pad_token_id=pad_token_id)
+    first_token = time.perf_counter() - start
+    age = _process_age()
+    since_start = f"{age:.1f}s after process start" if age is not None else "startup"
+    print(f"Time to first token: {since_start} (loading {load_seconds:.1f}s, first token {first_token:.2f}s)")
+
+def load_model(model=DEFAULT_MODEL, device=None, dtype="fp32", low_cpu_mem_usage=True, checkpoint_dir=CHECKPOINT_DIR,
+               measure_startup=False):
+    """
+    Load a language model and its tokenizer, or return the instance already loaded
+    in this process.
+
+    Args:
+        model (str): Registry key (see MODELS) or a model id / local path
+        device (str): Device to place the model on, defaults to CUDA if available
+        dtype (str): Weight dtype, one of DTYPES
+        low_cpu_mem_usage (bool): Load the weights straight into the target dtype and
+            device instead of materializing a full fp32 copy first
+        checkpoint_dir (str): Load the copy convert_checkpoint.py wrote here if there is
+            one, None or "" to always load the original checkpoint
+        measure_startup (bool): Generate one token and print the time to it (see report_startup)
+
+    Returns:
+        tuple: (model, tokenizer)
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {list(DTYPES)}, got {dtype!r}")
+    model_name = resolve_model_name(model)
+    device = device or default_device()
+    key = (model_name, str(device), dtype)
+    if key in _loaded_models:
+        return _loaded_models[key]
+
+    start = time.perf_counter()
+    converted = find_converted_checkpoint(model_name, dtype, checkpoint_dir)
+    source = converted["path"] if converted else model_name
+    load_kwargs = {"torch_dtype": DTYPES[dtype]}
+    if converted:
+        load_kwargs["local_files_only"] = True
+    placed = False
+    if low_cpu_mem_usage:
+        if HAS_ACCELERATE:
+            load_kwargs["low_cpu_mem_usage"] = True
+            load_kwargs["device_map"] = device
+            placed = True
+        else:
+            print("accelerate is not installed, loading without low_cpu_mem_usage")
+
+    print(f"Loading {model_name} ({dtype}) on {device}" + (f" from {source}" if converted else ""))
+    lm = AutoModelForCausalLM.from_pretrained(source, **load_kwargs)
+    if not placed:
+        lm = lm.to(device)
+    lm.eval()
+    tokenizer = AutoTokenizer.from_pretrained(source)
+    if converted:
+        # Identify the model as the hub checkpoint it was converted from (model
+        # fingerprints, batch profiles), not as the local directory
+        lm.config.name_or_path = model_name
+        lm.config._commit_hash = converted.get("revision")
+        tokenizer.name_or_path = model_name
+    if measure_startup:
+        report_startup(lm, tokenizer, device, time.perf_counter() - start)
+
+    _loaded_models[key] = (lm, tokenizer)
+    return lm, tokenizer
+
+def load_tokenizer(model=DEFAULT_MODEL, dtype="fp32", checkpoint_dir=CHECKPOINT_DIR):
+    """Tokenizer of a model without its weights (e.g. for a generation_server client)."""
+    model_name = resolve_model_name(model)
+    converted = find_converted_checkpoint(model_name, dtype, checkpoint_dir)
+    if not converted:
+        return AutoTokenizer.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(converted["path"])
+    tokenizer.name_or_path = model_name
+    return tokenizer
+
+def unload_model(model=DEFAULT_MODEL, device=None, dtype="fp32"):
+    """Drop a model from the process cache so its memory can be released."""
+    key = (resolve_model_name(model), str(device or default_device()), dtype)
+    _loaded_models.pop(key, None)
+
+def add_model_arguments(parser):
+    """Add the model loading and --assistant_model options to an argument parser."""
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL,
+                        help=f"Model to generate with: one of {list(MODELS)} or a model id / path")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=list(DTYPES),
+                        help="Dtype of the model weights")
+    parser.add_argument("--no_low_cpu_mem_usage", action="store_true",
+                        help="Materialize the full checkpoint before moving it to the device")
+    parser.add_argument("--checkpoint_dir", type=str, default=CHECKPOINT_DIR,
+                        help="Load models converted by convert_checkpoint.py from here if available ('' to disable)")
+    parser.add_argument("--measure_startup", action="store_true",
+                        help="Print the time from process start to the first generated token after loading")
+    parser.add_argument("--assistant_model", type=str, default=None,
+                        help="Draft model for assisted decoding, e.g. olmo-2-1b (same tokenizer as "
+                             "OLMo-2) or olmo-1b; generates one completion per call")
+    parser.add_argument("--num_assistant_tokens", type=int, default=None,
+                        help="Tokens drafted per round by the assistant model")
+    return parser
+
+def load_model_from_args(args, device=None):
+    """load_model with the options added by add_model_arguments."""
+    return load_model(args.model, device=device, dtype=args.dtype, low_cpu_mem_usage=not args.no_low_cpu_mem_usage,
+                      checkpoint_dir=args.checkpoint_dir, measure_startup=args.measure_startup)
@@ -1,19 +1,16 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
-import torch.nn.functional as F
-import math
+import argparse
+from model_registry import add_model_arguments, default_device, load_model_from_args
+from token_metrics import compute_token_metrics
 
 if __name__ == "__main__":
 
-    MODELS = {
-        "olmo-1b": "allenai/OLMo-1B-0724-hf",
-        "olmo-2-7b": "allenai/OLMo-2-1124-7B",
-        "olmo-2-13b": "allenai/OLMo-2-1124-13B"
-    }
+    parser = argparse.ArgumentParser(description="Sample one completion and print its token-level metrics")
+    add_model_arguments(parser)
+    args = parser.parse_args()
 
-    model_name = MODELS["olmo-2-7b"]
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    # Load the model on CUDA if available
+    device = default_device()
+    model, tokenizer = load_model_from_args(args, device)
 
     prompt = ("A numbered list of 100 new research projects in natural language processing: "
               "1. diversyfying the open source language model output "
@@ -24,10 +21,8 @@ if __name__ == "__main__":
     # Tokenize the prompt
     inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
 
-    # Move model and inputs to CUDA if available
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # Move inputs to the model's device
     inputs = {k: v.to(device) for k, v in inputs.items()}
-    model = model.to(device)
 
     # Generate text with output scores so we can inspect logits for new tokens.
     generation_output = model.generate(
@@ -47,29 +42,15 @@ if __name__ == "__main__":
     # Calculate token-level entropy and token-level perplexity for the newly generated tokens
     prompt_length = inputs["input_ids"].shape[1]
     new_tokens = generation_output.sequences[0][prompt_length:]
-    token_entropies = []
-    token_perplexities = []
-
+    # Compute entropy and perplexity for all generated tokens in one pass
+    metrics = compute_token_metrics(generation_output.scores, new_tokens.unsqueeze(0))
+    token_entropies = metrics["entropy"][0]
+    token_perplexities = metrics["perplexity"][0]
 
     print("Token-level metrics for generated tokens:")
-    for i, score in enumerate(generation_output.scores):
-
-        # Convert logits to probabilities for the current timestep
-        probs = F.softmax(score, dim=-1)
-        # Compute entropy for this token using a categorical distribution (batch size is 1)
-        entropy = torch.distributions.Categorical(probs=probs).entropy()
-        token_entropy = entropy.item()  # scalar value
-
-        # Calculate token perplexity as the exponential of the entropy
-        token_perplexity = math.exp(token_entropy)
-
+    for token_id, token_entropy, token_perplexity in zip(new_tokens.tolist(), token_entropies, token_perplexities):
         # Decode the generated token
-
-        token_id = new_tokens[i].item()
         token_text = tokenizer.decode(token_id)
-
-        token_entropies.append(token_entropy)
-        token_perplexities.append(token_perplexity)
         print(f"Token: {repr(token_text)} | Entropy: {token_entropy:.4f} | Perplexity: {token_perplexity:.4f}")
 
     # Compute and display the average entropy and average perplexity
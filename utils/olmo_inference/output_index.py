@@ -0,0 +1,159 @@
+"""
+Index of the completions already written to a generation output file.
+
+Used to resume an interrupted run: only the completion indices missing from the
+JSONL file are generated again. Records are located with a byte-level match on
+their "completion_idx" field instead of parsing every line as JSON (random-doc
+records carry whole documents), and the scan result is kept in a small
+<output>.idx sidecar so a later resume only reads the bytes appended since.
+The sidecar also records the inode and a hash of the first and last block of the
+scanned bytes, so an output file that was rewritten or hand-edited since is
+scanned again from the start, whatever its new size.
+"""
+import os
+import re
+import json
+import hashlib
+
+# json.dumps writes '"key": value'; inside string values quotes are escaped, so
+# these patterns only ever match the record's own keys
+COMPLETION_IDX_PATTERN = re.compile(rb'"completion_idx": (\d+)')
+COMPLETION_PATTERN = re.compile(rb'"completion_only": "')
+
+# Bytes hashed at either end of the scanned part of the output file
+FINGERPRINT_BLOCK = 1 << 12
+
+def _index_path(output_file):
+    return output_file + ".idx"
+
+def _fingerprint(f, scanned_bytes):
+    """Inode and hash of the first and last block of the first scanned_bytes of f."""
+    digest = hashlib.sha256()
+    f.seek(0)
+    digest.update(f.read(min(scanned_bytes, FINGERPRINT_BLOCK)))
+    f.seek(max(0, scanned_bytes - FINGERPRINT_BLOCK))
+    digest.update(f.read(min(scanned_bytes, FINGERPRINT_BLOCK)))
+    return {"inode": os.fstat(f.fileno()).st_ino, "hash": digest.hexdigest()}
+
+def _load_index(output_file, f, file_size):
+    """Load the sidecar index if it still describes a prefix of the output file."""
+    try:
+        with open(_index_path(output_file), "r") as index_file:
+            index = json.load(index_file)
+    except (OSError, json.JSONDecodeError):
+        return 0, set()
+    scanned_bytes = index.get("scanned_bytes", 0)
+    if scanned_bytes > file_size or index.get("fingerprint") != _fingerprint(f, scanned_bytes):
+        # The output was truncated, rewritten or edited since the last scan
+        return 0, set()
+    return scanned_bytes, set(index.get("indices", []))
+
+def _save_index(output_file, f, scanned_bytes, indices):
+    tmp_path = _index_path(output_file) + ".tmp"
+    with open(tmp_path, "w") as index_file:
+        json.dump({"scanned_bytes": scanned_bytes, "fingerprint": _fingerprint(f, scanned_bytes),
+                   "indices": sorted(indices)}, index_file)
+    os.replace(tmp_path, _index_path(output_file))
+
+def is_valid_record_line(line):
+    """Cheap structural check of one complete JSONL line, without parsing it."""
+    line = line.strip()
+    return (line.startswith(b"{") and line.endswith(b"}")
+            and COMPLETION_IDX_PATTERN.search(line) is not None
+            and COMPLETION_PATTERN.search(line) is not None)
+
+def repair_tail(output_file):
+    """
+    Truncate a torn final record left by an interrupted write.
+
+    A final line without a trailing newline, or whose JSON does not parse, is cut
+    off so that appending resumes on a clean line boundary.
+
+    Returns:
+        int: Number of bytes removed
+    """
+    if not os.path.exists(output_file):
+        return 0
+    size = os.path.getsize(output_file)
+    with open(output_file, "rb+") as f:
+        end = size
+        # Drop a partial last line (no trailing newline)
+        if not _ends_with_newline(f, end):
+            end = _last_line_start(f, end)
+        # Drop a last line that is complete but not valid JSON
+        if end > 0:
+            start = _last_line_start(f, end - 1)
+            f.seek(start)
+            last_line = f.read(end - start)
+            try:
+                json.loads(last_line)
+            except ValueError:
+                end = start
+        if end < size:
+            f.truncate(end)
+    return size - end
+
+def _ends_with_newline(f, end):
+    if end == 0:
+        return True
+    f.seek(end - 1)
+    return f.read(1) == b"\n"
+
+def _last_line_start(f, end, block_size=1 << 16):
+    """Offset just after the last newline before end (0 if there is none)."""
+    position = end
+    while position > 0:
+        read_from = max(0, position - block_size)
+        f.seek(read_from)
+        block = f.read(position - read_from)
+        newline = block.rfind(b"\n")
+        if newline != -1:
+            return read_from + newline + 1
+        position = read_from
+    return 0
+
+def completed_indices(output_file, repair=True):
+    """
+    Return the set of completion indices already written to output_file.
+
+    Args:
+        output_file (str): Path of the JSONL output file
+        repair (bool): Truncate a torn final line before scanning
+
+    Returns:
+        set: Completion indices of complete, valid records
+    """
+    if not os.path.exists(output_file):
+        return set()
+    if repair:
+        removed = repair_tail(output_file)
+        if removed:
+            print(f"Truncated {removed} bytes of a torn final record from {output_file}")
+
+    file_size = os.path.getsize(output_file)
+    with open(output_file, "rb") as f:
+        scanned_bytes, indices = _load_index(output_file, f, file_size)
+        f.seek(scanned_bytes)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            scanned_bytes += len(line)
+            if is_valid_record_line(line):
+                indices.add(int(COMPLETION_IDX_PATTERN.search(line).group(1)))
+        _save_index(output_file, f, scanned_bytes, indices)
+    return indices
+
+def pending_indices(output_file, num_completions, resume):
+    """
+    Completion indices still to generate for a run of num_completions.
+
+    Without resume every index is generated (and appended), as before.
+    """
+    indices = list(range(num_completions))
+    if not resume:
+        return indices
+    completed = completed_indices(output_file)
+    indices = [i for i in indices if i not in completed]
+    print(f"Resuming {output_file}: {num_completions - len(indices)} of {num_completions} completions "
+          f"already written, {len(indices)} to generate")
+    return indices
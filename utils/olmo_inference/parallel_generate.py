@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Data-parallel generation across several worker processes.
+
+The pending completion indices of a prompt key are split across N workers. Each
+worker is pinned to its own device (a GPU, or a disjoint set of CPU cores with a
+matching torch thread count), loads its own copy of the model and writes its
+records to a shard file next to the output file. Once the workers are done the
+shards are merged into the canonical output file in completion_idx order, so the
+result looks like a single-process run. Like a single-process --resume, a resumed
+run appends its records after the existing ones: the file is then in order within
+each run, not as a whole.
+
+Shards left behind by an interrupted run are merged before the pending indices
+are computed, so --resume never regenerates completions that reached a shard.
+"""
+
+import os
+import sys
+import glob
+import heapq
+import argparse
+import multiprocessing
+import torch
+
+# Add the parent directory to sys.path to import prompt_store
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prompt_store import get_all_prompts
+from assisted_decoding import AssistedDecoding
+from batch_tuner import add_batch_tuner_arguments
+from cpu_inference import add_cpu_arguments
+from model_registry import add_model_arguments, load_model, resolve_model_name
+from output_index import COMPLETION_IDX_PATTERN, is_valid_record_line, pending_indices, repair_tail
+from logit_snapshots import merge_snapshots
+from token_trace import merge_traces
+
+OUTPUT_SUFFIXES = {
+    "normal": "normal_prompt_output.jsonl",
+    "random": "random_prompt_output.jsonl"
+}
+
+def output_path(prompt_key, mode):
+    """Canonical output file of a prompt key, as written by the single-process scripts."""
+    output_dir = f"completions_eval_store/{prompt_key}"
+    os.makedirs(output_dir, exist_ok=True)
+    return f"{output_dir}/{prompt_key}_{OUTPUT_SUFFIXES[mode]}"
+
+def shard_path(output_file, worker_id):
+    return f"{output_file}.shard{worker_id}"
+
+def split_indices(indices, num_workers):
+    """Split indices into num_workers contiguous, near-equal chunks (empty chunks dropped)."""
+    chunk, extra = divmod(len(indices), num_workers)
+    chunks = []
+    start = 0
+    for worker_id in range(num_workers):
+        end = start + chunk + (1 if worker_id < extra else 0)
+        if end > start:
+            chunks.append(indices[start:end])
+        start = end
+    return chunks
+
+def worker_devices(num_workers, devices=None):
+    """
+    Device of every worker: the given devices round-robin, otherwise one CUDA device
+    per worker if available and CPU for all of them if not.
+    """
+    if not devices:
+        if torch.cuda.is_available():
+            devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        else:
+            devices = ["cpu"]
+    return [devices[worker_id % len(devices)] for worker_id in range(num_workers)]
+
+def cpu_core_sets(num_workers, threads_per_worker=0):
+    """
+    Disjoint CPU core sets for the CPU workers.
+
+    Args:
+        threads_per_worker (int): Cores per worker, 0 to share the available cores
+            evenly; lowered to an even share if the workers would not fit otherwise
+
+    Returns:
+        list: One list of core ids per worker
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if num_workers > len(cores):
+        raise ValueError(f"{num_workers} CPU workers need at least as many cores, only {len(cores)} are available")
+    per_worker = len(cores) // num_workers
+    if threads_per_worker > per_worker:
+        print(f"{num_workers} workers x {threads_per_worker} threads exceed the {len(cores)} available cores, "
+              f"using {per_worker} threads per worker")
+    elif threads_per_worker:
+        per_worker = threads_per_worker
+    return [cores[worker_id * per_worker:(worker_id + 1) * per_worker] for worker_id in range(num_workers)]
+
+def _line_index(line):
+    return int(COMPLETION_IDX_PATTERN.search(line).group(1))
+
+def _shard_records(shard_file):
+    """Yield the valid record lines of a shard file as bytes."""
+    with open(shard_file, "rb") as f:
+        for line in f:
+            if line.endswith(b"\n") and is_valid_record_line(line):
+                yield line
+
+def merge_shards(output_file, shard_files):
+    """
+    Append the records of the shard files to output_file in completion_idx order,
+    append their token traces and logit snapshots to its own, and delete the shards.
+
+    Only the appended records are ordered: records already in output_file (from
+    an earlier run being resumed) are left where they are.
+
+    Every worker writes its indices in increasing order, so the shards are merged
+    with a streaming k-way merge on the raw lines; records are never parsed.
+
+    Returns:
+        int: Number of records merged
+    """
+    shard_files = [shard_file for shard_file in shard_files if os.path.exists(shard_file)]
+    if not shard_files:
+        return 0
+    for shard_file in shard_files:
+        repair_tail(shard_file)
+
+    merged = 0
+    with open(output_file, "ab") as out:
+        for line in heapq.merge(*(_shard_records(shard_file) for shard_file in shard_files), key=_line_index):
+            out.write(line)
+            merged += 1
+        out.flush()
+        os.fsync(out.fileno())
+    merge_traces(output_file, shard_files)
+    merge_snapshots(output_file, shard_files)
+
+    for shard_file in shard_files:
+        os.remove(shard_file)
+        if os.path.exists(shard_file + ".idx"):
+            os.remove(shard_file + ".idx")
+    print(f"Merged {merged} records from {len(shard_files)} shards into {output_file}")
+    return merged
+
+def _run_worker(worker_id, device, cores, options, completion_indices, shard_file):
+    """Entry point of a worker process: pin it, load the model and generate its share."""
+    if cores:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    print(f"[worker {worker_id}] {len(completion_indices)} completions on {device}"
+          + (f" with {len(cores)} threads" if cores else ""))
+
+    model, tokenizer = load_model(options["model"], device=device, dtype=options["dtype"],
+                                  low_cpu_mem_usage=options["low_cpu_mem_usage"],
+                                  checkpoint_dir=options["checkpoint_dir"], measure_startup=options["measure_startup"])
+    model_name = resolve_model_name(options["model"])
+    if options["cpu_optimized"] and device == "cpu":
+        from cpu_inference import configure_cpu_threads, optimize_for_cpu
+        # One thread per physical core of the worker's core set
+        num_threads = configure_cpu_threads(options["num_threads"])
+        model, precision = optimize_for_cpu(model, options["cpu_precision"])
+        print(f"[worker {worker_id}] {precision} linear layers, {num_threads} intra-op threads")
+    assistant = None
+    if options["assistant_model"]:
+        assistant_model, assistant_tokenizer = load_model(options["assistant_model"], device=device, dtype=options["dtype"],
+                                                          low_cpu_mem_usage=options["low_cpu_mem_usage"],
+                                                          checkpoint_dir=options["checkpoint_dir"])
+        assistant = AssistedDecoding(assistant_model, assistant_tokenizer, tokenizer, options["num_assistant_tokens"])
+    common = {
+        "batch_size": options["batch_size"],
+        "stream_metrics": options["stream_metrics"],
+        "writer_options": options["writer_options"],
+        "completion_indices": completion_indices,
+        "output_file": shard_file,
+        "run_seed": options["run_seed"],
+        "assistant": assistant,
+        "use_stop_criteria": options["use_stop_criteria"],
+        "token_trace": options["token_trace"],
+        "logit_snapshot_k": options["logit_snapshot_k"],
+        "engine": options["engine"]
+    }
+    if options["auto_batch_size"]:
+        from batch_tuner import BatchSizeTuner
+        # Workers sharing a device split its memory
+        common["batch_tuner"] = BatchSizeTuner(
+            model, device, profile_path=options["batch_profile"], max_batch_size=options["max_batch_size"],
+            keep_scores=not options["stream_metrics"] and options["engine"] == "generate",
+            memory_fraction=0.9 / options["workers_per_device"]
+        )
+    if options["cache_dir"]:
+        from generation_cache import GenerationCache
+        common["cache"] = GenerationCache(options["cache_dir"], options["cache_max_bytes"])
+    if options["scheduler"]:
+        from scheduler import ContinuousBatchScheduler
+        common["scheduler"] = ContinuousBatchScheduler(model, tokenizer, device, max_batch_size=options["batch_size"],
+                                                       logit_snapshot_k=options["logit_snapshot_k"])
+    if options["mode"] == "normal":
+        from many_normal_prompt import generate_normal_completions
+        from prefix_cache import PromptCache
+        generate_normal_completions(
+            model, tokenizer, model_name, device, options["prompt_key"], options["num_completions"],
+            options["max_tokens"], prompt_cache=PromptCache() if options["prompt_cache"] else None, **common
+        )
+    else:
+        from many_random_doc import generate_random_doc_completions
+        generate_random_doc_completions(
+            model, tokenizer, model_name, device, options["prompt_key"], options["data_dir"],
+            options["num_completions"], options["max_tokens"], window=options["window"],
+            prefetch=options["prefetch"], prefetch_workers=options["prefetch_workers"],
+            token_budget=options["token_budget"], truncation=options["truncation"], **common
+        )
+
+def generate_parallel(options, num_workers, devices=None, threads_per_worker=0, resume=False):
+    """
+    Generate the completions of one prompt key with num_workers processes.
+
+    Args:
+        options (dict): Generation options (see main) passed to every worker
+        num_workers (int): Number of worker processes
+        devices (list): Devices assigned round-robin to the workers
+        threads_per_worker (int): CPU cores per CPU worker, 0 to share them evenly
+        resume (bool): Only generate the completion indices missing from the output file
+
+    Returns:
+        tuple: (output file, list of ids of workers that failed)
+    """
+    output_file = output_path(options["prompt_key"], options["mode"])
+
+    # Fold in whatever an interrupted run left in its shards
+    merge_shards(output_file, glob.glob(glob.escape(output_file) + ".shard*[0-9]"))
+
+    indices = pending_indices(output_file, options["num_completions"], resume)
+    if not indices:
+        print(f"Nothing to generate for {options['prompt_key']}")
+        return output_file, []
+    chunks = split_indices(indices, num_workers)
+    worker_device_list = worker_devices(len(chunks), devices)
+    cpu_workers = [worker_id for worker_id, device in enumerate(worker_device_list) if device == "cpu"]
+    core_sets = dict(zip(cpu_workers, cpu_core_sets(len(cpu_workers), threads_per_worker))) if cpu_workers else {}
+
+    # spawn: CUDA cannot be used in forked children
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for worker_id, chunk in enumerate(chunks):
+        process = context.Process(
+            target=_run_worker,
+            args=(worker_id, worker_device_list[worker_id], core_sets.get(worker_id),
+                  dict(options, workers_per_device=worker_device_list.count(worker_device_list[worker_id])), chunk,
+                  shard_path(output_file, worker_id)),
+            name=f"generate-worker-{worker_id}"
+        )
+        process.start()
+        workers.append(process)
+
+    failed = []
+    for worker_id, process in enumerate(workers):
+        process.join()
+        if process.exitcode != 0:
+            print(f"[worker {worker_id}] exited with code {process.exitcode}")
+            failed.append(worker_id)
+
+    # Merge even if some workers failed; their finished records are kept and a
+    # --resume run generates the rest
+    merge_shards(output_file, [shard_path(output_file, worker_id) for worker_id in range(len(chunks))])
+    return output_file, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate completions with several worker processes")
+    parser.add_argument("--mode", type=str, default="normal", choices=list(OUTPUT_SUFFIXES),
+                        help="normal prompts (many_normal_prompt) or random documents (many_random_doc)")
+    parser.add_argument("--prompt", type=str, help="Key of the prompt to use for generation")
+    parser.add_argument("--data_dir", type=str, default="/home/eisape/projects/diversify_lm_output/dolma/data",
+                        help="Directory containing data files")
+    parser.add_argument("--num_completions", type=int, default=300,
+                        help="Number of completions to generate")
+    parser.add_argument("--max_tokens", type=int, default=500,
+                        help="Maximum number of tokens to generate")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of worker processes (default: one per CUDA device, 1 on CPU)")
+    parser.add_argument("--devices", type=str, nargs="+", default=None,
+                        help="Devices assigned round-robin to the workers, e.g. cuda:0 cuda:1 or cpu")
+    parser.add_argument("--threads_per_worker", type=int, default=0,
+                        help="CPU cores (and torch threads) per CPU worker (default: share the cores evenly)")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Completions (normal) or prompts per length bucket (random) per generate call")
+    parser.add_argument("--window", type=int, default=0,
+                        help="Random mode: documents sampled ahead and bucketed together")
+    parser.add_argument("--stream_metrics", action="store_true",
+                        help="Compute token metrics during generation instead of keeping output scores")
+    parser.add_argument("--prompt_cache", action="store_true",
+                        help="Normal mode: prefill the prompt once per worker and reuse its KV cache")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Random mode: prompts sampled and tokenized ahead on background threads")
+    parser.add_argument("--prefetch_workers", type=int, default=1,
+                        help="Random mode: number of background threads for prefetching")
+    parser.add_argument("--prompt_token_budget", type=int, default=None,
+                        help="Random mode: maximum prompt length in tokens")
+    parser.add_argument("--doc_truncation", type=str, default="head", choices=["head", "tail", "random"],
+                        help="Random mode: part of the document kept when it is truncated")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only generate the completion indices missing from the output file")
+    parser.add_argument("--flush_records", type=int, default=32,
+                        help="Write buffered records to the shard files once this many are queued")
+    parser.add_argument("--flush_interval", type=float, default=5.0,
+                        help="Write buffered records to the shard files at least this often (seconds)")
+    parser.add_argument("--fsync", type=str, default="never", choices=["never", "batch", "close"],
+                        help="When to fsync the shard files")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="Continuous batching in every worker, --batch_size slots")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Run seed; with it every completion is the same whichever worker generates it")
+    parser.add_argument("--no_stop_criteria", action="store_true",
+                        help="Only stop at EOS or max_tokens, ignoring each prompt's stop criteria")
+    parser.add_argument("--token_trace", action="store_true",
+                        help="Write token ids, entropies and log-probs to a binary sidecar of the output file")
+    parser.add_argument("--logit_snapshot_k", type=int, default=0,
+                        help="Store the top-k tokens and log-probs of every step's raw distribution next to the output file (0: off)")
+    parser.add_argument("--engine", type=str, default="generate", choices=["generate", "lean"],
+                        help="Decode loop: model.generate or the lean loop of decode_engine (sampling only)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Reuse completions generated before with the same model, prompt, parameters and --seed from this cache (shared by the workers)")
+    parser.add_argument("--cache_max_gb", type=float, default=10.0,
+                        help="Evict least recently used cache entries beyond this size")
+    add_model_arguments(parser)
+    add_batch_tuner_arguments(parser)
+    add_cpu_arguments(parser)
+    args = parser.parse_args()
+
+    prompt_key = args.prompt if args.prompt else "default"
+    # get_prompt falls back to the default prompt, so check the key before starting any worker
+    if prompt_key not in get_all_prompts():
+        parser.error(f"unknown prompt key {prompt_key!r}, available: {list(get_all_prompts())}")
+
+    num_workers = args.num_workers
+    if num_workers <= 0:
+        num_workers = len(args.devices) if args.devices else max(1, torch.cuda.device_count())
+
+    options = {
+        "mode": args.mode,
+        "prompt_key": prompt_key,
+        "data_dir": args.data_dir,
+        "num_completions": args.num_completions,
+        "max_tokens": args.max_tokens,
+        "batch_size": args.batch_size,
+        "window": args.window,
+        "stream_metrics": args.stream_metrics,
+        "prompt_cache": args.prompt_cache,
+        "prefetch": args.prefetch,
+        "prefetch_workers": args.prefetch_workers,
+        "token_budget": args.prompt_token_budget,
+        "truncation": args.doc_truncation,
+        "measure_startup": args.measure_startup,
+        "writer_options": {"max_records": args.flush_records, "flush_interval": args.flush_interval, "fsync": args.fsync},
+        "run_seed": args.seed,
+        "scheduler": args.scheduler,
+        "use_stop_criteria": not args.no_stop_criteria,
+        "token_trace": args.token_trace,
+        "logit_snapshot_k": args.logit_snapshot_k,
+        "engine": args.engine,
+        "auto_batch_size": args.auto_batch_size,
+        "max_batch_size": args.max_batch_size,
+        "batch_profile": args.batch_profile,
+        "cpu_optimized": args.cpu_optimized,
+        "cpu_precision": args.cpu_precision,
+        "num_threads": args.num_threads,
+        "cache_dir": args.cache_dir,
+        "cache_max_bytes": int(args.cache_max_gb * 1024 ** 3),
+        "model": args.model,
+        "dtype": args.dtype,
+        "checkpoint_dir": args.checkpoint_dir,
+        "low_cpu_mem_usage": not args.no_low_cpu_mem_usage,
+        "assistant_model": args.assistant_model,
+        "num_assistant_tokens": args.num_assistant_tokens
+    }
+    output_file, failed = generate_parallel(options, num_workers, devices=args.devices,
+                                            threads_per_worker=args.threads_per_worker, resume=args.resume)
+    if failed:
+        print(f"\nWorkers {failed} failed; rerun with --resume to generate their missing completions")
+        sys.exit(1)
+    print(f"\nCompleted parallel generation into {output_file}")
+
+if __name__ == "__main__":
+    main()
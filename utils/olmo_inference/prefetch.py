@@ -0,0 +1,86 @@
+"""
+Background prefetching of generation inputs.
+
+Sampling a random document means gunzipping a whole shard, and the combined prompt
+then has to be tokenized; done inline, the model sits idle for both. The Prefetcher
+runs that work on a thread pool a bounded number of items ahead of the generation
+loop. gzip, the tokenizers library and torch all release the GIL for their heavy
+lifting, so threads are enough to overlap the work with decoding.
+"""
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher:
+    """
+    Iterate over (item, produce(item)) in item order, with up to depth results being
+    produced ahead of the consumer.
+
+    Counters tell which side is the bottleneck:
+        consumer_wait_seconds: time the generation loop waited for an input that
+            was not ready yet (the sampler is too slow)
+        ready_depth_total / items: average number of inputs already waiting when the
+            loop asked for the next one (close to depth means the model is too slow)
+    """
+    def __init__(self, produce, items, depth=4, num_workers=1):
+        self.produce = produce
+        self.items = iter(items)
+        self.depth = max(1, depth)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix="prefetch")
+        self.pending = deque()
+        self.items_consumed = 0
+        self.consumer_wait_seconds = 0.0
+        self.ready_depth_total = 0
+        self.full_count = 0
+
+    def _fill(self):
+        while len(self.pending) < self.depth:
+            try:
+                item = next(self.items)
+            except StopIteration:
+                return
+            self.pending.append((item, self.executor.submit(self.produce, item)))
+
+    def __iter__(self):
+        try:
+            self._fill()
+            while self.pending:
+                ready = sum(1 for _, future in self.pending if future.done())
+                self.ready_depth_total += ready
+                if ready == self.depth:
+                    self.full_count += 1
+
+                item, future = self.pending.popleft()
+                start = time.perf_counter()
+                result = future.result()
+                self.consumer_wait_seconds += time.perf_counter() - start
+                self.items_consumed += 1
+
+                # Keep the pipeline topped up while the caller uses this result
+                self._fill()
+                yield item, result
+        finally:
+            self.close()
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        """Return the prefetch counters as a dict."""
+        items = max(self.items_consumed, 1)
+        return {
+            "items": self.items_consumed,
+            "depth": self.depth,
+            "avg_ready_depth": self.ready_depth_total / items,
+            "full_fraction": self.full_count / items,
+            "consumer_wait_seconds": self.consumer_wait_seconds
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f"Prefetch: {stats['items']} items, avg ready depth {stats['avg_ready_depth']:.2f}/{stats['depth']}, "
+              f"queue full {stats['full_fraction']:.0%} of the time, "
+              f"generation waited {stats['consumer_wait_seconds']:.2f}s on inputs")
@@ -0,0 +1,83 @@
+"""
+Reuse of the prompt's prefill KV cache across completions.
+
+The normal-prompt runs complete the exact same prompt hundreds of times, so the
+prompt is tokenized and prefilled once per (model, prompt) and every generate call
+starts from a copy of that cache, paying only for the decode phase.
+"""
+import copy
+import torch
+import transformers
+from packaging import version
+from transformers import DynamicCache
+
+# transformers 4.56 moved the cache tensors into per-layer objects (cache.layers)
+# and 5.0 removed the legacy tuple conversions; older versions only have those
+LAYERED_CACHE = version.parse(transformers.__version__) >= version.parse("4.56")
+
+class PromptCache:
+    """
+    Prefill past_key_values keyed by (model, prompt).
+
+    Everything but the last prompt token is prefilled: generate needs at least one
+    uncached input token to produce the first next-token distribution.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, model, tokenizer, prompt, device):
+        """
+        Return the tokenized prompt and its prefill cache, computing them on first use.
+
+        Returns:
+            tuple: (inputs dict on device, past_key_values or None for one-token prompts)
+        """
+        key = (id(model), prompt)
+        if key not in self._entries:
+            inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            past_key_values = None
+            if inputs["input_ids"].shape[1] > 1:
+                with torch.no_grad():
+                    output = model(
+                        input_ids=inputs["input_ids"][:, :-1],
+                        attention_mask=inputs["attention_mask"][:, :-1],
+                        use_cache=True
+                    )
+                past_key_values = output.past_key_values
+            # Keep a reference to the model so its id cannot be reused by another one
+            self._entries[key] = (model, inputs, past_key_values)
+        _, inputs, past_key_values = self._entries[key]
+        return inputs, past_key_values
+
+    def clear(self):
+        self._entries.clear()
+
+def cache_layers(past_key_values):
+    """(key, value) tensors of every layer of a cache, [batch, heads, length, head_dim] each."""
+    if isinstance(past_key_values, (tuple, list)):
+        return [(layer[0], layer[1]) for layer in past_key_values]
+    if LAYERED_CACHE:
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    return [(key, value) for key, value in past_key_values.to_legacy_cache()]
+
+def cache_from_layers(layers):
+    """DynamicCache holding (key, value) tensors per layer; the inverse of cache_layers."""
+    if LAYERED_CACHE:
+        return DynamicCache(layers)
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+def expand_cache(past_key_values, batch_size):
+    """
+    Copy a batch-1 prefill cache for one generate call over batch_size rows.
+
+    generate and decode_engine.lean_generate extend the cache in place, so the stored
+    one is never handed out directly. The copy is always a DynamicCache: a legacy
+    tuple cache is converted, as lean_generate needs the Cache API.
+    """
+    cache = copy.deepcopy(past_key_values)
+    if not hasattr(cache, "get_seq_length"):
+        cache = cache_from_layers(cache_layers(cache))
+    if batch_size > 1:
+        cache.batch_repeat_interleave(batch_size)
+    return cache
@@ -0,0 +1,89 @@
+"""
+Token-budgeted assembly of random-document prompts.
+
+Sampled Dolma documents can be far longer than the instruction that follows them,
+which either overflows the model context or lets prefill dominate the run time.
+The document is tokenized once, cut down to a window that leaves room for the
+newline and instruction within the budget, and the character span of the document
+actually used is returned so it can be stored with the record.
+"""
+import random
+
+TRUNCATION_MODES = ("head", "tail", "random")
+
+def _token_window(num_tokens, keep, truncation, rng):
+    """Start and end token index of the kept part of the document."""
+    if keep >= num_tokens:
+        return 0, num_tokens
+    if truncation == "head":
+        return 0, keep
+    if truncation == "tail":
+        return num_tokens - keep, num_tokens
+    start = rng.randint(0, num_tokens - keep)
+    return start, start + keep
+
+def build_random_doc_prompt(tokenizer, doc, instruction, token_budget=None, truncation="head", rng=random):
+    """
+    Build "<document>\\n<instruction>" so that it fits within token_budget tokens.
+
+    Args:
+        tokenizer: A fast tokenizer (offset mappings are needed to map tokens back to text)
+        doc (str): The sampled document, may be empty
+        instruction (str): The prompt from the prompt store
+        token_budget (int): Maximum prompt length in tokens, None for no limit
+        truncation (str): Which part of the document to keep: "head", "tail" or "random"
+        rng (random.Random): Source of randomness for "random" truncation
+
+    Returns:
+        dict: prompt, prompt_token_ids, doc_span ([start, end] characters of doc used),
+            doc_tokens_used and doc_tokens_total (None without a budget, the document
+            is then not tokenized on its own)
+    """
+    if truncation not in TRUNCATION_MODES:
+        raise ValueError(f"truncation must be one of {TRUNCATION_MODES}, got {truncation!r}")
+
+    if not doc or token_budget is None:
+        prompt = doc + "\n" + instruction if doc else instruction
+        return {
+            "prompt": prompt,
+            "prompt_token_ids": tokenizer(prompt, return_token_type_ids=False)["input_ids"],
+            "doc_span": [0, len(doc)],
+            "doc_tokens_used": None,
+            "doc_tokens_total": None
+        }
+
+    doc_encoding = tokenizer(doc, add_special_tokens=False, return_offsets_mapping=True, return_token_type_ids=False)
+    offsets = doc_encoding["offset_mapping"]
+    num_doc_tokens = len(offsets)
+
+    suffix_tokens = len(tokenizer("\n" + instruction, add_special_tokens=False)["input_ids"])
+    special_tokens = len(tokenizer("", return_token_type_ids=False)["input_ids"])
+    keep = max(0, min(num_doc_tokens, token_budget - suffix_tokens - special_tokens))
+    start, end = _token_window(num_doc_tokens, keep, truncation, rng)
+
+    while True:
+        # Offsets may leave out surrounding whitespace, so a window touching either
+        # end of the document keeps the document's own start or end
+        doc_span = [
+            0 if start == 0 else offsets[start][0],
+            len(doc) if end == num_doc_tokens else offsets[end - 1][1]
+        ] if end > start else [0, 0]
+        prompt = doc[doc_span[0]:doc_span[1]] + "\n" + instruction if end > start else instruction
+        prompt_token_ids = tokenizer(prompt, return_token_type_ids=False)["input_ids"]
+        overflow = len(prompt_token_ids) - token_budget
+        if overflow <= 0 or end <= start:
+            break
+        # Tokens can merge differently at the document/instruction boundary;
+        # shrink the window by the overflow and try again
+        if truncation == "tail":
+            start = min(end, start + overflow)
+        else:
+            end = max(start, end - overflow)
+
+    return {
+        "prompt": prompt,
+        "prompt_token_ids": prompt_token_ids,
+        "doc_span": doc_span,
+        "doc_tokens_used": end - start,
+        "doc_tokens_total": num_doc_tokens
+    }
@@ -3,10 +3,9 @@ import gzip
 import json
 import glob
 import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
-import torch.nn.functional as F
-import math
+import argparse
+from model_registry import add_model_arguments, default_device, load_model_from_args
+from token_metrics import compute_token_metrics
 
 def get_sample_text(data_dir):
     """
@@ -39,6 +38,10 @@ def get_sample_text(data_dir):
     return record.get("text", "")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sample one completion conditioned on a random document")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+    
     # Set up data directory; change as needed
     data_dir = os.getenv("DATA_DIR", "/home/eisape/projects/diversify_lm_output/dolma/data")
     
@@ -63,22 +66,14 @@ if __name__ == "__main__":
     print("Combined prompt:\n", prompt)
     
     # Setup your language model and tokenizer
-    MODELS = {
-        "olmo-1b": "allenai/OLMo-1B-0724-hf",
-        "olmo-2-7b": "allenai/OLMo-2-1124-7B",
-        "olmo-2-13b": "allenai/OLMo-2-1124-13B"
-    }
-    model_name = MODELS["olmo-2-7b"]
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    device = default_device()
+    model, tokenizer = load_model_from_args(args, device)
 
     # Tokenize the prompt
     inputs = tokenizer(prompt, return_tensors='pt', return_token_type_ids=False)
 
-    # Move model and inputs to CUDA if available
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # Move inputs to the model's device
     inputs = {k: v.to(device) for k, v in inputs.items()}
-    model = model.to(device)
 
     # Generate text with output scores
     generation_output = model.generate(
@@ -98,22 +93,14 @@ if __name__ == "__main__":
     # Calculate token-level metrics for the newly generated tokens
     prompt_length = inputs["input_ids"].shape[1]
     new_tokens = generation_output.sequences[0][prompt_length:]
-    token_entropies = []
-    token_perplexities = []
+    # Compute entropy and perplexity for all generated tokens in one pass
+    metrics = compute_token_metrics(generation_output.scores, new_tokens.unsqueeze(0))
+    token_entropies = metrics["entropy"][0]
+    token_perplexities = metrics["perplexity"][0]
 
     print("Token-level metrics for generated tokens:")
-    for i, score in enumerate(generation_output.scores):
-        # Convert logits to probabilities for the current timestep
-        probs = F.softmax(score, dim=-1)
-        # Compute entropy for this token
-        entropy = torch.distributions.Categorical(probs=probs).entropy()
-        token_entropy = entropy.item()
-        token_perplexity = math.exp(token_entropy)
-
-        token_id = new_tokens[i].item()
+    for token_id, token_entropy, token_perplexity in zip(new_tokens.tolist(), token_entropies, token_perplexities):
         token_text = tokenizer.decode(token_id)
-        token_entropies.append(token_entropy)
-        token_perplexities.append(token_perplexity)
         print(f"Token: {repr(token_text)} | Entropy: {token_entropy:.4f} | Perplexity: {token_perplexity:.4f}")
 
     avg_entropy = sum(token_entropies) / len(token_entropies) if token_entropies else 0.0
@@ -1,42 +1,162 @@
 #!/usr/bin/env python3
 """
 Script to run inference with normal prompts for all entries in the prompt store.
-This runs the many_normal_prompt.py script for each prompt key in sequence.
+By default the model is loaded once and every prompt key is run in this process;
+with --subprocess the many_normal_prompt.py script is run for each prompt key in sequence.
 """
 
 import os
 import sys
 import subprocess
 import argparse
+import traceback
+import torch
 
 # Add the parent directory to sys.path to import prompt_store
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from prompt_store import get_all_prompts
+from many_normal_prompt import ENGINES, generate_normal_completions, generate_scheduled_completions, normal_output_file
+from output_index import completed_indices, pending_indices
+from assisted_decoding import load_assistant_from_args
+from model_registry import add_model_arguments, default_device, load_model_from_args, resolve_model_name
+from batch_tuner import add_batch_tuner_arguments, batch_tuner_from_args
+from cpu_inference import add_cpu_arguments, apply_cpu_options
+from generation_cache import GenerationCache
+from generation_server import add_server_arguments, connect_from_args, server_conflicts
+from prefix_cache import PromptCache
 
-def main():
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Run normal prompt inference for all prompts in the prompt store")
-    parser.add_argument("--num_completions", type=int, default=30, 
-                        help="Number of completions to generate per prompt (default: 30)")
-    parser.add_argument("--max_tokens", type=int, default=500,
-                        help="Maximum number of tokens to generate (default: 500)")
-    parser.add_argument("--data_dir", type=str, 
-                        default="/home/eisape/projects/diversify_lm_output/dolma/data", 
-                        help="Directory containing data files")
-    parser.add_argument("--skip", type=str, nargs='+', default=[],
-                        help="List of prompt keys to skip")
-    args = parser.parse_args()
+def check_options(parser, args):
+    """Reject option combinations that a generation path would ignore or fail on, before any model is loaded."""
+    if args.scheduler:
+        # The scheduler runs its own decode loop with --batch_size slots
+        ignored = [flag for flag, given in {
+            "--assistant_model": args.assistant_model,
+            "--prompt_cache": args.prompt_cache,
+            "--engine lean": args.engine != "generate",
+            "--auto_batch_size": args.auto_batch_size
+        }.items() if given]
+        if ignored:
+            parser.error(f"--scheduler cannot be combined with {', '.join(ignored)}")
+    conflicts = server_conflicts(args)
+    if conflicts:
+        parser.error(f"--server cannot be combined with {', '.join(conflicts)}")
+
+def run_in_process(args, prompt_keys):
+    """Load the model once and generate the completions for every prompt key in this process."""
+    model_name = resolve_model_name(args.model)
+    device = default_device()
+    server = connect_from_args(args)
+    if server is not None:
+        # The server holds the model; only the tokenizer is needed here
+        model, tokenizer = None, server.tokenizer
+    else:
+        model, tokenizer = load_model_from_args(args, device)
+        model = apply_cpu_options(args, model, device)
+    assistant = load_assistant_from_args(args, tokenizer, device)
+    prompt_cache = PromptCache() if args.prompt_cache else None
+    cache = GenerationCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3)) if args.cache_dir else None
+    batch_tuner = batch_tuner_from_args(args, model, device)
+    if args.scheduler:
+        return run_scheduled(args, prompt_keys, model, tokenizer, model_name, device, cache)
     
-    # Get all prompts from the prompt store
-    prompt_bank = get_all_prompts()
-    prompt_keys = list(prompt_bank.keys())
+    failed = []
+    for i, prompt_key in enumerate(prompt_keys):
+        if prompt_key in args.skip:
+            print(f"Skipping prompt: {prompt_key}")
+            continue
+        
+        print(f"\n[{i+1}/{len(prompt_keys)}] Running inference for prompt: {prompt_key}")
+        try:
+            generate_normal_completions(
+                model,
+                tokenizer,
+                model_name,
+                device,
+                prompt_key,
+                args.num_completions,
+                args.max_tokens,
+                batch_size=args.batch_size,
+                stream_metrics=args.stream_metrics,
+                prompt_cache=prompt_cache,
+                resume=args.resume,
+                run_seed=args.seed,
+                assistant=assistant,
+                use_stop_criteria=not args.no_stop_criteria,
+                token_trace=args.token_trace,
+                logit_snapshot_k=args.logit_snapshot_k,
+                cache=cache,
+                engine=args.engine,
+                batch_tuner=batch_tuner,
+                server=server
+            )
+            print(f"Completed inference for prompt: {prompt_key}")
+        except Exception as e:
+            # Keep going with the remaining prompt keys
+            print(f"Error running inference for prompt: {prompt_key}")
+            print(f"Error: {e}")
+            traceback.print_exc()
+            failed.append(prompt_key)
+            # Release whatever the failed prompt left allocated before the next one
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    return failed
+
+def run_scheduled(args, prompt_keys, model, tokenizer, model_name, device, cache=None):
+    """
+    Generate every prompt key through one continuous-batching scheduler, mixing the keys in its batch.
+
+    If the mixed run fails, every key is retried through the scheduler on its own,
+    with the completion indices the mixed run did not write, so one failing key
+    does not cost the others their completions.
+    """
+    from scheduler import ContinuousBatchScheduler
+    scheduler = ContinuousBatchScheduler(model, tokenizer, device, max_batch_size=args.batch_size,
+                                         logit_snapshot_k=args.logit_snapshot_k)
+    jobs = []
+    completed_before = {}
+    for prompt_key in prompt_keys:
+        if prompt_key in args.skip:
+            print(f"Skipping prompt: {prompt_key}")
+            continue
+        output_file = normal_output_file(prompt_key)
+        jobs.append((prompt_key, output_file, pending_indices(output_file, args.num_completions, args.resume)))
+        completed_before[prompt_key] = completed_indices(output_file)
     
-    print(f"Found {len(prompt_keys)} prompts in the prompt store: {prompt_keys}")
-    print(f"Will skip: {args.skip}")
+    def generate(jobs):
+        generate_scheduled_completions(scheduler, model_name, jobs, args.max_tokens, run_seed=args.seed,
+                                       use_stop_criteria=not args.no_stop_criteria, token_trace=args.token_trace,
+                                       cache=cache)
     
-    # Create the output directory structure
-    os.makedirs("completions_eval_store", exist_ok=True)
+    try:
+        generate(jobs)
+        return []
+    except Exception as e:
+        print(f"Error running scheduled inference: {e}")
+        traceback.print_exc()
     
+    failed = []
+    for prompt_key, output_file, indices in jobs:
+        written = completed_indices(output_file) - completed_before[prompt_key]
+        remaining = [completion_idx for completion_idx in indices if completion_idx not in written]
+        if not remaining:
+            continue
+        print(f"\nRetrying prompt {prompt_key} on its own: {len(remaining)} completions")
+        try:
+            generate([(prompt_key, output_file, remaining)])
+            print(f"Completed inference for prompt: {prompt_key}")
+        except Exception as e:
+            # Keep going with the remaining prompt keys
+            print(f"Error running inference for prompt: {prompt_key}")
+            print(f"Error: {e}")
+            traceback.print_exc()
+            failed.append(prompt_key)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    return failed
+
+def run_in_subprocesses(args, prompt_keys):
+    """Run many_normal_prompt.py once per prompt key, each in a fresh python process."""
+    failed = []
     # Run many_normal_prompt.py for each prompt key
     for i, prompt_key in enumerate(prompt_keys):
         if prompt_key in args.skip:
@@ -55,8 +175,43 @@ def main():
             "--prompt", prompt_key,
             "--num_completions", str(args.num_completions),
             "--max_tokens", str(args.max_tokens),
-            "--data_dir", args.data_dir
+            "--data_dir", args.data_dir,
+            "--batch_size", str(args.batch_size)
         ]
+        if args.stream_metrics:
+            cmd.append("--stream_metrics")
+        if args.prompt_cache:
+            cmd.append("--prompt_cache")
+        if args.resume:
+            cmd.append("--resume")
+        if args.scheduler:
+            cmd.append("--scheduler")
+        if args.seed is not None:
+            cmd.extend(["--seed", str(args.seed)])
+        if args.no_stop_criteria:
+            cmd.append("--no_stop_criteria")
+        if args.token_trace:
+            cmd.append("--token_trace")
+        if args.logit_snapshot_k:
+            cmd.extend(["--logit_snapshot_k", str(args.logit_snapshot_k)])
+        if args.engine != "generate":
+            cmd.extend(["--engine", args.engine])
+        if args.auto_batch_size:
+            cmd.extend(["--auto_batch_size", "--max_batch_size", str(args.max_batch_size),
+                        "--batch_profile", args.batch_profile])
+        if args.cpu_optimized:
+            cmd.extend(["--cpu_optimized", "--cpu_precision", args.cpu_precision, "--num_threads", str(args.num_threads)])
+        if args.cache_dir:
+            cmd.extend(["--cache_dir", args.cache_dir, "--cache_max_gb", str(args.cache_max_gb)])
+        if args.server:
+            cmd.extend(["--server", args.server])
+        cmd.extend(["--model", args.model, "--dtype", args.dtype, "--checkpoint_dir", args.checkpoint_dir])
+        if args.no_low_cpu_mem_usage:
+            cmd.append("--no_low_cpu_mem_usage")
+        if args.assistant_model:
+            cmd.extend(["--assistant_model", args.assistant_model])
+        if args.num_assistant_tokens is not None:
+            cmd.extend(["--num_assistant_tokens", str(args.num_assistant_tokens)])
         
         # Run the command
         print(f"Executing: {' '.join(cmd)}")
@@ -66,7 +221,72 @@ def main():
         except subprocess.CalledProcessError as e:
             print(f"Error running inference for prompt: {prompt_key}")
             print(f"Error: {e}")
+            failed.append(prompt_key)
+    
+    return failed
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Run normal prompt inference for all prompts in the prompt store")
+    parser.add_argument("--num_completions", type=int, default=30, 
+                        help="Number of completions to generate per prompt (default: 30)")
+    parser.add_argument("--max_tokens", type=int, default=500,
+                        help="Maximum number of tokens to generate (default: 500)")
+    parser.add_argument("--data_dir", type=str, 
+                        default="/home/eisape/projects/diversify_lm_output/dolma/data", 
+                        help="Directory containing data files")
+    parser.add_argument("--skip", type=str, nargs='+', default=[],
+                        help="List of prompt keys to skip")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of completions to sample per generate call")
+    parser.add_argument("--stream_metrics", action="store_true",
+                        help="Compute token metrics during generation instead of keeping output scores")
+    parser.add_argument("--prompt_cache", action="store_true",
+                        help="Prefill each prompt once and reuse its KV cache for every completion")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only generate the completion indices missing from each output file")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="Run each prompt key in its own python process (reloads the model every time unless --server is given)")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="Continuous batching over all prompt keys at once, --batch_size slots")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Run seed from which every completion's seeds are derived")
+    parser.add_argument("--no_stop_criteria", action="store_true",
+                        help="Only stop at EOS or max_tokens, ignoring each prompt's stop criteria")
+    parser.add_argument("--token_trace", action="store_true",
+                        help="Write token ids, entropies and log-probs to a binary sidecar of each output file")
+    parser.add_argument("--logit_snapshot_k", type=int, default=0,
+                        help="Store the top-k tokens and log-probs of every step's raw distribution next to each output file (0: off)")
+    parser.add_argument("--engine", type=str, default="generate", choices=ENGINES,
+                        help="Decode loop: model.generate or the lean loop of decode_engine (sampling only)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Reuse completions generated before with the same model, prompt, parameters and --seed from this cache")
+    parser.add_argument("--cache_max_gb", type=float, default=10.0,
+                        help="Evict least recently used cache entries beyond this size")
+    add_model_arguments(parser)
+    add_batch_tuner_arguments(parser)
+    add_cpu_arguments(parser)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    check_options(parser, args)
+    
+    # Get all prompts from the prompt store
+    prompt_bank = get_all_prompts()
+    prompt_keys = list(prompt_bank.keys())
+    
+    print(f"Found {len(prompt_keys)} prompts in the prompt store: {prompt_keys}")
+    print(f"Will skip: {args.skip}")
+    
+    # Create the output directory structure
+    os.makedirs("completions_eval_store", exist_ok=True)
+    
+    if args.subprocess:
+        failed = run_in_subprocesses(args, prompt_keys)
+    else:
+        failed = run_in_process(args, prompt_keys)
     
+    if failed:
+        print(f"\nInference failed for prompts: {failed}")
     print("\nCompleted inference for all prompts!")
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+"""
+Top-k/top-p sampling outside of generate().
+
+Used by decode loops that call the model step by step. The filters mirror the
+TopKLogitsWarper and TopPLogitsWarper that generate applies, so a completion
+sampled here follows the same distribution, and its token metrics are computed
+on the same filtered scores. sample_with_metrics does all of it on the top-k
+candidates only.
+"""
+import torch
+import torch.nn.functional as F
+from token_metrics import entropy_from_log_probs
+
+def top_k_top_p_filter(scores, top_k=50, top_p=0.95):
+    """
+    Set the scores of tokens outside the top-k / nucleus to -inf.
+
+    Args:
+        scores (torch.Tensor): Logits of shape [batch, vocab]
+        top_k (int): Keep the top_k highest scoring tokens, 0 or None to disable
+        top_p (float): Keep the smallest set of tokens whose probability reaches top_p,
+            1.0 or None to disable
+
+    Returns:
+        torch.Tensor: Filtered scores (a new tensor)
+    """
+    if top_k:
+        top_k = min(top_k, scores.shape[-1])
+        kth_score = torch.topk(scores, top_k)[0][..., -1, None]
+        scores = scores.masked_fill(scores < kth_score, float("-inf"))
+    if top_p is not None and top_p < 1.0:
+        sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p)
+        # Always keep the most likely token
+        sorted_to_remove[..., -1:] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        scores = scores.masked_fill(to_remove, float("-inf"))
+    return scores
+
+def seeded_choice(scores, generators):
+    """
+    Sample one token per row by inverting the CDF at a uniform drawn from that row's
+    CPU generator, so the draw is the same on every device.
+
+    Args:
+        scores (torch.Tensor): Filtered logits of shape [batch, vocab]
+        generators (list): One torch.Generator per row
+
+    Returns:
+        torch.Tensor: Token ids of shape [batch, 1]
+    """
+    uniforms = torch.cat([torch.rand(1, generator=generator) for generator in generators])
+    cdf = torch.softmax(scores.float(), dim=-1).cumsum(dim=-1)
+    uniforms = uniforms.to(cdf.device).unsqueeze(1) * cdf[:, -1:]
+    return torch.searchsorted(cdf, uniforms, right=True).clamp_(max=scores.shape[-1] - 1)
+
+def sample_next_tokens(scores, generators=None):
+    """
+    Sample the next token of every row from its filtered scores.
+
+    Args:
+        scores (torch.Tensor): Filtered logits of shape [batch, vocab]
+        generators (list): Optional per-row torch.Generator (None entries use the
+            global RNG), see seeded_choice
+
+    Returns:
+        torch.Tensor: Token ids of shape [batch]
+    """
+    if generators is None or all(generator is None for generator in generators):
+        return torch.multinomial(torch.softmax(scores.float(), dim=-1), num_samples=1).squeeze(1)
+    tokens = torch.empty(scores.shape[0], dtype=torch.long, device=scores.device)
+    seeded = [row for row, generator in enumerate(generators) if generator is not None]
+    unseeded = [row for row, generator in enumerate(generators) if generator is None]
+    seeded_rows = torch.tensor(seeded, device=scores.device)
+    tokens[seeded_rows] = seeded_choice(scores[seeded_rows], [generators[row] for row in seeded]).squeeze(1)
+    if unseeded:
+        unseeded_rows = torch.tensor(unseeded, device=scores.device)
+        probs = torch.softmax(scores[unseeded_rows].float(), dim=-1)
+        tokens[unseeded_rows] = torch.multinomial(probs, num_samples=1).squeeze(1)
+    return tokens
+
+def sample_with_metrics(logits, top_k=50, top_p=0.95, generators=None):
+    """
+    Top-k/top-p filtering, sampling, entropy and chosen-token log-prob in one pass.
+
+    Only the top_k candidates are sorted and normalized instead of the whole
+    vocabulary: tokens outside the top-k have zero probability after filtering, so
+    the nucleus, the entropy and the sampled distribution are the same as with
+    top_k_top_p_filter followed by sample_next_tokens and step_metrics.
+
+    Args:
+        logits (torch.Tensor): Raw logits of shape [batch, vocab]
+        top_k (int): Number of candidates, 0 or None for the whole vocabulary
+        top_p (float): Nucleus threshold, 1.0 or None to disable
+        generators (list): Optional per-row torch.Generator, see sample_next_tokens
+
+    Returns:
+        tuple: (tokens, entropy, chosen_log_prob), each of shape [batch], still on device
+    """
+    logits = logits.float()
+    if top_k:
+        values, ids = torch.topk(logits, min(top_k, logits.shape[-1]))
+    else:
+        values, ids = torch.sort(logits, descending=True)
+    if top_p is not None and top_p < 1.0:
+        # Mass of every candidate and all less likely ones: the ascending cumsum of
+        # TopPLogitsWarper, on candidates sorted in descending order
+        tail_mass = torch.softmax(values, dim=-1).flip(-1).cumsum(dim=-1).flip(-1)
+        to_remove = tail_mass <= (1 - top_p)
+        # Always keep the most likely token
+        to_remove[..., 0] = False
+        values = values.masked_fill(to_remove, float("-inf"))
+    log_probs = F.log_softmax(values, dim=-1)
+    entropy = entropy_from_log_probs(log_probs)
+    # Candidates in vocabulary order, so a seeded row draws the same token as
+    # seeded_choice over the full filtered vocabulary
+    order = ids.argsort(dim=-1)
+    ids = ids.gather(-1, order)
+    log_probs = log_probs.gather(-1, order)
+    choice = sample_next_tokens(log_probs, generators).unsqueeze(-1)
+    return ids.gather(-1, choice).squeeze(-1), entropy, log_probs.gather(-1, choice).squeeze(-1)
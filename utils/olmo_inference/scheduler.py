@@ -0,0 +1,344 @@
+"""
+Continuous-batching generation scheduler.
+
+generate() runs a static batch: a haiku that ends after 30 tokens keeps its row
+until the longest completion in the batch reaches max_new_tokens. The scheduler
+instead runs its own step-level decode loop over up to max_batch_size sequences.
+A sequence is retired as soon as it emits EOS, reaches its token limit or its
+stop check fires, and the next pending request is prefilled and admitted into
+the freed slot before the next step.
+
+The running batch keeps one left-padded KV cache. Admitted prompts are prefilled
+together, their caches are left-padded to the running cache's width and
+concatenated along the batch, and rows are dropped from it when their sequence
+retires, together with the leading columns no remaining row still uses. Every
+row has its own position ids, so rows of different lengths decode together.
+
+Sampling uses the same top-k/top-p filtering as generate and the same per-row
+seeded generators as SeededSampler, and the token metrics of every sequence are
+recorded on the filtered scores as they are produced.
+"""
+import time
+import inspect
+import itertools
+import numpy as np
+import torch
+from logit_snapshots import snapshot_dtype, snapshot_rows, snapshot_step
+from many_normal_prompt import encode_prompts
+from prefix_cache import cache_from_layers, cache_layers
+from sampling import sample_next_tokens, top_k_top_p_filter
+from token_metrics import eos_token_ids, step_metrics, summarize_tokens
+
+class GenerationRequest:
+    """
+    One completion to generate.
+
+    Args:
+        key: Identifies the request in the results, e.g. (prompt_key, completion_idx)
+        prompt (str): The prompt to complete
+        max_new_tokens (int): Maximum number of tokens to generate
+        prompt_token_ids (list): Already tokenized prompt
+        seed (int): Token sampling seed, None for the global RNG
+        stop (StopChecker): Stop criteria checked after every step; the sequence is
+            retired with the criterion's name as stop reason once one is met
+    """
+    def __init__(self, key, prompt, max_new_tokens=500, prompt_token_ids=None, seed=None, stop=None):
+        self.key = key
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.prompt_token_ids = prompt_token_ids
+        self.seed = seed
+        self.stop = stop
+
+class _Sequence:
+    """Decode state and per-token bookkeeping of one admitted request."""
+    def __init__(self, request, prompt_token_ids):
+        self.request = request
+        self.prompt_token_ids = prompt_token_ids
+        self.token_ids = []
+        self.entropies = []
+        self.perplexities = []
+        self.logprobs = []
+        self.snapshots = []
+        self.generator = None if request.seed is None else torch.Generator().manual_seed(request.seed)
+        self.stop_state = None if request.stop is None else request.stop.start()
+
+def _pad_left(tensor, width, dim):
+    missing = width - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class ContinuousBatchScheduler:
+    """
+    Generate completions for a stream of GenerationRequests, keeping up to
+    max_batch_size of them decoding at any time.
+
+    Args:
+        model: Causal LM
+        tokenizer: Its tokenizer
+        device (str): Device of the model
+        max_batch_size (int): Number of sequences decoded together
+        top_k (int): Top-k filtering, as in generate
+        top_p (float): Nucleus filtering, as in generate
+        logit_snapshot_k (int): Snapshot the top logit_snapshot_k tokens of every step's
+            raw distribution, as run_batched_inference does; 0 to disable
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=8, top_k=50, top_p=0.95, logit_snapshot_k=0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max(1, max_batch_size)
+        self.top_k = top_k
+        self.top_p = top_p
+        self.logit_snapshot_k = logit_snapshot_k
+        self.eos_ids = eos_token_ids(model, tokenizer)
+        # Only the last prompt position's logits are needed from a prefill
+        parameters = inspect.signature(model.forward).parameters
+        self._logits_to_keep = next((name for name in ("logits_to_keep", "num_logits_to_keep") if name in parameters), None)
+        self._reset_batch()
+        self.reset_stats()
+
+    def _reset_batch(self):
+        self.sequences = []
+        self.layers = None
+        self.attention_mask = None
+        self.positions = None
+        self.next_tokens = None
+
+    def reset_stats(self):
+        self.steps = 0
+        self.prefills = 0
+        self.prefill_tokens = 0
+        self.generated_tokens = 0
+        self.occupied_slots = 0
+        self.completed = 0
+        self.seconds = 0.0
+
+    def run(self, requests):
+        """
+        Generate every request, admitting new ones whenever slots free up.
+
+        Args:
+            requests (iterable): GenerationRequests, consumed lazily
+
+        Yields:
+            tuple: (request, result) in the order the sequences finish; result has the
+                fields of run_batched_inference's results
+        """
+        pending = iter(requests)
+        exhausted = False
+        start = time.perf_counter()
+        try:
+            while True:
+                free = self.max_batch_size - len(self.sequences)
+                if free > 0 and not exhausted:
+                    admitted = list(itertools.islice(pending, free))
+                    exhausted = len(admitted) < free
+                    if admitted:
+                        yield from self._admit(admitted)
+                if not self.sequences:
+                    if exhausted:
+                        break
+                    continue
+                yield from self._step()
+        finally:
+            self.seconds += time.perf_counter() - start
+            self._reset_batch()
+
+    def _forward(self, input_ids, attention_mask, position_ids, past_key_values=None, last_only=False):
+        kwargs = {}
+        if last_only and self._logits_to_keep:
+            kwargs[self._logits_to_keep] = 1
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+                **kwargs
+            )
+        # generate samples from float32 logits as well
+        return output.logits[:, -1].float(), cache_layers(output.past_key_values)
+
+    def _admit(self, requests):
+        """Prefill the new requests, sample their first token and merge them into the batch."""
+        prompt_token_ids = [
+            request.prompt_token_ids if request.prompt_token_ids is not None
+            else self.tokenizer(request.prompt, return_token_type_ids=False)["input_ids"]
+            for request in requests
+        ]
+        inputs = encode_prompts(self.tokenizer, None, self.device, prompt_token_ids)
+        attention_mask = inputs["attention_mask"]
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        logits, layers = self._forward(inputs["input_ids"], attention_mask, position_ids, last_only=True)
+        self.prefills += 1
+        self.prefill_tokens += sum(len(ids) for ids in prompt_token_ids)
+
+        sequences = [_Sequence(request, ids) for request, ids in zip(requests, prompt_token_ids)]
+        next_tokens, keep, finished = self._sample(sequences, logits)
+        yield from finished
+
+        keep_rows = [row for row, kept in enumerate(keep) if kept]
+        if not keep_rows:
+            return
+        rows = torch.tensor(keep_rows, device=attention_mask.device)
+        new_mask = attention_mask[rows]
+        new_layers = [(key[rows], value[rows]) for key, value in layers]
+        new_positions = torch.tensor([len(prompt_token_ids[row]) for row in keep_rows], device=attention_mask.device)
+        new_sequences = [sequences[row] for row in keep_rows]
+
+        if not self.sequences:
+            self.sequences = new_sequences
+            self.layers = new_layers
+            self.attention_mask = new_mask
+            self.positions = new_positions
+            self.next_tokens = next_tokens[rows]
+            return
+
+        # Left-pad the narrower cache so the two can be stacked along the batch
+        width = max(self.attention_mask.shape[1], new_mask.shape[1])
+        self.attention_mask = torch.cat([_pad_left(self.attention_mask, width, 1), _pad_left(new_mask, width, 1)])
+        self.layers = [
+            (torch.cat([_pad_left(key, width, 2), _pad_left(new_key, width, 2)]),
+             torch.cat([_pad_left(value, width, 2), _pad_left(new_value, width, 2)]))
+            for (key, value), (new_key, new_value) in zip(self.layers, new_layers)
+        ]
+        self.positions = torch.cat([self.positions, new_positions])
+        self.next_tokens = torch.cat([self.next_tokens, next_tokens[rows]])
+        self.sequences.extend(new_sequences)
+
+    def _step(self):
+        """Feed every running sequence its last sampled token and sample the next one."""
+        attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.sequences), 1))], dim=1)
+        logits, self.layers = self._forward(
+            self.next_tokens.unsqueeze(1),
+            attention_mask,
+            self.positions.unsqueeze(1),
+            past_key_values=cache_from_layers(self.layers)
+        )
+        self.attention_mask = attention_mask
+        self.positions = self.positions + 1
+        self.steps += 1
+        self.occupied_slots += len(self.sequences)
+
+        self.next_tokens, keep, finished = self._sample(self.sequences, logits)
+        yield from finished
+        if not all(keep):
+            self._retire(keep)
+
+    def _sample(self, sequences, logits):
+        """
+        Sample the next token of every sequence, record its metrics and check whether
+        the sequence is done.
+
+        Returns:
+            tuple: (next tokens on device, keep flag per sequence, list of finished
+                (request, result) pairs)
+        """
+        scores = top_k_top_p_filter(logits, self.top_k, self.top_p)
+        tokens = sample_next_tokens(scores, [sequence.generator for sequence in sequences])
+        entropy, log_prob = step_metrics(scores, tokens)
+        # One device -> host transfer per step
+        host = torch.stack([tokens.to(entropy.dtype), entropy, entropy.exp(), log_prob]).cpu().tolist()
+        snapshots = [None] * len(sequences)
+        if self.logit_snapshot_k:
+            snapshots = snapshot_rows(self.logit_snapshot_k, tokens, *snapshot_step(logits, tokens, self.logit_snapshot_k))
+        self.generated_tokens += len(sequences)
+
+        keep = []
+        finished = []
+        for sequence, snapshot, token_id, token_entropy, token_perplexity, token_logprob in zip(sequences, snapshots, *host):
+            request = sequence.request
+            sequence.token_ids.append(int(token_id))
+            sequence.entropies.append(token_entropy)
+            sequence.perplexities.append(token_perplexity)
+            sequence.logprobs.append(token_logprob)
+            if snapshot is not None:
+                sequence.snapshots.append(snapshot)
+            stop_reason = None
+            if int(token_id) in self.eos_ids:
+                stop_reason = "eos"
+            elif len(sequence.token_ids) >= request.max_new_tokens:
+                stop_reason = "length"
+            elif sequence.stop_state is not None:
+                stop_reason = sequence.stop_state.update([int(token_id)])
+            keep.append(stop_reason is None)
+            if stop_reason is not None:
+                self.completed += 1
+                finished.append((request, self._result(sequence, stop_reason)))
+        return tokens, keep, finished
+
+    def _retire(self, keep):
+        """Drop the finished rows and the leading cache columns no remaining row uses."""
+        keep_rows = [row for row, kept in enumerate(keep) if kept]
+        if not keep_rows:
+            self._reset_batch()
+            return
+        rows = torch.tensor(keep_rows, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[rows]
+        first_column = int(attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = attention_mask[:, first_column:]
+        self.layers = [(key[rows, :, first_column:], value[rows, :, first_column:]) for key, value in self.layers]
+        self.positions = self.positions[rows]
+        self.next_tokens = self.next_tokens[rows]
+        self.sequences = [self.sequences[row] for row in keep_rows]
+
+    def _result(self, sequence, stop_reason):
+        """Result dict of a finished sequence, in the run_batched_inference format."""
+        generated_text = self.tokenizer.decode(sequence.prompt_token_ids + sequence.token_ids, skip_special_tokens=True)
+        token_details, avg_entropy, avg_perplexity = summarize_tokens(
+            self.tokenizer, sequence.token_ids, sequence.entropies, sequence.perplexities
+        )
+        result = {
+            "full_output": generated_text,
+            "completion_only": generated_text[len(sequence.request.prompt):].strip(),
+            "avg_token_entropy": avg_entropy,
+            "avg_token_perplexity": avg_perplexity,
+            "token_details": token_details,
+            "token_ids": sequence.token_ids,
+            "token_logprobs": sequence.logprobs,
+            "stop_reason": stop_reason
+        }
+        if self.logit_snapshot_k:
+            result["logit_snapshot"] = np.array(sequence.snapshots, dtype=snapshot_dtype(self.logit_snapshot_k))
+        return result
+
+    def stats(self):
+        """Throughput and slot occupancy since the last reset_stats."""
+        return {
+            "completed": self.completed,
+            "generated_tokens": self.generated_tokens,
+            "prefills": self.prefills,
+            "prefill_tokens": self.prefill_tokens,
+            "decode_steps": self.steps,
+            "avg_occupancy": self.occupied_slots / (self.steps * self.max_batch_size) if self.steps else 0.0,
+            "seconds": self.seconds,
+            "tokens_per_second": self.generated_tokens / self.seconds if self.seconds > 0 else 0.0
+        }
+
+    def report(self, label=""):
+        stats = self.stats()
+        print(f"Scheduler{' ' + label if label else ''}: {stats['completed']} completions, "
+              f"{stats['generated_tokens']} tokens in {stats['seconds']:.2f}s "
+              f"({stats['tokens_per_second']:.1f} tokens/s), {stats['decode_steps']} decode steps at "
+              f"{stats['avg_occupancy']:.0%} slot occupancy, {stats['prefills']} prefills")
+
+def in_completion_order(results, order):
+    """
+    Re-order (request, result) pairs coming out of ContinuousBatchScheduler.run so
+    that they are yielded in the given order of request keys; results that finish
+    early wait until every earlier key is done.
+    """
+    order = list(order)
+    position = {key: i for i, key in enumerate(order)}
+    waiting = {}
+    next_position = 0
+    for request, result in results:
+        waiting[position[request.key]] = (request, result)
+        while next_position in waiting:
+            yield waiting.pop(next_position)
+            next_position += 1
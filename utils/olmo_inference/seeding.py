@@ -0,0 +1,67 @@
+"""
+Per-completion deterministic seeding.
+
+Every completion derives its own seeds from the run seed and its completion_idx,
+one per purpose ("doc" for sampling the random document, "sample" for token
+sampling), so a completion does not depend on which other completions were
+generated before it, in the same batch or on the same worker. Any subset of
+indices can be regenerated in any order by passing the same run seed.
+
+Token sampling uses one CPU torch.Generator per batch row: the uniform draw is
+the same on every device, and only the logits themselves have to agree. They
+do for the same model, dtype and device; across different batch shapes or
+hardware, float differences can still flip a token whose probability mass sits
+right at the drawn value.
+"""
+import random
+import hashlib
+import torch
+from transformers import LogitsProcessor
+from sampling import seeded_choice
+
+def completion_seed(run_seed, completion_idx, purpose):
+    """
+    Seed for one purpose of one completion.
+
+    Args:
+        run_seed (int): Seed of the whole run
+        completion_idx (int): Index of the completion
+        purpose (str): What the seed is used for, e.g. "doc" or "sample"
+
+    Returns:
+        int: A 63-bit seed
+    """
+    digest = hashlib.sha256(f"{run_seed}:{completion_idx}:{purpose}".encode()).digest()
+    return int.from_bytes(digest[:8], "little") & ((1 << 63) - 1)
+
+def completion_rng(run_seed, completion_idx, purpose):
+    """A random.Random seeded for one purpose of one completion."""
+    return random.Random(completion_seed(run_seed, completion_idx, purpose))
+
+def completion_seeds(run_seed, completion_idx, purposes=("doc", "sample")):
+    """The run seed and the <purpose>_seed fields of a completion, as stored in its output record."""
+    seeds = {"run_seed": run_seed}
+    for purpose in purposes:
+        seeds[f"{purpose}_seed"] = completion_seed(run_seed, completion_idx, purpose)
+    return seeds
+
+class SeededSampler(LogitsProcessor):
+    """
+    Sample the next token of every row from its own generator.
+
+    Runs last in the logits processor list, after the top-k/top-p warpers. The
+    chosen token keeps its score and every other token is set to -inf, so the
+    sampling generate does afterwards can only pick the token chosen here.
+
+    Args:
+        seeds (list): One seed per batch row
+    """
+    def __init__(self, seeds):
+        self.generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    def __call__(self, input_ids, scores):
+        if scores.shape[0] != len(self.generators):
+            raise ValueError(f"SeededSampler has {len(self.generators)} seeds for a batch of {scores.shape[0]} rows")
+        chosen = seeded_choice(scores, self.generators)
+        sampled = torch.full_like(scores, float("-inf"))
+        return sampled.scatter_(1, chosen, scores.gather(1, chosen))
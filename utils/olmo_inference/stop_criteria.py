@@ -0,0 +1,207 @@
+"""
+Per-prompt stop criteria.
+
+generate() only stops at EOS or max_new_tokens, so a haiku or a "500-word story"
+keeps decoding long after the answer is complete. The criteria of a prompt (see
+prompt_store.get_stop_criteria) are checked on the decoded completion after every
+step, decoding and scanning only the text added by the step, and a row stops as
+soon as one of them is met. Which criterion stopped a
+completion is recorded as its stop_reason: the criterion name, "eos" or "length".
+"""
+import re
+import torch
+from transformers import StoppingCriteria
+
+# How far past its word budget a completion may run looking for a sentence end
+WORD_BUDGET_SLACK = 1.25
+
+# Sentence punctuation, optionally followed by closing quotes/brackets, at the end of the text
+SENTENCE_END_PATTERN = re.compile(r"[.!?][\"')\]]*\s*$")
+
+# Start of a numbered list item: "12. " or "12) " at the start of a line
+LIST_ITEM_PATTERN = re.compile(r"^\s*(\d{1,3})[.)]\s", re.MULTILINE)
+
+# Characters before the end of the text a sentence end (punctuation and closing
+# quotes/brackets) is looked for in
+SENTENCE_END_LOOKBACK = 16
+
+def count_list_items(text, count=0):
+    """
+    Length of the numbered list a text ends in.
+
+    Only consecutive numbering counts: an item numbered count + 1 extends the list,
+    an item numbered 1 starts a new one and any other number (e.g. a year that
+    happens to start a line) is ignored.
+
+    Args:
+        text (str): Text to scan for list items at line starts
+        count (int): Items of the list running at the start of text
+
+    Returns:
+        int: Items of the list running at the end of text
+    """
+    for number in LIST_ITEM_PATTERN.findall(text):
+        number = int(number)
+        if number == count + 1:
+            count = number
+        elif number == 1:
+            count = 1
+    return count
+
+class StopChecker:
+    """
+    Check completions against the stop criteria of their prompt.
+
+    Args:
+        tokenizer: Tokenizer used to decode the completions
+        criteria (dict): Stop criteria, see prompt_store.STOP_CRITERIA
+    """
+    def __init__(self, tokenizer, criteria):
+        self.tokenizer = tokenizer
+        self.stop_strings = criteria.get("stop_strings", [])
+        self.max_lines = criteria.get("max_lines")
+        self.max_list_items = criteria.get("max_list_items")
+        # The completion of a prompt ending on "3. " goes on with item 4
+        self.list_items_in_prompt = criteria.get("list_items_in_prompt", 0)
+        self.word_budget = criteria.get("word_budget")
+        self.longest_stop_string = max((len(stop_string) for stop_string in self.stop_strings), default=0)
+
+    def start(self):
+        """StopState of a new completion, to be fed its tokens as they are generated."""
+        return StopState(self)
+
+    def check(self, token_ids):
+        """
+        Args:
+            token_ids (list): Token ids of a completion (without the prompt)
+
+        Returns:
+            str: Name of the criterion that is met, or None to keep generating
+        """
+        return self.start().update(token_ids)
+
+class StopState:
+    """
+    Stop check of one growing completion.
+
+    Every update costs time proportional to the new tokens, not to the whole
+    completion: only the new tokens are decoded (with the tokens of the previous
+    update as context, so spaces and multi-byte characters split across tokens
+    come out as in a full decode), and the line, list item and word counts of the
+    text already seen are kept.
+
+    Args:
+        checker (StopChecker): The criteria to check
+    """
+    def __init__(self, checker):
+        self.checker = checker
+        self.token_ids = []
+        self.text = ""
+        # Tokens before read_offset are in text; decoding starts at prefix_offset
+        self._prefix_offset = 0
+        self._read_offset = 0
+        # Counts over the text before line_start (complete lines) and before
+        # word_boundary (a whitespace character)
+        self._line_start = 0
+        self._complete_lines = 0
+        self._list_items = checker.list_items_in_prompt
+        self._word_boundary = 0
+        self._words = 0
+
+    def update(self, token_ids):
+        """
+        Args:
+            token_ids (list): Token ids generated since the last update
+
+        Returns:
+            str: Name of the criterion that is met, or None to keep generating
+        """
+        self.token_ids.extend(token_ids)
+        decode = self.checker.tokenizer.decode
+        prefix_text = decode(self.token_ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        new_text = decode(self.token_ids[self._prefix_offset:], skip_special_tokens=True)
+        # Wait for the rest of a character whose bytes span several tokens
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return None
+        start = len(self.text)
+        self.text += new_text[len(prefix_text):]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.token_ids)
+        return self._check(start)
+
+    def _check(self, start):
+        """Criteria met by the text, of which text[start:] is new."""
+        checker = self.checker
+        text = self.text
+        if checker.stop_strings:
+            # Only occurrences overlapping the new text have not been seen before
+            window = text[max(0, start - checker.longest_stop_string + 1):]
+            if any(stop_string in window for stop_string in checker.stop_strings):
+                return "stop_string"
+        line_end = text.rfind("\n", start)
+        if line_end >= 0:
+            complete = text[self._line_start:line_end + 1]
+            self._complete_lines += sum(1 for line in complete.split("\n") if line.strip())
+            self._list_items = count_list_items(complete, self._list_items)
+            self._line_start = line_end + 1
+        if checker.max_lines:
+            # Only lines that have been ended count, the last one may still be growing
+            if self._complete_lines >= checker.max_lines:
+                return "max_lines"
+        if checker.max_list_items:
+            if count_list_items(text[self._line_start:], self._list_items) > checker.max_list_items:
+                return "max_list_items"
+        if checker.word_budget:
+            for i in range(len(text) - 1, max(start, self._word_boundary) - 1, -1):
+                if text[i].isspace():
+                    self._words += len(text[self._word_boundary:i].split())
+                    self._word_boundary = i
+                    break
+            num_words = self._words + len(text[self._word_boundary:].split())
+            if num_words >= checker.word_budget * WORD_BUDGET_SLACK:
+                return "word_budget"
+            if num_words >= checker.word_budget:
+                end = len(text)
+                while end > 0 and text[end - 1].isspace():
+                    end -= 1
+                if SENTENCE_END_PATTERN.search(text, max(0, end - SENTENCE_END_LOOKBACK)):
+                    return "word_budget"
+        return None
+
+class PromptStopCriteria(StoppingCriteria):
+    """
+    StoppingCriteria for generate() applying a StopChecker to every row.
+
+    Rows keep the first reason they stopped for, and stop_lengths holds the number
+    of tokens they had generated by then: generate pads a stopped row until the
+    whole batch is done, and with a pad token distinct from EOS the padding cannot
+    be told apart from generated tokens otherwise.
+
+    Args:
+        tokenizer: Tokenizer used to decode the completions
+        criteria (dict): Stop criteria, see prompt_store.STOP_CRITERIA
+        prompt_length (int): Length of the (padded) prompt in input_ids
+    """
+    def __init__(self, tokenizer, criteria, prompt_length):
+        self.checker = StopChecker(tokenizer, criteria)
+        self.prompt_length = prompt_length
+        self.stop_reasons = {}
+        self.stop_lengths = {}
+        self._states = {}
+        self._checked_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # One device -> host transfer per step for the whole batch, of the new tokens only
+        new_tokens = input_ids[:, self._checked_length:].tolist()
+        self._checked_length = input_ids.shape[1]
+        is_done = []
+        for row, row_tokens in enumerate(new_tokens):
+            if row not in self.stop_reasons:
+                if row not in self._states:
+                    self._states[row] = self.checker.start()
+                reason = self._states[row].update(row_tokens)
+                if reason is not None:
+                    self.stop_reasons[row] = reason
+                    self.stop_lengths[row] = input_ids.shape[1] - self.prompt_length
+            is_done.append(row in self.stop_reasons)
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,23 @@
+"""
+The scripts import their sibling modules by name, as when run from
+utils/olmo_inference; the prompt store lives one directory up.
+"""
+import os
+import sys
+import pytest
+
+OLMO_INFERENCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(OLMO_INFERENCE_DIR))
+sys.path.insert(0, OLMO_INFERENCE_DIR)
+
+@pytest.fixture(scope="session")
+def byte_tokenizer():
+    """Byte-level fast tokenizer without merges (one token per byte), as in benchmark.build_tiny_tokenizer."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    vocab = {symbol: i for i, symbol in enumerate(pre_tokenizers.ByteLevel.alphabet())}
+    vocab["<|endoftext|>"] = len(vocab)
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<|endoftext|>", pad_token="<|endoftext|>")
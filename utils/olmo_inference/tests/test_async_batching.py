@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+
+pytest.importorskip("torch")
+
+import async_batching
+from async_batching import AsyncBatcher
+
+class StubGenerate:
+    """Stands in for run_batched_inference: records every batch and echoes its prompts."""
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, model, tokenizer, prompts, device, seeds=None, prompt_token_ids=None, **kwargs):
+        self.batches.append({"prompts": list(prompts), "seeds": seeds, "kwargs": kwargs})
+        if self.error is not None:
+            raise self.error
+        return [{"completion_only": prompt.upper(), "seed": None if seeds is None else seeds[i],
+                 "prompt_tokens": len(prompt_token_ids[i])} for i, prompt in enumerate(prompts)]
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubGenerate()
+    monkeypatch.setattr(async_batching, "run_batched_inference", stub)
+    return stub
+
+def run(batcher, calls):
+    async def main():
+        try:
+            return await asyncio.gather(*(batcher.generate_async(prompt, params) for prompt, params in calls),
+                                        return_exceptions=True)
+        finally:
+            await batcher.close()
+    return asyncio.run(main())
+
+def test_concurrent_calls_share_one_batch(stub, byte_tokenizer):
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", batch_window=0.1)
+    calls = [(prompt, {"seed": i, "max_new_tokens": 5}) for i, prompt in enumerate(["abc", "de", "fgh", "ij"])]
+    results = run(batcher, calls)
+    assert [result["completion_only"] for result in results] == ["ABC", "DE", "FGH", "IJ"]
+    assert [result["seed"] for result in results] == [0, 1, 2, 3]
+    assert [result["prompt_tokens"] for result in results] == [3, 2, 3, 2]
+    assert len(stub.batches) == 1
+    assert stub.batches[0]["kwargs"]["max_new_tokens"] == 5
+    assert (batcher.calls, batcher.batches) == (4, 1)
+
+def test_max_batch_size(stub, byte_tokenizer):
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", max_batch_size=2, batch_window=0.1)
+    results = run(batcher, [(prompt, None) for prompt in ["a", "b", "c"]])
+    assert [result["completion_only"] for result in results] == ["A", "B", "C"]
+    assert sorted(len(batch["prompts"]) for batch in stub.batches) == [1, 2]
+
+def test_different_params_do_not_share_a_batch(stub, byte_tokenizer):
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", batch_window=0.1)
+    results = run(batcher, [("a", {"top_k": 10}), ("b", {"top_k": 20}), ("c", {"top_k": 10}), ("d", {"seed": 1})])
+    assert [result["completion_only"] for result in results] == ["A", "B", "C", "D"]
+    assert sorted(sorted(batch["prompts"]) for batch in stub.batches) == [["a", "c"], ["b"], ["d"]]
+
+def test_error_reaches_every_waiting_call(monkeypatch, byte_tokenizer):
+    stub = StubGenerate(error=RuntimeError("out of memory"))
+    monkeypatch.setattr(async_batching, "run_batched_inference", stub)
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", batch_window=0.1)
+    results = run(batcher, [(prompt, None) for prompt in ["a", "b", "c"]])
+    assert all(isinstance(result, RuntimeError) and str(result) == "out of memory" for result in results)
+
+def test_bad_params_fail_only_their_call(stub, byte_tokenizer):
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", batch_window=0.1)
+    results = run(batcher, [("a", None), ("b", {"stop_criteria": {"stop_strings": {"\n"}}}), ("c", {"beams": 2})])
+    assert results[0]["completion_only"] == "A"
+    assert isinstance(results[1], TypeError)
+    assert isinstance(results[2], ValueError)
+
+def test_batcher_keeps_serving_after_an_error(monkeypatch, byte_tokenizer):
+    stub = StubGenerate(error=RuntimeError("out of memory"))
+    monkeypatch.setattr(async_batching, "run_batched_inference", stub)
+    batcher = AsyncBatcher(None, byte_tokenizer, "cpu", batch_window=0.01)
+
+    async def main():
+        try:
+            with pytest.raises(RuntimeError):
+                await batcher.generate_async("a")
+            stub.error = None
+            return await batcher.generate_async("b")
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(main())["completion_only"] == "B"
@@ -0,0 +1,36 @@
+from batching import bucket_by_length, padding_efficiency
+
+def test_buckets_cover_every_index_once():
+    lengths = [30, 5, 12, 7, 100, 64, 6, 13]
+    buckets = bucket_by_length(lengths, batch_size=3)
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(lengths)))
+
+def test_buckets_are_sorted_and_bounded_by_batch_size():
+    lengths = [10] * 7
+    buckets = bucket_by_length(lengths, batch_size=3)
+    assert [len(bucket) for bucket in buckets] == [3, 3, 1]
+
+def test_bucket_closes_at_length_ratio():
+    lengths = [10, 15, 20, 21, 50]
+    buckets = bucket_by_length(lengths, batch_size=8, max_length_ratio=2.0)
+    assert buckets == [[0, 1, 2], [3], [4]]
+    for bucket in buckets:
+        shortest = min(lengths[i] for i in bucket)
+        assert max(lengths[i] for i in bucket) <= 2.0 * shortest
+
+def test_shortest_bucket_first():
+    lengths = [400, 3, 90, 4]
+    buckets = bucket_by_length(lengths, batch_size=2, max_length_ratio=100.0)
+    assert buckets == [[1, 3], [2, 0]]
+
+def test_zero_length_items_do_not_divide_by_zero():
+    assert bucket_by_length([0, 0, 2], batch_size=4) == [[0, 1, 2]]
+
+def test_empty_input():
+    assert bucket_by_length([], batch_size=4) == []
+    assert padding_efficiency([], []) == 1.0
+
+def test_padding_efficiency():
+    lengths = [2, 4, 8]
+    assert padding_efficiency(lengths, [[0, 1], [2]]) == (2 + 4 + 8) / (2 * 4 + 8)
+    assert padding_efficiency(lengths, [[0], [1], [2]]) == 1.0
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+from generation_cache import GenerationCache, completion_params
+
+FINGERPRINT = {"model": "allenai/OLMo-2-0425-1B", "revision": None, "dtype": "torch.float32",
+               "precision": "torch.float32", "tokenizer": "allenai/OLMo-2-0425-1B", "vocab_size": 100278}
+
+def result(text):
+    return {"completion_only": text, "stop_reason": "length", "token_metrics": {"entropy": [0.5, 1.25]}}
+
+def test_key_depends_on_every_input(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    params = completion_params(seed=1, max_new_tokens=100)
+    key = cache.key(FINGERPRINT, "prompt", params)
+    assert key == cache.key(dict(reversed(list(FINGERPRINT.items()))), "prompt", dict(params))
+    assert key != cache.key(FINGERPRINT, "prompt ", params)
+    assert key != cache.key(FINGERPRINT, "prompt", completion_params(seed=2, max_new_tokens=100))
+    assert key != cache.key(FINGERPRINT, "prompt", completion_params(seed=1, max_new_tokens=100, engine="scheduler"))
+    assert key != cache.key(dict(FINGERPRINT, precision="int8"), "prompt", params)
+
+def test_get_put_round_trip(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    key = cache.key(FINGERPRINT, "prompt", completion_params(1, 100))
+    assert cache.get(key) is None
+    cache.put(key, result("Once"))
+    assert cache.get(key) == result("Once")
+    # A new instance sees the entries already on disk
+    assert GenerationCache(str(tmp_path)).get(key) == result("Once")
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+
+def test_logit_snapshot_round_trip(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    snapshot = np.arange(12, dtype=np.float16).reshape(3, 4)
+    cache.put("ab" * 32, dict(result("Once"), logit_snapshot=snapshot))
+    stored = cache.get("ab" * 32)
+    np.testing.assert_array_equal(stored.pop("logit_snapshot"), snapshot)
+    assert stored == result("Once")
+
+def test_overwrite_replaces_entry_size(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    cache.put("ef" * 32, dict(result("x" * 100), logit_snapshot=np.zeros(64, dtype=np.float32)))
+    cache.put("ef" * 32, result("y" * 10))
+    assert "logit_snapshot" not in cache.get("ef" * 32)
+    assert cache.total_bytes == sum(size for _, _, size in cache._entries()) == os.path.getsize(cache._path("ef" * 32))
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    cache.put("cd" * 32, result("Once"))
+    with open(cache._path("cd" * 32), "w") as f:
+        f.write('{"completion_only": "On')
+    assert cache.get("cd" * 32) is None
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    keys = [f"{i:02d}" * 32 for i in range(4)]
+    for age, key in enumerate(keys):
+        cache.put(key, result("x" * 100))
+        # Oldest first: keys[0] was used longest ago
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+    entry_size = cache.total_bytes // len(keys)
+    cache.get(keys[0])
+    # Room for three entries: storing a fifth evicts down to 90% of that
+    cache.max_bytes = 3 * entry_size + entry_size // 2
+    cache.put("99" * 32, result("x" * 100))
+    assert cache.evictions == 2
+    assert cache.get(keys[1]) is None and cache.get(keys[2]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[3]) is not None
+    assert cache.get("99" * 32) is not None
+    assert cache.total_bytes <= cache.max_bytes
+
+def test_lookup_generates_only_misses(tmp_path):
+    cache = GenerationCache(str(tmp_path))
+    cache.put("aa" * 32, result("cached"))
+    calls = []
+
+    def generate(positions):
+        calls.append(positions)
+        return [result(f"new {i}") for i in positions]
+
+    keys = ["aa" * 32, "bb" * 32, None]
+    assert cache.lookup(keys, generate) == [result("cached"), result("new 1"), result("new 2")]
+    assert calls == [[1, 2]]
+    # Uncached completions (None key) are generated again, the others are not
+    assert cache.lookup(keys, generate) == [result("cached"), result("new 1"), result("new 2")]
+    assert calls == [[1, 2], [2]]
@@ -0,0 +1,117 @@
+import json
+import argparse
+import threading
+import types
+import urllib.error
+import urllib.request
+import pytest
+
+pytest.importorskip("torch")
+
+from generation_server import GenerationClient, GenerationServer, ModelWorker, connect_from_args, server_conflicts
+
+MODEL = "stub/model"
+
+class StubWorker(ModelWorker):
+    """ModelWorker whose batches echo their prompts instead of running a model."""
+    def __init__(self, tokenizer, **options):
+        super().__init__(types.SimpleNamespace(config=types.SimpleNamespace(name_or_path=MODEL)), tokenizer, "cpu",
+                         **options)
+        self.batch_sizes = []
+
+    def _generate_batch(self, units, params):
+        self.batch_sizes.append(len(units))
+        if params.get("max_new_tokens") == 0:
+            raise RuntimeError("nothing to generate")
+        return [{"completion_only": unit["prompt"][::-1], "seed": unit["seed"],
+                 "prompt_tokens": len(unit["prompt_token_ids"])} for unit in units]
+
+@pytest.fixture
+def server(byte_tokenizer):
+    server = GenerationServer(("127.0.0.1", 0), "cpu")
+    worker = StubWorker(byte_tokenizer, max_batch_size=4, batch_window=0.2)
+    worker.start()
+    server.workers[(MODEL, "fp32")] = worker
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def post(server, path, data):
+    request = urllib.request.Request(url(server) + path, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def test_round_trip(server, byte_tokenizer):
+    client = GenerationClient(url(server), MODEL, "fp32", byte_tokenizer, timeout=10)
+    results = client.run_batched_inference(["abc", "hello"], num_return_sequences=2, seeds=[1, 2, 3, 4])
+    assert [result["completion_only"] for result in results] == ["cba", "cba", "olleh", "olleh"]
+    assert [result["seed"] for result in results] == [1, 2, 3, 4]
+    # Tokenized on the server with the model's tokenizer (one token per byte)
+    assert [result["prompt_tokens"] for result in results] == [3, 3, 5, 5]
+
+def test_concurrent_requests_share_a_batch(server, byte_tokenizer):
+    client = GenerationClient(url(server), MODEL, "fp32", byte_tokenizer, timeout=10)
+    results = {}
+
+    def generate(prompt):
+        results[prompt] = client.run_batched_inference(prompt)[0]["completion_only"]
+
+    threads = [threading.Thread(target=generate, args=(prompt,)) for prompt in ("one", "two", "six")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"one": "eno", "two": "owt", "six": "xis"}
+    assert server.workers[(MODEL, "fp32")].batch_sizes == [3]
+
+def test_bad_json_is_a_client_error(server):
+    status, body = post(server, "/generate", b'{"model": "stub/model", "prompts": [')
+    assert status == 400
+    assert "error" in body
+
+@pytest.mark.parametrize("payload", [
+    {"prompts": ["a"]},
+    {"model": MODEL, "prompts": []},
+    {"model": MODEL, "prompts": ["a"], "num_return_sequences": 0},
+    {"model": MODEL, "prompts": ["a", "b"], "prompt_token_ids": [[1]]},
+    {"model": MODEL, "prompts": ["a"], "seeds": [1, 2]}
+])
+def test_invalid_payload_is_a_client_error(server, payload):
+    status, _ = post(server, "/generate", json.dumps(payload).encode("utf-8"))
+    assert status == 400
+
+def test_generation_error_reaches_client(server, byte_tokenizer):
+    client = GenerationClient(url(server), MODEL, "fp32", byte_tokenizer, timeout=10)
+    with pytest.raises(RuntimeError, match="nothing to generate"):
+        client.run_batched_inference("abc", max_new_tokens=0)
+    # The worker keeps serving
+    assert client.run_batched_inference("abc")[0]["completion_only"] == "cba"
+
+def test_health(server):
+    with urllib.request.urlopen(url(server) + "/health", timeout=10) as response:
+        models = json.load(response)["models"]
+    assert [(model["model"], model["dtype"]) for model in models] == [(MODEL, "fp32")]
+
+def client_args(**options):
+    return argparse.Namespace(server="http://127.0.0.1:1", model=MODEL, dtype="fp32", checkpoint_dir="", **options)
+
+def test_server_conflicts():
+    assert server_conflicts(client_args(scheduler=True, prompt_cache=True, auto_batch_size=False)) == [
+        "--scheduler", "--prompt_cache"]
+    assert server_conflicts(argparse.Namespace(server=None, scheduler=True)) == []
+
+@pytest.mark.parametrize("option", ["assistant_model", "scheduler", "auto_batch_size", "cpu_optimized", "prompt_cache"])
+def test_connect_from_args_rejects_local_options(option):
+    with pytest.raises(SystemExit, match=f"--{option}"):
+        connect_from_args(client_args(**{option: True}))
+
+def test_connect_from_args_without_server():
+    assert connect_from_args(argparse.Namespace(server=None, scheduler=True)) is None
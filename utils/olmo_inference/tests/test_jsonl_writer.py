@@ -0,0 +1,34 @@
+import json
+import pytest
+from jsonl_writer import BufferedJsonlWriter
+
+def read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_records_are_appended_in_order(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    with BufferedJsonlWriter(path, max_records=3) as writer:
+        for i in range(10):
+            writer.write({"completion_idx": i})
+    assert read(path) == [{"completion_idx": i} for i in range(10)]
+    assert writer.records_written == 10
+
+def test_unserializable_record_is_dropped(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    writer = BufferedJsonlWriter(path, max_records=100)
+    writer.write({"completion_idx": 0})
+    writer.write({"completion_idx": 1, "tokens": {1, 2}})
+    writer.write({"completion_idx": 2})
+    with pytest.raises(TypeError):
+        writer.flush()
+    # The records buffered with it are written, and so is everything after it
+    writer.write({"completion_idx": 3})
+    writer.close()
+    assert [record["completion_idx"] for record in read(path)] == [0, 2, 3]
+
+def test_write_after_close(tmp_path):
+    writer = BufferedJsonlWriter(str(tmp_path / "out.jsonl"))
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.write({"completion_idx": 0})
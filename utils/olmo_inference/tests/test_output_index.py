@@ -0,0 +1,68 @@
+import json
+from output_index import completed_indices, is_valid_record_line, pending_indices, repair_tail
+
+def record(completion_idx, text="Once upon a time"):
+    return json.dumps({"prompt": "p", "completion_only": text, "completion_idx": completion_idx}) + "\n"
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+def test_valid_record_line():
+    assert is_valid_record_line(record(3).encode())
+    assert not is_valid_record_line(b'{"completion_idx": 3}\n')
+    assert not is_valid_record_line(record(3).encode()[:-10])
+
+def test_repair_tail_removes_partial_last_line(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + record(1) + record(2)[:20])
+    removed = repair_tail(path)
+    assert removed == 20
+    with open(path) as f:
+        assert f.read() == record(0) + record(1)
+
+def test_repair_tail_removes_invalid_complete_line(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + '{"completion_idx": 1, "completion_only": "\n')
+    repair_tail(path)
+    with open(path) as f:
+        assert f.read() == record(0)
+
+def test_repair_tail_keeps_clean_file(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + record(1))
+    assert repair_tail(path) == 0
+    assert repair_tail(str(tmp_path / "missing.jsonl")) == 0
+
+def test_indices_in_completion_text_are_not_counted(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0, text='he wrote "completion_idx": 7 on the wall'))
+    assert completed_indices(path) == {0}
+
+def test_completed_indices_rescans_only_appended_bytes(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + record(2))
+    assert completed_indices(path) == {0, 2}
+    with open(path, "a") as f:
+        f.write(record(1))
+    assert completed_indices(path) == {0, 1, 2}
+    # A rewritten, shorter file invalidates the sidecar index
+    write(path, record(5))
+    assert completed_indices(path) == {5}
+
+def test_same_size_rewrite_is_rescanned(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + record(1) + record(2))
+    assert completed_indices(path) == {0, 1, 2}
+    # Regenerated in place to the same size, then grown: the old indices must not survive
+    write(path, record(3) + record(4) + record(5))
+    assert completed_indices(path) == {3, 4, 5}
+    write(path, record(6) + record(7) + record(8) + record(9))
+    assert completed_indices(path) == {6, 7, 8, 9}
+
+def test_pending_indices(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write(path, record(0) + record(3) + record(1)[:15])
+    assert pending_indices(path, 5, resume=False) == [0, 1, 2, 3, 4]
+    assert pending_indices(path, 5, resume=True) == [1, 2, 4]
+    assert pending_indices(str(tmp_path / "missing.jsonl"), 3, resume=True) == [0, 1, 2]
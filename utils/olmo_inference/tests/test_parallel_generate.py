@@ -0,0 +1,60 @@
+import json
+import pytest
+
+pytest.importorskip("torch")
+
+import parallel_generate
+from parallel_generate import cpu_core_sets, merge_shards, split_indices
+
+def record(completion_idx):
+    return json.dumps({"completion_only": f"text {completion_idx}", "completion_idx": completion_idx}) + "\n"
+
+def write(path, records):
+    with open(path, "w") as f:
+        f.writelines(records)
+
+def test_split_indices():
+    assert split_indices(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert split_indices([4, 9], 3) == [[4], [9]]
+
+def test_merge_shards_in_completion_idx_order(tmp_path):
+    output_file = str(tmp_path / "out.jsonl")
+    write(output_file, [record(0)])
+    shard_files = [str(tmp_path / f"out.jsonl.shard{i}") for i in range(3)]
+    write(shard_files[0], [record(1), record(4), record(7)])
+    write(shard_files[1], [record(2), record(5)])
+    # A torn record left by a killed worker is dropped
+    write(shard_files[2], [record(3), record(6), record(8)[:12]])
+    assert merge_shards(output_file, shard_files + [str(tmp_path / "missing.shard")]) == 7
+    with open(output_file) as f:
+        assert [json.loads(line)["completion_idx"] for line in f] == list(range(8))
+    assert not any((tmp_path / name).exists() for name in ("out.jsonl.shard0", "out.jsonl.shard1", "out.jsonl.shard2"))
+
+def test_merge_shards_appends_after_existing_records(tmp_path):
+    output_file = str(tmp_path / "out.jsonl")
+    write(output_file, [record(0), record(3)])
+    shard_file = str(tmp_path / "out.jsonl.shard0")
+    write(shard_file, [record(1), record(2)])
+    merge_shards(output_file, [shard_file])
+    with open(output_file) as f:
+        assert [json.loads(line)["completion_idx"] for line in f] == [0, 3, 1, 2]
+
+def test_merge_shards_without_shards(tmp_path):
+    assert merge_shards(str(tmp_path / "out.jsonl"), [str(tmp_path / "out.jsonl.shard0")]) == 0
+
+@pytest.fixture
+def eight_cores(monkeypatch):
+    monkeypatch.setattr(parallel_generate.os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+
+def test_cpu_core_sets_share_cores_evenly(eight_cores):
+    assert cpu_core_sets(3) == [[0, 1], [2, 3], [4, 5]]
+    assert cpu_core_sets(2, threads_per_worker=3) == [[0, 1, 2], [3, 4, 5]]
+
+def test_cpu_core_sets_clamp_threads_per_worker(eight_cores):
+    core_sets = cpu_core_sets(3, threads_per_worker=4)
+    assert core_sets == [[0, 1], [2, 3], [4, 5]]
+    assert len({core for cores in core_sets for core in cores}) == 6
+
+def test_cpu_core_sets_reject_more_workers_than_cores(eight_cores):
+    with pytest.raises(ValueError):
+        cpu_core_sets(9)
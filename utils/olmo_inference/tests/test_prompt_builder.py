@@ -0,0 +1,55 @@
+import random
+import pytest
+from prompt_builder import build_random_doc_prompt
+
+DOC = "The quick brown fox jumps over the lazy dog. " * 10
+INSTRUCTION = "Write a story."
+
+def test_no_budget_keeps_whole_document(byte_tokenizer):
+    built = build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION)
+    assert built["prompt"] == DOC + "\n" + INSTRUCTION
+    assert built["doc_span"] == [0, len(DOC)]
+    assert built["doc_tokens_used"] is None
+    assert built["prompt_token_ids"] == byte_tokenizer(built["prompt"])["input_ids"]
+
+def test_empty_document(byte_tokenizer):
+    built = build_random_doc_prompt(byte_tokenizer, "", INSTRUCTION, token_budget=100)
+    assert built["prompt"] == INSTRUCTION
+    assert built["doc_span"] == [0, 0]
+
+def test_document_within_budget_is_not_cut(byte_tokenizer):
+    built = build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION, token_budget=10000)
+    assert built["prompt"] == DOC + "\n" + INSTRUCTION
+    assert built["doc_tokens_used"] == built["doc_tokens_total"] == len(DOC)
+
+@pytest.mark.parametrize("truncation", ["head", "tail", "random"])
+def test_truncated_prompt_fits_budget(byte_tokenizer, truncation):
+    budget = 100
+    built = build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION, token_budget=budget,
+                                    truncation=truncation, rng=random.Random(0))
+    start, end = built["doc_span"]
+    assert len(built["prompt_token_ids"]) <= budget
+    assert built["prompt"] == DOC[start:end] + "\n" + INSTRUCTION
+    assert built["prompt_token_ids"] == byte_tokenizer(built["prompt"])["input_ids"]
+    # One token per byte: the whole remaining budget goes to the document
+    assert built["doc_tokens_used"] == end - start == budget - len("\n" + INSTRUCTION)
+    assert built["doc_tokens_total"] == len(DOC)
+    if truncation == "head":
+        assert start == 0
+    elif truncation == "tail":
+        assert end == len(DOC)
+
+def test_random_truncation_follows_rng(byte_tokenizer):
+    spans = [build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION, token_budget=60, truncation="random",
+                                     rng=random.Random(seed))["doc_span"] for seed in (1, 1, 2)]
+    assert spans[0] == spans[1]
+    assert spans[0] != spans[2]
+
+def test_budget_below_instruction_drops_document(byte_tokenizer):
+    built = build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION, token_budget=5)
+    assert built["prompt"] == INSTRUCTION
+    assert built["doc_tokens_used"] == 0
+
+def test_unknown_truncation_mode(byte_tokenizer):
+    with pytest.raises(ValueError):
+        build_random_doc_prompt(byte_tokenizer, DOC, INSTRUCTION, token_budget=50, truncation="middle")
@@ -0,0 +1,45 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from transformers import TopKLogitsWarper, TopPLogitsWarper
+from sampling import sample_next_tokens, sample_with_metrics, top_k_top_p_filter
+from token_metrics import entropy_from_log_probs
+
+def random_logits(batch=4, vocab=1000, seed=0):
+    return torch.randn(batch, vocab, generator=torch.Generator().manual_seed(seed)) * 3
+
+def hf_filter(scores, top_k, top_p):
+    """What generate() applies to the scores with do_sample=True."""
+    input_ids = torch.zeros(scores.shape[0], 1, dtype=torch.long)
+    if top_k:
+        scores = TopKLogitsWarper(top_k)(input_ids, scores)
+    if top_p is not None and top_p < 1.0:
+        scores = TopPLogitsWarper(top_p)(input_ids, scores)
+    return scores
+
+@pytest.mark.parametrize("top_k,top_p", [(50, 0.95), (50, 1.0), (0, 0.9), (5, 0.5), (2000, 0.99), (1, 0.95)])
+def test_filter_matches_hf_warpers(top_k, top_p):
+    for seed in range(3):
+        scores = random_logits(seed=seed)
+        assert torch.equal(top_k_top_p_filter(scores, top_k, top_p), hf_filter(scores, top_k, top_p))
+
+def test_filter_keeps_most_likely_token():
+    scores = torch.tensor([[10.0, 0.0, 0.0, 0.0]])
+    filtered = top_k_top_p_filter(scores, top_k=0, top_p=0.01)
+    assert filtered[0, 0] == 10.0
+    assert torch.isinf(filtered[0, 1:]).all()
+
+@pytest.mark.parametrize("top_k,top_p", [(50, 0.95), (0, 0.9), (5, 1.0)])
+def test_sample_with_metrics_matches_full_vocabulary(top_k, top_p):
+    logits = random_logits(seed=7)
+    filtered = top_k_top_p_filter(logits, top_k, top_p)
+    log_probs = torch.log_softmax(filtered, dim=-1)
+    generators = [torch.Generator().manual_seed(row) for row in range(logits.shape[0])]
+    expected_tokens = sample_next_tokens(filtered, generators)
+
+    generators = [torch.Generator().manual_seed(row) for row in range(logits.shape[0])]
+    tokens, entropy, chosen_log_prob = sample_with_metrics(logits, top_k, top_p, generators)
+    assert torch.equal(tokens, expected_tokens)
+    torch.testing.assert_close(entropy, entropy_from_log_probs(log_probs))
+    torch.testing.assert_close(chosen_log_prob, log_probs.gather(-1, tokens.unsqueeze(-1)).squeeze(-1))
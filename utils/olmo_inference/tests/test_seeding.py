@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from seeding import completion_rng, completion_seed, completion_seeds
+
+def test_completion_seed_is_stable():
+    # Stored in output records: a changed derivation breaks regenerating old runs
+    assert completion_seed(1234, 0, "doc") == 1066377638644547241
+    assert completion_seed(1234, 7, "sample") == 3629577457745995317
+
+def test_completion_seed_is_63_bit():
+    for completion_idx in range(100):
+        assert 0 <= completion_seed(0, completion_idx, "sample") < 1 << 63
+
+def test_completion_seed_differs_by_run_index_and_purpose():
+    seeds = {completion_seed(run_seed, completion_idx, purpose)
+             for run_seed in (0, 1) for completion_idx in range(50) for purpose in ("doc", "sample")}
+    assert len(seeds) == 2 * 50 * 2
+
+def test_completion_rng_does_not_depend_on_order():
+    first = [completion_rng(5, completion_idx, "doc").random() for completion_idx in range(10)]
+    reversed_order = [completion_rng(5, completion_idx, "doc").random() for completion_idx in reversed(range(10))]
+    assert first == reversed_order[::-1]
+
+def test_completion_seeds_record_fields():
+    assert completion_seeds(3, 4) == {
+        "run_seed": 3,
+        "doc_seed": completion_seed(3, 4, "doc"),
+        "sample_seed": completion_seed(3, 4, "sample")
+    }
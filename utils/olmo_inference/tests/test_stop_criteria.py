@@ -0,0 +1,88 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from prompt_store import get_stop_criteria
+from stop_criteria import LIST_ITEM_PATTERN, StopChecker, count_list_items
+
+def test_list_item_pattern_matches_line_starts_only():
+    text = "1. Apples\n  2) Pears\nI counted 3. Then 4. more\n"
+    assert LIST_ITEM_PATTERN.findall(text) == ["1", "2"]
+
+def test_list_item_pattern_ignores_long_numbers():
+    assert LIST_ITEM_PATTERN.findall("1999. A good year\n2024) another\n") == []
+
+def test_count_list_items_counts_consecutive_numbering():
+    assert count_list_items("1. a\n2. b\n3. c\n") == 3
+    assert count_list_items("4. d\n", count=3) == 4
+
+def test_count_list_items_ignores_out_of_sequence_numbers():
+    # A number that happens to start a line (a year, a page) does not extend the list
+    assert count_list_items("1. a\n2. b\n150. years later\n3. c\n") == 3
+
+def test_count_list_items_restarts_at_one():
+    assert count_list_items("1. a\n2. b\n3. c\n1. again\n") == 1
+
+def feed(checker, text, tokenizer, step=1):
+    """Feed text to a new StopState a few tokens at a time; the reason and the state at the stop."""
+    token_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    state = checker.start()
+    for i in range(0, len(token_ids), step):
+        reason = state.update(token_ids[i:i + step])
+        if reason is not None:
+            return reason, state
+    return None, state
+
+@pytest.mark.parametrize("step", [1, 3])
+def test_incremental_text_matches_full_decode(byte_tokenizer, step):
+    text = "Café crème — naïve façade\n1. 日本語 text\n"
+    reason, state = feed(StopChecker(byte_tokenizer, {}), text, byte_tokenizer, step)
+    assert reason is None
+    assert state.text == text
+
+def test_stop_string(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"stop_strings": ["\n\n\n"]})
+    reason, state = feed(checker, "Intro\n\nBody\n\n\nTrailing", byte_tokenizer)
+    assert reason == "stop_string"
+    assert state.text == "Intro\n\nBody\n\n\n"
+
+def test_max_lines_counts_ended_non_empty_lines(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"max_lines": 3})
+    reason, state = feed(checker, "An old pond\n\nA frog jumps in\nThe sound of water\nMore", byte_tokenizer)
+    assert reason == "max_lines"
+    assert state.text.endswith("The sound of water\n")
+
+def test_max_list_items(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"max_list_items": 3})
+    text = "1. a\n2. b\n1999. was a year\n3. c\n4. d\n"
+    reason, state = feed(checker, text, byte_tokenizer)
+    assert reason == "max_list_items"
+    assert state.text == "1. a\n2. b\n1999. was a year\n3. c\n4. "
+
+@pytest.mark.parametrize("prompt_key,first_item", [("NLP_research", 4), ("NLP_research_no_examples", 2)])
+def test_max_list_items_continues_prompt_numbering(byte_tokenizer, prompt_key, first_item):
+    criteria = get_stop_criteria(prompt_key)
+    assert criteria["max_list_items"] == 100
+    # The completion finishes the item the prompt opened, then goes on from there
+    text = "a project on parsing\n" + "".join(f"{i}. project {i}\n" for i in range(first_item, 102))
+    reason, state = feed(StopChecker(byte_tokenizer, criteria), text, byte_tokenizer)
+    assert reason == "max_list_items"
+    assert state.text.endswith("100. project 100\n101. ")
+
+def test_word_budget_stops_at_sentence_end(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"word_budget": 5})
+    reason, state = feed(checker, "One two three four five six. Seven eight.", byte_tokenizer)
+    assert reason == "word_budget"
+    assert state.text == "One two three four five six."
+
+def test_word_budget_slack(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"word_budget": 4})
+    reason, state = feed(checker, "one two three four five six seven", byte_tokenizer)
+    assert reason == "word_budget"
+    assert len(state.text.split()) == 5
+
+def test_check_matches_incremental_updates(byte_tokenizer):
+    checker = StopChecker(byte_tokenizer, {"max_lines": 2, "word_budget": 50})
+    text = "First line\nSecond line\nThird"
+    token_ids = byte_tokenizer(text, add_special_tokens=False)["input_ids"]
+    assert checker.check(token_ids) == feed(checker, text, byte_tokenizer)[0] == "max_lines"
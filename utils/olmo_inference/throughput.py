@@ -0,0 +1,32 @@
+"""
+Generated-token throughput of generation calls.
+
+The generation scripts wrap their generate closures with ThroughputMeter.measure
+and report tokens/s per prompt key, whatever device or decode engine runs them.
+"""
+import time
+
+class ThroughputMeter:
+    """Generated tokens per second over the generate calls it wraps."""
+    def __init__(self):
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def measure(self, generate):
+        """Wrap a function returning result dicts (with token_ids) so its calls are counted."""
+        def measured(*args, **kwargs):
+            start = time.perf_counter()
+            results = generate(*args, **kwargs)
+            self.seconds += time.perf_counter() - start
+            self.tokens += sum(len(result["token_ids"]) for result in results)
+            return results
+        return measured
+
+    def tokens_per_second(self):
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
+
+    def report(self, label=""):
+        if not self.tokens:
+            return
+        print(f"Throughput{' ' + label if label else ''}: {self.tokens_per_second():.1f} tokens/s "
+              f"({self.tokens} tokens in {self.seconds:.1f}s)")
@@ -0,0 +1,157 @@
+"""
+Token-level metrics shared by the generation scripts.
+
+All steps and all batch rows are scored in one log-softmax pass on the device the
+scores live on, and the results are copied back to the host in a single transfer
+instead of one .item() call per generated token.
+"""
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor
+
+def eos_token_ids(model, tokenizer):
+    """Return the set of token ids that end a sequence for this model."""
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    if eos is None:
+        return set()
+    return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+def generated_length(token_ids, eos_ids):
+    """
+    Number of generated tokens that belong to the sequence, i.e. up to and
+    including the first EOS. Anything after it is padding added by generate
+    once the row finished early and must not count towards the metrics.
+
+    Args:
+        token_ids (list): Generated token ids for one row
+        eos_ids (set): Ids that end a sequence
+
+    Returns:
+        int: Number of valid generated tokens
+    """
+    for i, token_id in enumerate(token_ids):
+        if token_id in eos_ids:
+            return i + 1
+    return len(token_ids)
+
+def entropy_from_log_probs(log_probs):
+    """Entropy over the last dimension of a log-softmax tensor."""
+    # Filtered tokens have -inf log-probs; clamp like torch.distributions.Categorical
+    # does so that 0 * -inf contributes 0 rather than nan
+    clamped = log_probs.clamp(min=torch.finfo(log_probs.dtype).min)
+    return -(log_probs.exp() * clamped).sum(dim=-1)
+
+def step_metrics(scores, chosen_tokens):
+    """
+    Entropy and chosen-token log-prob for a block of processed logits.
+
+    Args:
+        scores (torch.Tensor): Logits of shape [..., vocab] (after top-k/top-p filtering)
+        chosen_tokens (torch.Tensor): Sampled token ids of shape [...]
+
+    Returns:
+        tuple: (entropy, chosen_log_prob), both of shape [...], still on device
+    """
+    log_probs = F.log_softmax(scores.float(), dim=-1)
+    entropy = entropy_from_log_probs(log_probs)
+    chosen_log_prob = log_probs.gather(-1, chosen_tokens.unsqueeze(-1)).squeeze(-1)
+    return entropy, chosen_log_prob
+
+def _metrics_to_host(entropy, log_prob):
+    """Copy [batch, steps] entropy and log-prob tensors to the host in one transfer."""
+    metrics = torch.stack([entropy, entropy.exp(), log_prob]).cpu().tolist()
+    return {"entropy": metrics[0], "perplexity": metrics[1], "logprob": metrics[2]}
+
+def _empty_metrics(batch_size):
+    empty = [[] for _ in range(batch_size)]
+    return {"entropy": empty, "perplexity": empty, "logprob": empty}
+
+def compute_token_metrics(scores, new_tokens, step_chunk=64):
+    """
+    Compute per-token entropy, perplexity and chosen-token log-prob for every
+    generated step of every row.
+
+    Args:
+        scores (tuple): generation_output.scores, one [batch, vocab] tensor per step
+        new_tokens (torch.Tensor): Generated token ids of shape [batch, steps]
+        step_chunk (int): Steps stacked per log-softmax pass, bounds temporary memory
+
+    Returns:
+        dict: "entropy", "perplexity" and "logprob", each a [batch][steps] list of floats
+    """
+    if len(scores) == 0:
+        return _empty_metrics(new_tokens.shape[0])
+
+    entropies = []
+    log_probs = []
+    for start in range(0, len(scores), step_chunk):
+        chunk = torch.stack(scores[start:start + step_chunk], dim=1)
+        entropy, log_prob = step_metrics(chunk, new_tokens[:, start:start + chunk.shape[1]].to(chunk.device))
+        entropies.append(entropy)
+        log_probs.append(log_prob)
+
+    # One device -> host transfer for all metrics
+    return _metrics_to_host(torch.cat(entropies, dim=1), torch.cat(log_probs, dim=1))
+
+class StreamingTokenMetrics(LogitsProcessor):
+    """
+    Logits processor that records the per-step metrics while generate runs, so the
+    full-vocabulary scores never need to be kept (output_scores=False).
+
+    It must be the last processor in the list, after the top-k/top-p warpers, so it
+    sees the same distribution output_scores would have returned. Only the
+    [batch, vocab] log-probs of the latest step are held until the token sampled
+    from them is known, everything else is one scalar per row and step.
+    """
+    def __init__(self):
+        self.entropies = []
+        self.log_probs = []
+        self._pending_log_probs = None
+
+    def _resolve_pending(self, chosen_tokens):
+        chosen = chosen_tokens.to(self._pending_log_probs.device).unsqueeze(-1)
+        self.log_probs.append(self._pending_log_probs.gather(-1, chosen).squeeze(-1))
+        self._pending_log_probs = None
+
+    def __call__(self, input_ids, scores):
+        # The last input id is the token sampled from the previous step
+        if self._pending_log_probs is not None:
+            self._resolve_pending(input_ids[:, -1])
+        log_probs = F.log_softmax(scores.float(), dim=-1)
+        self.entropies.append(entropy_from_log_probs(log_probs))
+        self._pending_log_probs = log_probs
+        return scores
+
+    def finalize(self, new_tokens):
+        """
+        Resolve the last step and return the metrics in the compute_token_metrics format.
+
+        Args:
+            new_tokens (torch.Tensor): Generated token ids of shape [batch, steps]
+        """
+        if self._pending_log_probs is not None:
+            self._resolve_pending(new_tokens[:, len(self.log_probs)])
+        if not self.entropies:
+            return _empty_metrics(new_tokens.shape[0])
+        return _metrics_to_host(torch.stack(self.entropies, dim=1), torch.stack(self.log_probs, dim=1))
+
+def summarize_tokens(tokenizer, token_ids, entropies, perplexities):
+    """
+    Build the per-token details and averages reported for one completion.
+
+    Returns:
+        tuple: (token_details, avg_entropy, avg_perplexity)
+    """
+    token_details = [
+        {
+            "token": tokenizer.decode(token_id),
+            "entropy": token_entropy,
+            "perplexity": token_perplexity
+        }
+        for token_id, token_entropy, token_perplexity in zip(token_ids, entropies, perplexities)
+    ]
+    avg_entropy = sum(entropies) / len(entropies) if entropies else 0.0
+    avg_perplexity = sum(perplexities) / len(perplexities) if perplexities else 0.0
+    return token_details, avg_entropy, avg_perplexity
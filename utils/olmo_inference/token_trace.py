@@ -0,0 +1,176 @@
+"""
+Binary sidecar of per-token generation traces.
+
+The JSONL records only keep the averaged token metrics. With a trace enabled, the
+generated token ids, the per-step entropy and the chosen-token log-prob of every
+completion are appended to two flat files next to the output file:
+
+    <output>.tokens          one TOKEN_DTYPE row per generated token (8 bytes)
+    <output>.tokens.offsets  one INDEX_DTYPE row per completion:
+                             (completion_idx, offset, length) into .tokens
+
+Both files are append-only, so a resumed run simply adds its completions; when a
+completion_idx appears more than once the last entry wins, matching the record a
+resumed run appends to the JSONL. TokenTrace memory-maps the token file, so a
+completion's trace is a zero-copy view:
+
+    trace = TokenTrace(output_file)
+    entropy = trace[completion_idx]["entropy"]
+"""
+import os
+import numpy as np
+
+TOKEN_DTYPE = np.dtype([("token_id", "<u4"), ("entropy", "<f2"), ("logprob", "<f2")])
+INDEX_DTYPE = np.dtype([("completion_idx", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+
+TRACE_SUFFIX = ".tokens"
+
+def trace_paths(output_file, suffix=TRACE_SUFFIX):
+    """(token file, offsets file) of an output file's trace."""
+    return output_file + suffix, output_file + suffix + ".offsets"
+
+def has_trace(output_file, suffix=TRACE_SUFFIX):
+    return os.path.exists(trace_paths(output_file, suffix)[1])
+
+def _truncate_partial_row(path, itemsize):
+    """Drop a partially written trailing row left by an interrupted write."""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size % itemsize:
+        with open(path, "r+b") as f:
+            f.truncate(size - size % itemsize)
+        size -= size % itemsize
+    return size // itemsize
+
+class TokenTraceWriter:
+    """
+    Append the token traces of completions to an output file's sidecar.
+
+    A completion's tokens are written before its offsets row, so an interrupted
+    write never leaves an offsets row pointing past the end of the token file.
+
+    Args:
+        output_file (str): JSONL output file the trace belongs to
+        suffix (str): Suffix of the trace files, for other per-token stores
+        dtype (np.dtype): Row type of the trace (one row per generated token)
+    """
+    def __init__(self, output_file, suffix=TRACE_SUFFIX, dtype=TOKEN_DTYPE):
+        self.output_file = output_file
+        self.dtype = dtype
+        tokens_path, offsets_path = trace_paths(output_file, suffix)
+        self._offset = _truncate_partial_row(tokens_path, dtype.itemsize)
+        _truncate_partial_row(offsets_path, INDEX_DTYPE.itemsize)
+        self._tokens = open(tokens_path, "ab")
+        self._offsets = open(offsets_path, "ab")
+
+    def write(self, completion_idx, token_ids, entropies, logprobs):
+        """
+        Append one completion's trace.
+
+        Args:
+            completion_idx (int): Index of the completion
+            token_ids (list): Generated token ids
+            entropies (list): Entropy of every generation step
+            logprobs (list): Log-prob of the chosen token at every step
+        """
+        rows = np.empty(len(token_ids), dtype=TOKEN_DTYPE)
+        rows["token_id"] = token_ids
+        rows["entropy"] = entropies
+        rows["logprob"] = logprobs
+        self.write_rows(completion_idx, rows)
+
+    def write_rows(self, completion_idx, rows):
+        """Append one completion's trace given as an array of the writer's dtype."""
+        self._tokens.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self._tokens.flush()
+        entry = np.array([(completion_idx, self._offset, len(rows))], dtype=INDEX_DTYPE)
+        self._offsets.write(entry.tobytes())
+        self._offsets.flush()
+        self._offset += len(rows)
+
+    def write_result(self, completion_idx, inference_results):
+        """Append the trace of a run_batched_inference result."""
+        self.write(
+            completion_idx,
+            inference_results["token_ids"],
+            [token_info["entropy"] for token_info in inference_results["token_details"]],
+            inference_results["token_logprobs"]
+        )
+
+    def close(self):
+        self._tokens.close()
+        self._offsets.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class TokenTrace:
+    """
+    Read-only, memory-mapped view of an output file's token traces.
+
+    Indexing with a completion_idx returns that completion's rows (TOKEN_DTYPE by
+    default) as a view into the mapped file; ["token_id"], ["entropy"] and
+    ["logprob"] are views as well.
+
+    Args:
+        output_file (str): JSONL output file the trace belongs to
+        suffix (str): Suffix of the trace files, see TokenTraceWriter
+        dtype (np.dtype): Row type of the trace
+    """
+    def __init__(self, output_file, suffix=TRACE_SUFFIX, dtype=TOKEN_DTYPE):
+        tokens_path, offsets_path = trace_paths(output_file, suffix)
+        offsets = np.fromfile(offsets_path, dtype=np.uint8) if os.path.exists(offsets_path) else np.empty(0, np.uint8)
+        offsets = offsets[:len(offsets) - len(offsets) % INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        num_tokens = os.path.getsize(tokens_path) // dtype.itemsize if os.path.exists(tokens_path) else 0
+        if num_tokens:
+            self.tokens = np.memmap(tokens_path, dtype=dtype, mode="r", shape=(num_tokens,))
+        else:
+            self.tokens = np.empty(0, dtype=dtype)
+        # Later entries replace earlier ones; ignore entries the token file does not cover
+        self._spans = {}
+        for completion_idx, offset, length in offsets.tolist():
+            if offset + length <= num_tokens:
+                self._spans[completion_idx] = (offset, length)
+
+    def indices(self):
+        """Completion indices that have a trace, sorted."""
+        return sorted(self._spans)
+
+    def __contains__(self, completion_idx):
+        return completion_idx in self._spans
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, completion_idx):
+        offset, length = self._spans[completion_idx]
+        return self.tokens[offset:offset + length]
+
+    def __iter__(self):
+        """Yield (completion_idx, rows) in completion_idx order."""
+        for completion_idx in self.indices():
+            yield completion_idx, self[completion_idx]
+
+def merge_traces(output_file, shard_files, suffix=TRACE_SUFFIX, dtype=TOKEN_DTYPE):
+    """
+    Append the traces of shard files to the trace of output_file and delete them.
+
+    Returns:
+        int: Number of completion traces merged
+    """
+    shard_files = [shard_file for shard_file in shard_files if has_trace(shard_file, suffix)]
+    if not shard_files:
+        return 0
+    merged = 0
+    with TokenTraceWriter(output_file, suffix, dtype) as writer:
+        for shard_file in shard_files:
+            for completion_idx, rows in TokenTrace(shard_file, suffix, dtype):
+                writer.write_rows(completion_idx, rows)
+                merged += 1
+    for shard_file in shard_files:
+        for path in trace_paths(shard_file, suffix):
+            if os.path.exists(path):
+                os.remove(path)
+    return merged
@@ -2,6 +2,7 @@
 Centralized prompt store for text generation scripts.
 This module contains common prompts used across different generation scripts.
 """
+import re
 
 # Prompt bank - collection of different prompts that can be used
 PROMPT_BANK = {
@@ -25,6 +26,29 @@ PROMPT_BANK = {
     "poem": "Write a 250-word poem:"
 }
 
+# Stop criteria enforced during generation, per prompt key
+#   stop_strings: stop once the completion contains any of these strings
+#   max_lines: stop once the completion has this many complete non-empty lines
+#   max_list_items: stop when a numbered list (1., 2., 3., ... at line starts) reaches
+#       an item numbered beyond this
+#   list_items_in_prompt: number of the list item the prompt ends on ("... 3. "), which
+#       the completion's numbering continues from
+#   word_budget: stop at the first sentence end once the completion has this many words
+#       (or, failing one, a quarter past the budget)
+# Word budgets ("500-word"), list sizes ("list of 100") and the list item a prompt
+# ends on are also read from the prompt text itself, see get_stop_criteria; entries here take precedence
+STOP_CRITERIA = {
+    "haiku": {"max_lines": 3},
+    
+    "NLP_research": {"stop_strings": ["\n\n\n"]},
+    
+    "NLP_research_no_examples": {"stop_strings": ["\n\n\n"]}
+}
+
+WORD_BUDGET_PATTERN = re.compile(r"(\d+)-word")
+LIST_SIZE_PATTERN = re.compile(r"list of (\d+)")
+TRAILING_LIST_ITEM_PATTERN = re.compile(r"(\d{1,3})[.)]\s*$")
+
 def get_prompt(key, default_key="default"):
     """
     Get a prompt by key from the prompt bank.
@@ -45,4 +69,34 @@ def get_all_prompts():
     Returns:
         dict: The complete prompt bank
     """
-    return PROMPT_BANK 
\ No newline at end of file
+    return PROMPT_BANK 
+
+def get_stop_criteria(key, default_key="default"):
+    """
+    Get the stop criteria of a prompt: the STOP_CRITERIA entry, completed with the
+    word budget, list size and trailing list item stated in the prompt text.
+    
+    Args:
+        key (str): The prompt key
+        default_key (str): Fallback key if the requested key is not found, as in get_prompt
+        
+    Returns:
+        dict: Criteria (see STOP_CRITERIA), empty if the prompt has none
+    """
+    if key not in PROMPT_BANK:
+        key = default_key
+    criteria = {}
+    prompt = PROMPT_BANK.get(key, "")
+    word_budget = WORD_BUDGET_PATTERN.search(prompt)
+    if word_budget:
+        criteria["word_budget"] = int(word_budget.group(1))
+    list_size = LIST_SIZE_PATTERN.search(prompt)
+    if list_size:
+        criteria["max_list_items"] = int(list_size.group(1))
+        # Prompts that open the list themselves ("...:1. ") leave the completion to
+        # continue from that item
+        trailing_item = TRAILING_LIST_ITEM_PATTERN.search(prompt)
+        if trailing_item:
+            criteria["list_items_in_prompt"] = int(trailing_item.group(1))
+    criteria.update(STOP_CRITERIA.get(key, {}))
+    return criteria